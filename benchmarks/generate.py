@@ -0,0 +1,151 @@
+import random
+from io import StringIO
+
+
+class ConfigGenerator(object):
+    """
+    Deterministic generator of synthetic input
+
+    Produces ini files (parsable by the example grammar: sections and
+    key = "value" lines) and free form input for the full tokenizer.
+    Values are made of words and the 3 kinds of expansion, in the
+    proportions given at construction.
+    """
+    WORDS = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'host', 'port', 'path', 'user', 'timeout', 'worker',
+             'memory', 'cache', 'size', 'level', 'x1', 'y22', '0x1f', '4711', '017']
+    VARIABLES = 10
+
+    def __init__(self, seed: int = 0, line_length: int = 60, comment_density: float = 0.1,
+                 variable_density: float = 0.1, default_density: float = 0.05, math_density: float = 0.02,
+                 nesting_depth: int = 1, section_length: int = 20):
+        """
+        Generator with tunable input shape
+
+        :param seed: random seed, same seed and parameters give the same output
+        :param line_length: approximate length of a value
+        :param comment_density: fraction of lines that are comments
+        :param variable_density: fraction of value words that are $VAR
+        :param default_density: fraction of value words that are ${VAR:mod|default}
+        :param math_density: fraction of value words that are $( ... )
+        :param nesting_depth: depth of ${UNSET|...} default chains and ( ) groups in math
+        :param section_length: number of key lines in a section
+        """
+        self._random = random.Random(seed)
+        self._line_length = line_length
+        self._comment_density = comment_density
+        self._variable_density = variable_density
+        self._default_density = default_density
+        self._math_density = math_density
+        self._nesting_depth = nesting_depth
+        self._section_length = section_length
+
+    def variables(self) -> dict:
+        """
+        Variables referenced by generated input (all have integer values)
+
+        :return: dict usable by EnvironmentVariable
+        """
+        return dict(('VAR%d' % n, str(n + 1)) for n in range(self.VARIABLES))
+
+    def ini(self, lines: int) -> str:
+        """
+        Generate an ini file
+
+        :param lines: number of lines
+        :return: content
+        """
+        content = StringIO()
+        key = 0
+        for n in range(lines):
+            if n % (self._section_length + 1) == 0:
+                content.write("[section%d]\n" % n)
+            elif self._random.random() < self._comment_density:
+                content.write("# %s\n" % self._words(self._line_length))
+            else:
+                content.write('key%d = "%s"\n' % (key, self.value()))
+                key = key + 1
+        return content.getvalue()
+
+    def full(self, lines: int) -> str:
+        """
+        Generate free form input, using all single character tokens
+
+        :param lines: number of lines
+        :return: content
+        """
+        content = StringIO()
+        for n in range(lines):
+            if self._random.random() < self._comment_density:
+                content.write("; %s\n" % self._words(self._line_length))
+                continue
+            line = []
+            length = 0
+            while length < self._line_length:
+                piece = self._random.choice(['%s(%s)' % (self._word(), self._word()),
+                                             '{%s: %s}' % (self._word(), self._word()),
+                                             '%s.%s, %s' % (self._word(), self._word(), self._word()),
+                                             '%s + %s * %s' % (self._word(), self._word(), self._word()),
+                                             "'%s'" % self._word(),
+                                             '"%s"' % self.value()])
+                line.append(piece)
+                length = length + len(piece) + 1
+            content.write("\t%s;\n" % " ".join(line))
+        return content.getvalue()
+
+    def value(self) -> str:
+        """
+        Generate the content of a double quoted value
+
+        :return: value text
+        """
+        parts = []
+        length = 0
+        while length < self._line_length:
+            dice = self._random.random()
+            if dice < self._variable_density:
+                part = '$%s' % self._variable()
+            elif dice < self._variable_density + self._default_density:
+                part = self.default(self._nesting_depth)
+            elif dice < self._variable_density + self._default_density + self._math_density:
+                part = self.math(self._nesting_depth)
+            else:
+                part = self._word()
+            parts.append(part)
+            length = length + len(part) + 1
+        return " ".join(parts)
+
+    def default(self, depth: int) -> str:
+        """
+        Generate a chain of defaults, ending in a variable that resolves
+
+        :param depth: number of unresolvable variables before the resolvable one
+        :return: ${...} expression
+        """
+        inner = '${%s:%s}' % (self._variable(), self._random.choice(['xml', 'attr', 'uri', 'sql']))
+        for n in range(depth):
+            inner = '${UNSET%d|%s}' % (n, inner)
+        return inner
+
+    def math(self, depth: int) -> str:
+        """
+        Generate a math expression
+
+        :param depth: nesting of ( ) groups
+        :return: $( ... ) expression
+        """
+        expression = '${%s} * 1024 / %s' % (self._variable(), self._random.randint(1, 9))
+        for n in range(depth - 1):
+            expression = '( %s %s $%s )' % (expression, self._random.choice('+-*<>'), self._variable())
+        return '$( %s < 65536 )' % expression
+
+    def _variable(self) -> str:
+        return 'VAR%d' % self._random.randrange(self.VARIABLES)
+
+    def _word(self) -> str:
+        return self._random.choice(self.WORDS)
+
+    def _words(self, length: int) -> str:
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            words.append(self._word())
+        return " ".join(words)
@@ -0,0 +1,325 @@
+"""
+Timing harnesses for Reader, Tokenizer, Expansion and math evaluation
+
+Usage: python -m benchmarks.run [--lines N] [--seed N] [--repeat N] [--depth N] [--output FILE]
+
+Results are written as JSON, so runs on different commits can be compared.
+Every result is the best of --repeat runs.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from io import StringIO
+
+from benchmarks.generate import ConfigGenerator
+from expanding.expand import Expansion
+from expanding.math import MathExpr, MathProgram, MathType, MathValue
+from expanding.source import Reader
+from expanding.tokenizer import Tokenizer, TokenEngine, TokenGrammar, TokenType as T, TokenWhitespace
+from expanding.variable import EnvironmentVariable
+
+
+def best_of(repeat: int, function) -> tuple:
+    """
+    Run a function a number of times
+
+    :param repeat: number of runs
+    :param function: takes no arguments and returns a count of work done
+    :return: (best time in seconds, count)
+    """
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, count
+
+
+def result(seconds: float, count: int, unit: str, **extra) -> dict:
+    """
+    Build a result record
+
+    :param seconds: time taken
+    :param count: work done
+    :param unit: what count is counting
+    :param extra: additional fields
+    :return: dict for json output
+    """
+    record = {'seconds': seconds, 'count': count, 'unit': unit + '/sec',
+              'rate': count / seconds if seconds > 0 else None}
+    record.update(extra)
+    return record
+
+
+def bench_reader(text: str, repeat: int) -> dict:
+    """
+    Reader.get() throughput
+
+    :return: result in chars/sec
+    """
+    def run():
+        reader = Reader(StringIO(text))
+        count = 0
+        while reader.get() is not None:
+            count = count + 1
+        return count
+
+    return result(*best_of(repeat, run), unit='chars')
+
+
+def bench_tokenizer(text: str, variables: dict, whitespace: TokenWhitespace, single_tokens: str,
+                    engine: TokenEngine, repeat: int) -> dict:
+    """
+    Tokenizer._next_token() throughput
+
+    :return: result in tokens/sec
+    """
+    def run():
+        tokenizer = Tokenizer(Reader(StringIO(text)), EnvironmentVariable(variables), whitespace=whitespace,
+                              single_tokens=single_tokens, engine=engine)
+        count = 0
+        while not tokenizer._next_token().is_a(T.EOF):
+            count = count + 1
+        return count
+
+    return result(*best_of(repeat, run), unit='tokens')
+
+
+def bench_tokens_are(text: str, variables: dict, repeat: int) -> dict:
+    """
+    Line matching with chained tokens_are() calls, as in the example parser
+
+    :return: result in lines/sec, with the fraction of tokens_are() calls that matched
+    """
+    calls = [0, 0]
+
+    def run():
+        tokenizer = Tokenizer(Reader(StringIO(text)), EnvironmentVariable(variables))
+        calls[0] = calls[1] = 0
+        lines = 0
+        while tokenizer.has_more():
+            for pattern in ((T.NEWLINE,), (T.SECTION, T.EOL), (T.WORD, T.EQ, T.TEXT, T.EOL)):
+                calls[0] = calls[0] + 1
+                if tokenizer.tokens_are(*pattern):
+                    calls[1] = calls[1] + 1
+                    break
+            else:
+                raise Exception("Unexpected input at: %s" % tokenizer.peek_token().at())
+            lines = lines + 1
+        return lines
+
+    record = result(*best_of(repeat, run), unit='lines')
+    record['match_rate'] = calls[1] / calls[0] if calls[0] else None
+    return record
+
+
+def bench_tokens_match(text: str, variables: dict, repeat: int) -> dict:
+    """
+    Line matching with a TokenGrammar
+
+    :return: result in lines/sec
+    """
+    grammar = TokenGrammar(blank=(T.NEWLINE,), section=(T.SECTION, T.EOL), assign=(T.WORD, T.EQ, T.TEXT, T.EOL))
+
+    def run():
+        tokenizer = Tokenizer(Reader(StringIO(text)), EnvironmentVariable(variables))
+        lines = 0
+        while tokenizer.has_more():
+            if tokenizer.tokens_match(grammar) is None:
+                raise Exception("Unexpected input at: %s" % tokenizer.peek_token().at())
+            lines = lines + 1
+        return lines
+
+    return result(*best_of(repeat, run), unit='lines')
+
+
+def bench_expansion(construct: str, variables: dict, count: int, repeat: int) -> dict:
+    """
+    Expansion.expand() throughput for one kind of construct
+
+    :param construct: text of the construct, starting with $
+    :return: result in expansions/sec
+    """
+    text = (construct + " ") * count
+
+    def run():
+        reader = Reader(StringIO(text))
+        expansion = Expansion(reader, EnvironmentVariable(variables))
+        expanded = 0
+        while reader.get() == '$':
+            expansion.expand(reader.position())
+            reader.get()
+            expanded = expanded + 1
+        return expanded
+
+    return result(*best_of(repeat, run), unit='expansions')
+
+
+def math_tree(depth: int):
+    """
+    Build a balanced math tree using all operators
+
+    :param depth: levels of operators
+    :return: MathTree
+    """
+    if depth == 0:
+        return MathValue(7)
+    operators = [MathType.ADD, MathType.SUB, MathType.MUL, MathType.DIV, MathType.MOD, MathType.MIN, MathType.MAX]
+    right = MathValue(depth + 1)
+    return MathExpr(operators[depth % len(operators)], math_tree(depth - 1), right)
+
+
+def bench_math(depth: int, count: int, repeat: int) -> dict:
+    """
+    MathExpr.get_value() throughput
+
+    :param depth: levels of operators in the tree
+    :return: result in evaluations/sec
+    """
+    tree = math_tree(depth)
+
+    def run():
+        for _ in range(count):
+            tree.get_value()
+        return count
+
+    return result(*best_of(repeat, run), unit='evaluations', operators=depth)
+
+
+def nested_text(kind: str, depth: int) -> str:
+    """
+    Build a $-construct nested to a given depth
+
+    :param kind: 'default' for ${A|${A|...x}}, 'math' for $(((...1)+1)+1),
+                 'expansion' for $($($(...1))), 'mixed' for ${A|$((${A|$((...1))}))}
+    :param depth: levels of nesting
+    :return: text of the construct, starting with $
+    """
+    if kind == 'default':
+        return '${UNSET|' * depth + 'x' + '}' * depth
+    if kind == 'expansion':
+        return '$(' * depth + '1' + ')' * depth
+    if kind == 'mixed':
+        return '${UNSET|$((' * depth + '1' + '))}' * depth
+    return '$' + '(' * depth + '1' + '+1)' * depth
+
+
+def bench_nesting(kind: str, depth: int, repeat: int) -> dict:
+    """
+    Expansion.expand() cost of one deeply nested construct
+
+    A steady rate across depths means the cost grows linearly with depth
+
+    :param kind: see nested_text()
+    :param depth: levels of nesting
+    :return: result in levels/sec
+    """
+    text = nested_text(kind, depth)
+
+    def run():
+        reader = Reader(StringIO(text))
+        reader.get()
+        Expansion(reader, EnvironmentVariable({}), max_depth=2 * depth + 1).expand(reader.position())
+        return depth
+
+    return result(*best_of(repeat, run), unit='levels', depth=depth)
+
+
+def bench_math_depth(depth: int, repeat: int) -> dict:
+    """
+    Compile and run a math tree, that is a chain of operators
+
+    :param depth: levels of operators in the tree
+    :return: result in levels/sec
+    """
+    tree = MathValue(7)
+    for level in range(depth):
+        tree = MathExpr(MathType.ADD, MathValue(level), tree)
+
+    def run():
+        MathProgram(tree).run()
+        return depth
+
+    return result(*best_of(repeat, run), unit='levels', depth=depth)
+
+
+def run_all(lines: int, seed: int, repeat: int, expansions: int, max_depth: int = 100000) -> dict:
+    """
+    Run all benchmarks
+
+    :param lines: size of generated input
+    :param seed: generator seed
+    :param repeat: runs of each benchmark
+    :param expansions: number of expansions timed per construct
+    :param max_depth: max nesting timed by the depth benchmarks
+    :return: dict of results
+    """
+    generator = ConfigGenerator(seed=seed)
+    variables = generator.variables()
+    ini = generator.ini(lines)
+    full = ConfigGenerator(seed=seed).full(lines)
+    all_single_tokens = "".join(Tokenizer._SINGLE_CHARACTER_TOKENS.keys())
+
+    results = {
+        'reader.get': bench_reader(ini, repeat),
+        'tokens_are': bench_tokens_are(ini, variables, repeat),
+        'tokens_match': bench_tokens_match(ini, variables, repeat),
+    }
+    for engine in TokenEngine:
+        for whitespace in TokenWhitespace:
+            name = 'tokenizer.%s.%s' % (engine.name.lower(), whitespace.name.lower())
+            results[name + '.ini'] = bench_tokenizer(ini, variables, whitespace, "=", engine, repeat)
+            results[name + '.full'] = bench_tokenizer(full, variables, whitespace, all_single_tokens, engine, repeat)
+    constructs = {
+        'variable': '$VAR1',
+        'braces': '${VAR1}',
+        'modifier': '${VAR1:xml,sql}',
+        'default': '${UNSET|default}',
+        'nested_default': ConfigGenerator(seed=seed).default(4),
+        'math': '$( ${VAR1} * 1024 / ${VAR2} < 65536 )',
+        'nested_math': ConfigGenerator(seed=seed).math(4),
+    }
+    for (name, construct) in constructs.items():
+        results['expand.' + name] = bench_expansion(construct, variables, expansions, repeat)
+    for depth in (1, 8, 64):
+        results['math.get_value.%d' % depth] = bench_math(depth, expansions, repeat)
+    levels = 1000
+    while levels <= max_depth:
+        for kind in ('default', 'math', 'expansion', 'mixed'):
+            results['nesting.%s.%d' % (kind, levels)] = bench_nesting(kind, levels, repeat)
+        results['math.depth.%d' % levels] = bench_math_depth(levels, repeat)
+        levels = levels * 10
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'parameters': {'lines': lines, 'seed': seed, 'repeat': repeat, 'expansions': expansions, 'max_depth': max_depth,
+                       'ini_chars': len(ini), 'full_chars': len(full)},
+        'results': results,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the expanding tokenizer")
+    parser.add_argument('--lines', type=int, default=2000, help="lines of generated input")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the input generator")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark (best is reported)")
+    parser.add_argument('--expansions', type=int, default=2000, help="expansions timed per construct")
+    parser.add_argument('--depth', type=int, default=100000, help="max nesting timed by the depth benchmarks")
+    parser.add_argument('--output', default=None, help="file to write JSON to (default stdout)")
+    args = parser.parse_args(argv)
+    report = run_all(args.lines, args.seed, args.repeat, args.expansions, args.depth)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
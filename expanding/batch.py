@@ -0,0 +1,306 @@
+from io import StringIO
+from numbers import Integral
+from typing import TypeVar
+
+from expanding.math import MathTokenizer, MathType, MathExpr, MathTree, MathProgram
+from expanding.source import Reader, At
+from expanding.template import TemplateExpansion, TemplateMath, TemplateVariable, TemplateBracket
+from expanding.variable import EnvironmentVariable, Variable
+
+_str = TypeVar('_str', str, None)
+
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+_EXACT = 1 << 53  # Integers of up to this size are exact as float64
+
+
+def _numpy():
+    """
+    Import numpy, which is only needed for batch evaluation
+
+    :return: numpy module
+    :raises Exception: if numpy is not installed
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("Batch evaluation of math expressions requires numpy (pip install numpy)")
+    return numpy
+
+
+def _add(numpy, left, right):
+    value = numpy.add(left, right)
+    if numpy.any(((left ^ value) & (right ^ value)) < 0):  # Both operands differ in sign from the sum
+        return None
+    return value
+
+
+def _sub(numpy, left, right):
+    value = numpy.subtract(left, right)
+    if numpy.any(((left ^ right) & (left ^ value)) < 0):
+        return None
+    return value
+
+
+def _mul(numpy, left, right):
+    # The float product is close enough, to tell if the product is near the limit
+    if numpy.any(numpy.abs(numpy.multiply(left, right, dtype=numpy.float64)) >= float(1 << 62)):
+        return None
+    return numpy.multiply(left, right)
+
+
+def _div(numpy, left, right):
+    # int(l / r) divides as floats, which numpy only does the same way for exact operands
+    if numpy.any(right == 0) or numpy.any((left > _EXACT) | (left < -_EXACT) | (right > _EXACT) | (right < -_EXACT)):
+        return None
+    return numpy.trunc(numpy.true_divide(left, right)).astype(numpy.int64)
+
+
+def _mod(numpy, left, right):
+    if numpy.any(right == 0) or numpy.any((left == _INT64_MIN) & (right == -1)):
+        return None
+    return numpy.remainder(left, right)
+
+
+def _min(numpy, left, right):
+    return numpy.minimum(left, right)
+
+
+def _max(numpy, left, right):
+    return numpy.maximum(left, right)
+
+
+_VECTOR_OPERATIONS = {
+    MathExpr.FUNCTIONS[MathType.ADD]: _add,
+    MathExpr.FUNCTIONS[MathType.SUB]: _sub,
+    MathExpr.FUNCTIONS[MathType.MUL]: _mul,
+    MathExpr.FUNCTIONS[MathType.DIV]: _div,
+    MathExpr.FUNCTIONS[MathType.MOD]: _mod,
+    MathExpr.FUNCTIONS[MathType.MIN]: _min,
+    MathExpr.FUNCTIONS[MathType.MAX]: _max
+}
+
+
+def _run_vector(numpy, program: MathProgram, arrays: list, rows: int):
+    """
+    Run a program on int64 arrays
+
+    :return: int64 array or None if a value doesn't fit or an operation fails
+    """
+    stack = []
+    with numpy.errstate(all='ignore'):
+        for (kind, argument) in program.instructions():
+            if kind == MathProgram.CONSTANT:
+                if not _INT64_MIN <= argument <= _INT64_MAX:
+                    return None
+                stack.append(numpy.int64(argument))
+            elif kind == MathProgram.VARIABLE:
+                stack.append(arrays[argument])
+            else:
+                right = stack.pop()
+                value = _VECTOR_OPERATIONS[argument](numpy, stack[-1], right)
+                if value is None:
+                    return None
+                stack[-1] = value
+    return numpy.array(numpy.broadcast_to(stack[0], (rows,)), dtype=numpy.int64)
+
+
+def evaluate_batch(tree: TypeVar('_tree', MathTree, MathProgram), columns: list, rows: int = None):
+    """
+    Compute an expression for many sets of values
+
+    The rows are computed at once as numpy int64 arrays, with the integer
+    semantics of MathExpr.OPERATIONS. If a value doesn't fit, or an operation
+    would overflow (or divide by zero), the rows are computed one at a time
+    with Python ints instead; the values (or the error) are then those of
+    MathTree.get_value()
+
+    :param tree: expression (or compiled expression)
+    :param columns: for each MathVariable index, a sequence of integers (a value for each row)
+    :param rows: number of rows (defaults to the length of the columns)
+    :return: numpy array of values, dtype int64 (or object, if computed with Python ints)
+    :raises Exception: if numpy isn't installed or the columns are not integers of the same length
+    """
+    numpy = _numpy()
+    program = tree if isinstance(tree, MathProgram) else MathProgram(tree)
+    if rows is None:
+        rows = len(columns[0]) if columns else 1
+    arrays = []
+    for (index, column) in enumerate(columns):
+        array = numpy.asarray(column)
+        if array.ndim != 1 or len(array) != rows:
+            raise Exception("Column %d has %d values, expected %d" % (index, len(array), rows))
+        if array.size == 0:
+            array = array.astype(numpy.int64)
+        if array.dtype.kind == 'u' and numpy.any(array > _INT64_MAX):
+            array = array.astype(object)
+        if array.dtype.kind not in 'iuO':
+            raise Exception("Column %d is not integers" % index)
+        arrays.append(array)
+    if all(array.dtype.kind != 'O' for array in arrays):
+        result = _run_vector(numpy, program, [array.astype(numpy.int64) for array in arrays], rows)
+        if result is not None:
+            return result
+    for (index, array) in enumerate(arrays):
+        if array.dtype.kind == 'O' and not all(isinstance(value, Integral) for value in array):
+            raise Exception("Column %d is not integers" % index)
+    values = [[int(value) for value in array] for array in arrays]
+    return numpy.array([program.run([column[row] for column in values]) for row in range(rows)], dtype=object)
+
+
+class _RowVariable(Variable):
+    """
+    Resolver of the values of one row of a table
+    """
+
+    def __init__(self, table: dict, row: int):
+        self._table = table
+        self._row = row
+
+    def lookup_variable(self, name: str) -> _str:
+        column = self._table.get(name)
+        if column is None:
+            return None
+        value = column[self._row]
+        if value is None:
+            return None
+        return str(value)
+
+
+class MathBatch(object):
+    """
+A $() expression, computed for many sets of variable values at once
+
+The variable values are given as a table of columns (name to a sequence of
+values), and every row is computed at once, see evaluate_batch(). Variables
+are taken from the columns as integers, or as text that resolves to a number
+(as in Expansion); defaults and modifiers are rendered for each row.
+Requires numpy.
+    """
+
+    @staticmethod
+    def from_text(text: str, variable: Variable = EnvironmentVariable(), name: str = "<UNKNOWN>") -> \
+            TypeVar('MathBatch'):
+        """
+        Parse an expression
+
+        :param text: the expression, ie. "$(${MEM}*1024/${WORKERS} < 65536)"
+        :param variable: resolver, that reads variable names (values are not looked up)
+        :param name: name of source, for error messages
+        :return: new object
+        :raises Exception: if text is not one $() expression
+        """
+        reader = Reader(StringIO(text.strip()), name)
+        at = reader.position()
+        if reader.get() != '$':
+            raise Exception("Expected $( at: %s" % reader.locate(at))
+        node = TemplateExpansion(reader, variable).expand(at)
+        if not isinstance(node, TemplateMath):
+            raise Exception("Expected $( at: %s" % reader.locate(at))
+        if not reader.eof():
+            raise Exception("Unexpected text after expression at: %s" % reader.at())
+        return MathBatch(node, name)
+
+    def __init__(self, math: TemplateMath, name: str = "<UNKNOWN>"):
+        """
+        Construct from a parsed expression
+
+        :param math: parsed $() expression
+        :param name: name of source, for error messages
+        """
+        self._math = math
+        self._name = name
+
+    def names(self) -> list:
+        """
+        The variable names in the expression (in input order, each once)
+
+        :return: list of names
+        """
+        references = []
+        self._math.references(references)
+        names = []
+        for (at, name, modifiers, has_default) in references:
+            if name not in names:
+                names.append(name)
+        return names
+
+    def evaluate(self, table: dict, rows: int = None):
+        """
+        Compute the expression for each row of a table
+
+        :param table: dict of variable name to a sequence of values (integers or text)
+        :param rows: number of rows (defaults to the length of the columns)
+        :return: numpy array of values, see evaluate_batch()
+        :raises Exception: as Expansion, for the first value that fails
+        """
+        if rows is None:
+            rows = len(next(iter(table.values()))) if table else 1
+        for (name, column) in table.items():
+            if len(column) != rows:
+                raise Exception("Column %s has %d values, expected %d" % (name, len(column), rows))
+        columns = []
+        for (at, leaf) in self._math.leaves():
+            if isinstance(leaf, str):
+                raise Exception("%s is not a number at: %s" % (leaf, self._locate(at)))
+            column = None
+            name = self._column_name(leaf)
+            if name in table:
+                column = self._column(table[name])
+            if column is None:
+                column = self._rendered(leaf, table, rows, at)
+            columns.append(column)
+        return evaluate_batch(self._math.program(), columns, rows)
+
+    @staticmethod
+    def _column_name(leaf) -> _str:
+        """
+        The variable of a plain expansion ($NAME or ${NAME}), whose value can be taken from a column as is
+
+        :return: name or None if the expansion has defaults or modifiers
+        """
+        if not isinstance(leaf, (TemplateVariable, TemplateBracket)):
+            return None
+        references = []
+        leaf.references(references)
+        if len(references) != 1 or references[0][2] or references[0][3]:
+            return None
+        return references[0][1]
+
+    @staticmethod
+    def _column(column) -> TypeVar('_column', list, None):
+        """
+        The values of a column, as integers
+
+        :param column: sequence of integers or text
+        :return: column of integers or None if a value is not a number
+        """
+        if getattr(column, 'dtype', None) is not None and column.dtype.kind in 'iu':
+            return column
+        values = []
+        for value in column:
+            if isinstance(value, bool) or not isinstance(value, (Integral, str)):
+                return None
+            if isinstance(value, str):
+                value = MathTokenizer.as_signed_int(value)
+                if value is None:
+                    return None
+            values.append(int(value))
+        return values
+
+    def _rendered(self, leaf, table: dict, rows: int, at) -> list:
+        """
+        Render an expansion for each row
+
+        :return: list of integers
+        """
+        values = []
+        for row in range(rows):
+            value = MathTokenizer.as_signed_int(leaf.render(_RowVariable(table, row), self._locate))
+            if value is None:
+                raise Exception("Expansion at: %s does not resolve to a number" % self._locate(at))
+            values.append(value)
+        return values
+
+    def _locate(self, position) -> At:
+        return At.from_position(self._name, position)
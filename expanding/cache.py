@@ -0,0 +1,196 @@
+import hashlib
+import marshal
+import os
+import tempfile
+from typing import TypeVar, List
+
+from expanding.expand import Expansion
+from expanding.source import Reader
+from expanding.tokenizer import TokenArrays, TokenWhitespace, TokenEngine, Tokenizer
+from expanding.variable import EnvironmentVariable, Variable, hook
+
+_str = TypeVar('_str', str, None)
+
+
+class _RecordingVariable(Variable):
+    """
+    Resolver wrapper, that remembers the values looked up, and if the resolver failed
+    """
+
+    def __init__(self, variable: Variable):
+        self._variable = variable
+        self.values = {}
+        self.failed = False
+
+    def get_name(self, reader: Reader) -> _str:
+        return self._variable.get_name(reader)
+
+    def begin_parse(self) -> None:
+        hook(self._variable, 'begin_parse')()
+
+    def forget(self, names: List[str] = None) -> None:
+        hook(self._variable, 'forget')(names)
+
+    def name_syntax(self):
+        return hook(self._variable, 'name_syntax')()
+
+    def lookup_variable(self, name: str) -> _str:
+        try:
+            value = self._variable.lookup_variable(name)
+        except Exception:
+            self.failed = True
+            raise
+        self.values[name] = value
+        return value
+
+    def lookup_many(self, names: List[str]) -> dict:
+        try:
+            values = hook(self._variable, 'lookup_many')(names)
+        except Exception:
+            self.failed = True
+            raise
+        self.values.update(values)
+        return values
+
+
+class ParseCache(object):
+    """
+On-disk cache of token streams
+
+A file is identified by its path, modification time, size and content, and
+the tokenizer settings. An entry is the tokens of a parse of the file, keyed
+by the values of the variables that parse looked up; the same values give
+the same tokens. A Tokenizer from a cache hit replays the tokens (and the
+error, if the parse failed) without reading the file. A parse where the
+resolver itself raised (a service that is down) is not stored.
+
+Entries are written atomically, so the cache directory can be shared by
+many processes. Entries that cannot be read are treated as misses.
+    """
+    _VERSION = 2  # Change when the token stream or the format changes
+
+    def __init__(self, directory: str):
+        """
+        Use (and create) a cache directory
+
+        :param directory: where entries are stored
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def ini_from_file(self, filename: str, variable: Variable = EnvironmentVariable(),
+                      track_location: bool = True, max_depth: int = None) -> Tokenizer:
+        """
+        Cached Tokenizer.ini_from_file()
+
+        :param filename: path of file
+        :param variable: the variable expander
+        :param track_location: if token locations should be reported
+        :param max_depth: see Tokenizer
+        :return: tokenizer
+        """
+        return self.tokenizer(filename, variable, TokenWhitespace.NEWLINE, "=", track_location, max_depth)
+
+    def tokenizer(self, filename: str, variable: Variable = EnvironmentVariable(),
+                  whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                  single_tokens: str = "=",
+                  track_location: bool = True,
+                  max_depth: int = None) -> Tokenizer:
+        """
+        Tokenizer of a file, from the cache if possible
+
+        :param filename: path of file
+        :param variable: the variable expander
+        :param whitespace: see Tokenizer
+        :param single_tokens: see Tokenizer
+        :param track_location: if token locations should be reported
+        :param max_depth: see Tokenizer (it is part of the key, deeper nesting is an error)
+        :return: tokenizer
+        """
+        if max_depth is None:
+            max_depth = Expansion.MAX_DEPTH
+        identity = self._identity(filename, whitespace, single_tokens, track_location, max_depth)
+        hook(variable, 'begin_parse')()
+        index = self._load(identity + ".index")
+        if index is None:
+            index = []
+        for names in index:
+            try:
+                values = hook(variable, 'lookup_many')(names)
+            except Exception:
+                break  # The parse reports the error of the resolver, where it is met
+            entry = self._load(self._entry_name(identity, values))
+            if entry is not None:
+                self.hits += 1
+                return TokenArrays.load(filename, entry).tokenizer()
+        self.misses += 1
+        recorder = _RecordingVariable(variable)
+        reader = Reader.from_file(filename, track_location=track_location)
+        arrays = TokenArrays.from_tokenizer(Tokenizer(reader, recorder, whitespace, single_tokens, TokenEngine.REGEX,
+                                                      max_depth))
+        entry = arrays.dump()
+        if entry is not None and not recorder.failed:
+            names = sorted(recorder.values.keys())
+            if names not in index:
+                self._store(identity + ".index", index + [names])
+            self._store(self._entry_name(identity, recorder.values), entry)
+        return arrays.tokenizer()
+
+    def _identity(self, filename: str, whitespace: TokenWhitespace, single_tokens: str, track_location: bool,
+                  max_depth: int) -> str:
+        """
+        Key of a file and tokenizer settings
+
+        :return: hex digest
+        """
+        stat = os.stat(filename)
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(65536), b''):
+                digest.update(block)
+        key = (self._VERSION, os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, digest.digest(),
+               whitespace.name, "".join(sorted(single_tokens)), track_location, max_depth)
+        return hashlib.sha256(marshal.dumps(key)).hexdigest()
+
+    @staticmethod
+    def _entry_name(identity: str, values: dict) -> str:
+        """
+        Name of an entry
+
+        :param identity: key of the file
+        :param values: dict of variable name to value
+        :return: file name
+        """
+        fingerprint = hashlib.sha256(marshal.dumps(sorted(values.items(), key=lambda item: item[0])))
+        return "%s-%s.tokens" % (identity, fingerprint.hexdigest())
+
+    def _load(self, name: str) -> TypeVar('_entry', tuple, list, None):
+        """
+        Read a cache file
+
+        :param name: file name
+        :return: content or None if it cannot be read
+        """
+        try:
+            with open(os.path.join(self._directory, name), 'rb') as file:
+                return marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, name: str, content: TypeVar('_entry', tuple, list)) -> None:
+        """
+        Write a cache file atomically
+
+        :param name: file name
+        :param content: marshal-able content
+        """
+        (handle, path) = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                marshal.dump(content, file)
+            os.replace(path, os.path.join(self._directory, name))
+        except OSError:
+            if os.path.exists(path):
+                os.unlink(path)
@@ -7,15 +7,19 @@ tokenizer = Tokenizer.ini_from_file("config.ini")
 data = {}
 section = ""
 
+LINE = TokenGrammar(blank=(T.NEWLINE,),
+                    section=(T.SECTION, T.EOL),
+                    assign=(T.WORD, T.EQ, T.TEXT, T.EOL))
+
 while tokenizer.has_more():
     token = []
-    if tokenizer.tokens_are(T.NEWLINE):
-        pass
-    elif tokenizer.tokens_are(T.SECTION, T.EOL,
-                              output=token):
+    line = tokenizer.tokens_match(LINE, output=token)
+    if line is None:
+        unexpected = tokenizer.peek_token()
+        raise SyntaxError("Unexpected input: `%s' at: %s" % (unexpected.content(), unexpected.at()))
+    elif line[0] == 'section':
         section = token[0].content()
-    elif tokenizer.tokens_are(T.WORD, T.EQ, T.TEXT, T.EOL,
-                              output=token):
+    elif line[0] == 'assign':
         key = token[0].content()
         value = token[2].content()
         if section not in data:
@@ -23,8 +27,5 @@ while tokenizer.has_more():
         if key in data[section]:
             raise SyntaxError("In section `%s' variable `%s' is already set at: %s" % (section, key, token[0].at()))
         data[section][key] = value
-    else:
-        unexpected = tokenizer.peek_token()
-        raise SyntaxError("Unexpected input: `%s' at: %s" % (unexpected.content(), unexpected.at()))
 
 print(json.dumps(data, indent=4, sort_keys=True))
@@ -1,12 +1,14 @@
 import re
 import urllib
+from types import GeneratorType
 from typing import TypeVar
 from xml.sax import saxutils
 from io import StringIO
 
-from expanding.math import MathTokenizer, MathType, MathValue, MathExpr, MathTree
+from expanding.math import MathToken, MathTokenizer, MathType, MathValue, MathExpr, MathTree, MathVariable, \
+    MathProgram, MathCache
 from expanding.source import Reader, At
-from expanding.variable import EnvironmentVariable
+from expanding.variable import EnvironmentVariable, hook
 
 _str = TypeVar('_str', str, None)
 
@@ -19,6 +21,11 @@ Supports following expansions:
  * $VARIABLE
  * ${VARIABLE[:quote[,quote...][|default value]}
  * $( integer expression )
+
+${} and $() are expanded by generators, that yield the $-expansions nested in
+them, and are sent the expanded text. The generators are kept on an explicit
+stack (see _run()), so deep nesting isn't limited by recursion, but by
+max_depth; as is the nesting of parentheses in an expression.
 """
     DEFAULT_QUOTES = {
         'ms': lambda s, at: Expansion.to_milliseconds(s, at),
@@ -32,18 +39,23 @@ Supports following expansions:
     TO_MILLISECONDS_SCALE = {'': 1, 'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
     TO_SECONDS = re.compile('^([1-9][0-9]*)(|h|m|s)$', re.S)
     TO_SECONDS_SCALE = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    MAX_DEPTH = 10000  # Default max nesting of expansions (and of parentheses)
+    MATH_CACHE = MathCache()  # Compiled $() expressions, by name syntax of the variable and text
+    _MATH_TEXT = re.compile('(?:[^()\\n]|\\((?:[^()\\n]|\\([^()\\n]*\\))*\\))*\\)')  # Text up to the closing )
 
-    def __init__(self, reader, variable=EnvironmentVariable(), quotes=DEFAULT_QUOTES):
+    def __init__(self, reader, variable=EnvironmentVariable(), quotes=DEFAULT_QUOTES, max_depth=None):
         """
         Constructor with sane defaults
 
         :param reader: input source
         :param variable: Object that can read variable names from a reader, and resolve variables
         :param quotes: map of quotes @see add_quote()
+        :param max_depth: max nesting of expansions (and of parentheses), defaults to MAX_DEPTH
         """
         self._reader = reader
         self._variable = variable
         self.quotes = quotes
+        self.max_depth = self.MAX_DEPTH if max_depth is None else max_depth
 
     def add_quote(self, name, func) -> TypeVar('Expansion'):
         """
@@ -62,46 +74,88 @@ Supports following expansions:
 
         reader should be positioned after $
 
-        :param at: location if $ for error reporting
+        :param at: location if $ for error reporting (At or position)
         :param should_resolve: if it is required to resolve
         :return: expanded text
         """
+        value = self._begin(at, should_resolve)
+        if isinstance(value, GeneratorType):
+            return self._run(value)
+        return value
+
+    def _run(self, steps: GeneratorType):
+        """
+        Run the generator of an expansion, and those of the expansions nested in it
+
+        :param steps: generator, that yields tuples of (position, should resolve)
+                      of nested $-expansions and is sent their expanded text
+        :return: expanded text
+        :raises Exception: if the expansions are nested deeper than max_depth
+        """
+        stack = [steps]
+        value = None
+        while True:
+            try:
+                (at, should_resolve) = stack[-1].send(value)
+            except StopIteration as stop:
+                stack.pop()
+                if not stack:
+                    return stop.value
+                value = stop.value
+                continue
+            value = self._begin(at, should_resolve)
+            if isinstance(value, GeneratorType):
+                if len(stack) >= self.max_depth:
+                    raise Exception("Expansions nested deeper than %d levels at: %s" %
+                                    (self.max_depth, self._reader.locate(at)))
+                stack.append(value)
+                value = None
+
+    def _begin(self, at, should_resolve: bool):
+        """
+        Start expanding a $-expression, reader should be positioned after $
+
+        :param at: location if $ for error reporting (At or position)
+        :param should_resolve: if it is required to resolve
+        :return: expanded text, or a generator for ${} and $() (see _run())
+        """
         c = self._reader.get()
-        if c is '{':
+        if c == '{':
             return self._expand_variable(at, should_resolve)
-        if c is '(':
+        if c == '(':
             return self._expand_math(at, should_resolve)
-        self._reader.unget()
-        (name, value) = self._process_variable()
+        if c is not None:
+            self._reader.unget()
+        (name, value) = self._process_variable(should_resolve)
         if should_resolve:
             self._fail_variable(at, name, value)
         return value
 
-    def _process_variable(self) -> (_str, _str):
+    def _process_variable(self, should_resolve: bool) -> (_str, _str):
         """
         Read a variable form source
 
+        :param should_resolve: if the value is needed (otherwise it isn't looked up)
         :return:tuple of variable name and value
         """
         name = self._variable.get_name(self._reader)
         value = None
-        if name is not None:
+        if name is not None and should_resolve:
             value = self._variable.lookup_variable(name)
         return name, value
 
-    @staticmethod
-    def _fail_variable(at, name, value) -> None:
+    def _fail_variable(self, at, name, value) -> None:
         """
         Fail if variable cannot be resolved
 
-        :param at: location
+        :param at: location (At or position)
         :param name: tuple from _process_variable
         :param value: tuple from _process_variable
         """
         if name is None:
-            raise Exception("Cannot find variable name at: %s" % at)
+            raise Exception("Cannot find variable name at: %s" % self._reader.locate(at))
         if value is None:
-            raise Exception("Cannot resolve variable: %s at: %s" % (name, at))
+            raise Exception("Cannot resolve variable: %s at: %s" % (name, self._reader.locate(at)))
 
     @staticmethod
     def to_milliseconds(string, at) -> str:
@@ -133,22 +187,24 @@ Supports following expansions:
         ms_pr_unit = Expansion.TO_SECONDS_SCALE[match.group(2)]
         return str(int(match.group(1)) * ms_pr_unit)
 
-    def _expand_variable(self, at: At, should_resolve: bool) -> str:
+    def _expand_variable(self, at: TypeVar('_at', At, int), should_resolve: bool) -> str:
         """
         expand ${} construction
 
+        A generator, see _run()
+
         :param at: location of $
         :param should_resolve: if a result is required
         :return: expanded text
         """
-        (name, value) = self._process_variable()
-        at_after = self._reader.at()
+        (name, value) = self._process_variable(should_resolve)
+        at_after = self._reader.position()
         c = self._reader.get()
         quotes = []
-        if c is ':':
+        if c == ':':
             c = ','
-            while c is ',':
-                at_quote = self._reader.at()
+            while c == ',':
+                at_quote = self._reader.position()
                 quote = StringIO()
                 c = self._reader.get()
                 while str.isalnum(c):
@@ -156,20 +212,22 @@ Supports following expansions:
                     c = self._reader.get()
                 quote = quote.getvalue()
                 if quote not in self.quotes:
-                    raise Exception("Unknown quote: '%s' at: %s" % (quote, at_quote))
+                    raise Exception("Unknown quote: '%s' at: %s" % (quote, self._reader.locate(at_quote)))
                 quotes.append(quote)
 
-        if c is '|':
-            default_value = self._process_until_closing_bracket(should_resolve and value is None)
+        if c == '|':
+            default_value = yield from self._process_until_closing_bracket(should_resolve and value is None)
         else:
             if c is None:
-                raise Exception("Unexpected EOF in variable: %s at: %s" % (name, at))
-            if c is not '}':
-                raise Exception("Expected '}' in variable: %s at: %s got %s" % (name, at_after, c))
+                raise Exception("Unexpected EOF in variable: %s at: %s" % (name, self._reader.locate(at)))
+            if c != '}':
+                raise Exception("Expected '}' in variable: %s at: %s got %s" % (name, self._reader.locate(at_after), c))
             if should_resolve:
                 self._fail_variable(at, name, value)
         if should_resolve:
             if value is not None:
+                if quotes:
+                    at = self._reader.locate(at)
                 for quote in quotes:
                     value = self.quotes[quote](value, at)
                 return value
@@ -182,72 +240,234 @@ Supports following expansions:
         """
         Expand text (default value) up until closing bracket
 
+        A generator, see _run()
+
         :param should_resolve: if nested expansions should resolve
         :return: expanded content
         """
-        at = self._reader.at()
+        at = self._reader.position()
         content = StringIO()
         while True:
-            pos = self._reader.at()
+            pos = self._reader.position()
             c = self._reader.get()
-            if c is '}':
+            if c == '}':
                 return content.getvalue()
             if c is None:
-                raise Exception("Unexpected EOF in default value at %s" % at)
-            if c is '$':
-                c = self.expand(pos, should_resolve)
-            elif c is '\\':
+                raise Exception("Unexpected EOF in default value at %s" % self._reader.locate(at))
+            if c == '$':
+                c = yield pos, should_resolve
+            elif c == '\\':
                 c = self._reader.get_quoted()
             if c is not None:
                 content.write(c)
 
-    def _expand_math(self, at: At, should_resolve: bool) -> str:
+    def _expand_math(self, at: TypeVar('_at', At, int), should_resolve: bool) -> str:
         """
         expand $() construction
 
+        An expression on one line is compiled once (see MathProgram), and
+        cached by its text. When the text is seen again, only the expansions
+        in it are expanded. A generator, see _run()
+
         :param at: location of $
         :param should_resolve: if a result is required
         :return: expanded text
        """
-        self._tokenizer = MathTokenizer(at, self._reader, self, should_resolve)
-        tree = self._process_to_closing_parenthesis()
+        reader = self._reader
+        match = reader.match_ahead(self._MATH_TEXT)
+        key = None
+        if match is not None:
+            key = (hook(self._variable, 'name_syntax')(), match.group(0))
+            cached = self.MATH_CACHE.get(key)
+            if cached is not None and cached[3] <= self.max_depth:
+                return (yield from self._run_math(cached, should_resolve))
+        if not should_resolve:
+            yield from self._process_to_closing_parenthesis(MathTokenizer(at, reader, self, False))
+            return ""
+        first_line = reader.line_number()
+        tokenizer = _CompilingMathTokenizer(at, reader, self)
+        program = MathProgram((yield from self._process_to_closing_parenthesis(tokenizer)))
+        if key is not None and reader.line_number() == first_line and \
+                reader.column() - tokenizer.column == len(key[1]):
+            depth = self._math_depth(key[1], tokenizer.slots)
+            self.MATH_CACHE.put(key, (program, tokenizer.slots, len(key[1]), depth))
+        return str(program.run(tokenizer.values))
+
+    def _run_math(self, cached: tuple, should_resolve: bool) -> str:
+        """
+        expand a cached $() construction, reader is positioned after the (
+
+        A generator, see _run()
+
+        :param cached: tuple of (program, list of (start, end) offsets of the expansions, length of text,
+                       nesting of parentheses)
+        :param should_resolve: if a result is required
+        :return: expanded text
+        """
+        (program, slots, length, depth) = cached
+        reader = self._reader
+        offset = 0
+        values = []
+        for (start, end) in slots:
+            reader.skip(start - offset)
+            at = reader.position()
+            reader.get()
+            content = yield at, should_resolve
+            if should_resolve:
+                value = MathTokenizer.as_signed_int(content)
+                if value is None:
+                    raise Exception("Expansion at: %s does not resolve to a number" % reader.locate(at))
+                values.append(value)
+            offset = end
+        reader.skip(length - offset)
         if should_resolve:
-            return str(tree.get_value())
+            return str(program.run(values))
         else:
             return ""
 
-    def _process_to_closing_parenthesis(self) -> MathTree:
+    @staticmethod
+    def _math_depth(text: str, slots: list) -> int:
+        """
+        Nesting of parentheses in a $() expression, as checked against max_depth
+
+        :param text: the expression after the (, including the closing )
+        :param slots: list of (start, end) offsets of the expansions (they are checked when expanded)
+        :return: max number of enclosing groups
+        """
+        depth = 0
+        deepest = 0
+        offset = 0
+        for (start, end) in slots + [(len(text), len(text))]:
+            for c in text[offset:start]:
+                if c == '(':
+                    depth += 1
+                    deepest = max(deepest, depth)
+                elif c == ')':
+                    depth -= 1
+            offset = end
+        return deepest
+
+    def _math_leaf(self, value) -> MathTree:
+        """
+        Build a math tree leaf from the content of a number token
+
+        :param value: token content
+        :return: Math Tree
+        """
+        if isinstance(value, MathTree):
+            return value
+        return MathValue(value)
+
+    def _math_token(self, tokenizer: MathTokenizer) -> MathToken:
+        """
+        Read a math token, a $-expansion is expanded into a NUMBER token
+
+        A generator, see _run()
+
+        :param tokenizer: tokenizer of the expression
+        :return: token
+        """
+        token = tokenizer.raw_token()
+        if token.is_a(MathType.EXPANSION):
+            at = token.at()
+            content = yield at, tokenizer.should_resolve()
+            token = MathToken(at, MathType.NUMBER, tokenizer.expansion_value(at, content),
+                              tokenizer.expansion_text(at, content))
+        return token
+
+    def _process_to_closing_parenthesis(self, tokenizer: MathTokenizer) -> MathTree:
         """
         Build a math tree up until the matching closing parenthesis
+
+        A generator, see _run(). The enclosing groups of nested parentheses
+        are kept on a stack
+
+        :param tokenizer: tokenizer of the expression
         :return: Math Tree
+        :raises Exception: if parentheses are nested deeper than max_depth
         """
+        groups = []  # (operators, values, negate) of the enclosing groups
         operators = []
         values = []
         while True:
             neg = False
-            token = self._tokenizer.token()
+            token = yield from self._math_token(tokenizer)
             while token.is_a(MathType.SUB):
                 neg = not neg
-                token = self._tokenizer.token()
+                token = yield from self._math_token(tokenizer)
             if token.is_a(MathType.LPAR):
-                tree = self._process_to_closing_parenthesis()
-            elif token.is_a(MathType.NUMBER):
-                tree = MathValue(token.content())
+                if len(groups) >= self.max_depth:
+                    raise Exception("Parentheses nested deeper than %d levels at: %s" %
+                                    (self.max_depth, self._reader.locate(token.at())))
+                groups.append((operators, values, neg))
+                operators = []
+                values = []
+                continue
+            if token.is_a(MathType.NUMBER):
+                tree = self._math_leaf(token.content())
             else:
-                raise Exception("Unexpected token: %s at: %s" % (str(token.content()), token.at()))
-            if neg:
-                tree = MathExpr(MathType.SUB, MathValue(0), tree)
-            values.append(tree)
-            token = self._tokenizer.token()
-            precedence = token.precedence()
-            if precedence is None:
-                raise Exception(
-                    "Unexpected token: %s at: %s expected ')' or [operator]" % (str(token.content()), token.at()))
-            while operators and operators[-1].precedence() <= precedence:
-                right = values.pop()
-                left = values.pop()
-                operator = operators.pop()
-                values.append(MathExpr(operator.token_type(), left, right))
-            if token.is_a(MathType.RPAR):
-                return values.pop()
-            operators.append(token)
+                raise self._unexpected_token(tokenizer, token, "")
+            while True:
+                if neg:
+                    tree = MathExpr(MathType.SUB, MathValue(0), tree)
+                values.append(tree)
+                token = yield from self._math_token(tokenizer)
+                precedence = token.precedence()
+                if precedence is None:
+                    raise self._unexpected_token(tokenizer, token, " expected ')' or [operator]")
+                while operators and operators[-1].precedence() <= precedence:
+                    right = values.pop()
+                    left = values.pop()
+                    operator = operators.pop()
+                    values.append(MathExpr(operator.token_type(), left, right))
+                if not token.is_a(MathType.RPAR):
+                    operators.append(token)
+                    break
+                tree = values.pop()
+                if not groups:
+                    return tree
+                (operators, values, neg) = groups.pop()
+
+
+    def _unexpected_token(self, tokenizer: MathTokenizer, token: MathToken, expected: str) -> Exception:
+        """
+        Error for a token, that doesn't fit in the expression
+
+        :param tokenizer: tokenizer of the expression
+        :param token: the token
+        :param expected: what was expected instead, appended to the message
+        :return: exception to raise
+        """
+        return Exception("Unexpected token: %s at: %s%s" % (token.text(), self._reader.locate(token.at()), expected))
+
+
+class _CompilingMathTokenizer(MathTokenizer):
+    """
+    Math tokenizer, that makes a MathVariable of every expansion, and records
+    where the expansions are in the line
+    """
+
+    def __init__(self, at, reader: Reader, expansion: Expansion):
+        """
+        Construct a tokenizer
+
+        :param at: position of $
+        :param reader: input source, positioned after the (
+        :param expansion: expander of $-expansions
+        """
+        super().__init__(at, reader, expansion, True)
+        self.column = reader.column()  # The offsets are relative to this
+        self._start = None
+        self.values = []
+        self.slots = []
+
+    def raw_token(self) -> MathToken:
+        token = super().raw_token()
+        if token.is_a(MathType.EXPANSION):
+            self._start = self._reader.column() - self.column - 1
+        return token
+
+    def expansion_value(self, at, content) -> MathVariable:
+        self.values.append(super().expansion_value(at, content))
+        self.slots.append((self._start, self._reader.column() - self.column))
+        return MathVariable(len(self.values) - 1)
@@ -0,0 +1,591 @@
+import locale
+import marshal
+import mmap
+import os
+import re
+import tempfile
+from io import StringIO
+from typing import Iterable, Iterator, TypeVar, List
+
+from expanding.expand import Expansion
+from expanding.source import At, Reader
+from expanding.template import Template, TemplateNode, TemplateSyntaxError, TemplateTokenizer
+from expanding.tokenizer import Token, Tokenizer, TokenEngine, TokenGrammar, TokenType, TokenWhitespace
+from expanding.variable import EnvironmentVariable, Variable, hook
+
+
+class IniParser(object):
+    """
+Streaming parser for ini files
+
+Lines are [section] headers or key = value assignments, as in the example
+parser. Lines that are plain (no expansion, quotes or trailing comment) are
+split with a regular expression, everything else is tokenized by a Tokenizer
+on the same Reader, so the result is the same as tokenizing the whole file.
+    """
+    # Characters that may start / continue an unquoted TEXT token, when only = is a single token
+    _TEXT = '[^\\s=\\[$;#\'"][^\\s=\\[\\]$;#\'"]*'
+    _PLAIN_BLANK = re.compile('[^\\S\\n]*(?:[#;][^\\n]*)?\\n?', re.U)
+    _PLAIN_SECTION = re.compile('[^\\S\\n]*\\[([^\\]\\s]*)\\][^\\S\\n]*\\n?', re.U)
+    _PLAIN_ASSIGN = re.compile('[^\\S\\n]*(%s)[^\\S\\n]*=[^\\S\\n]*(%s)[^\\S\\n]*\\n?' % (_TEXT, _TEXT), re.U)
+    _LINE = TokenGrammar(blank=(TokenType.NEWLINE,),
+                         section=(TokenType.SECTION, TokenType.EOL),
+                         assign=(TokenType.WORD, TokenType.EQ, TokenType.TEXT, TokenType.EOL))
+
+    def __init__(self, reader: Reader, variable: Variable = None, max_depth: int = None):
+        """
+        Construct a parser
+
+        :param reader: the input
+        :param variable: the variable expander (defaults to Environment)
+        :param max_depth: max nesting of expansions, see Tokenizer
+        """
+        if variable is None:
+            variable = EnvironmentVariable()
+        self._reader = reader
+        self._tokenizer = Tokenizer(reader, variable, whitespace=TokenWhitespace.NEWLINE, single_tokens="=",
+                                    engine=TokenEngine.REGEX, max_depth=max_depth)
+
+    def events(self) -> Iterator[tuple]:
+        """
+        Generator of assignments
+
+        :return: iterator of (section, key, value, At of key)
+        :raises SyntaxError: if a line isn't a section header or an assignment
+        """
+        reader = self._reader
+        section = ""
+        # Every line shape ends with EOL, so the tokenizer never reads ahead of the line it has matched,
+        # and the reader is at the start of a line, whenever the loop comes around
+        while not reader.eof():
+            line = reader.rest_of_line()
+            match = self._PLAIN_ASSIGN.fullmatch(line)
+            if match is not None:
+                position = reader.position()
+                reader.skip_line()
+                if position is not None:
+                    position = position + match.start(1)
+                yield section, match.group(1), match.group(2), reader.locate(position)
+                continue
+            if self._PLAIN_BLANK.fullmatch(line) is not None:
+                reader.skip_line()
+                continue
+            match = self._PLAIN_SECTION.fullmatch(line)
+            if match is not None:
+                reader.skip_line()
+                section = match.group(1)
+                continue
+            tokens = []
+            found = self._tokenizer.tokens_match(self._LINE, output=tokens)
+            if found is None:
+                unexpected = self._tokenizer.peek_token()
+                raise SyntaxError("Unexpected input: `%s' at: %s" % (unexpected.content(), unexpected.at()))
+            if found[0] == 'section':
+                section = tokens[0].content()
+            elif found[0] == 'assign':
+                yield section, tokens[0].content(), tokens[2].content(), tokens[0].at()
+
+    def parse(self) -> dict:
+        """
+        Parse the input into a dict of sections
+
+        :return: dict of section name to dict of key to value
+        :raises SyntaxError: on invalid input or if a key is repeated in a section
+        """
+        data = {}
+        for (section, key, value, at) in self.events():
+            values = data.setdefault(section, {})
+            if key in values:
+                raise SyntaxError("In section `%s' variable `%s' is already set at: %s" % (section, key, at))
+            values[key] = value
+        return data
+
+
+def _reader(source: TypeVar('_source', str, Reader)) -> Reader:
+    """
+    Reader for a filename or a Reader
+
+    :param source: path of file or Reader
+    :return: Reader
+    """
+    if isinstance(source, Reader):
+        return source
+    return Reader.from_file(source)
+
+
+def ini_events(source: TypeVar('_source', str, Reader), variable: Variable = None,
+               max_depth: int = None) -> Iterator[tuple]:
+    """
+    Stream the assignments of an ini file
+
+    :param source: path of file or Reader
+    :param variable: the variable expander (defaults to Environment)
+    :param max_depth: max nesting of expansions, see Tokenizer
+    :return: iterator of (section, key, value, At of key)
+    :raises SyntaxError: on invalid input
+    """
+    return IniParser(_reader(source), variable, max_depth).events()
+
+
+def parse_ini(source: TypeVar('_source', str, Reader), variable: Variable = None, max_depth: int = None) -> dict:
+    """
+    Parse an ini file
+
+    :param source: path of file or Reader
+    :param variable: the variable expander (defaults to Environment)
+    :param max_depth: max nesting of expansions, see Tokenizer
+    :return: dict of section name to dict of key to value
+    :raises SyntaxError: on invalid input or if a key is repeated in a section
+    """
+    return IniParser(_reader(source), variable, max_depth).parse()
+
+
+class SectionIndex(object):
+    """
+Index of the [section] headers of an ini file
+
+The file is scanned without expanding variables: lines without expansions or
+quotes are matched with a regular expression, anything else is tokenized (by a
+tokenizer that doesn't resolve variables), so a [ inside a quote that spans
+lines is not taken for a header. The scan stops at the first error, the last
+section then runs to the end of the file, and the error is reported when that
+section is parsed.
+
+The index can be stored next to the file (filename.sections), it is rebuilt
+when the modification time or size of the file changes.
+    """
+    _VERSION = 2  # Change when the format (or what is a header) changes
+    _PLAIN = re.compile('[^$"\'\\n]*\\n?', re.U)
+    _HEADER = re.compile('[^\\S\\n]*\\[([^\\]\\s]*)\\][^\\S\\n]*(?:[#;][^\\n]*)?\\n?', re.U)
+
+    @staticmethod
+    def load(filename: str, cache: bool = False, max_depth: int = None) -> TypeVar('SectionIndex'):
+        """
+        Index of a file, from filename.sections if it is current
+
+        :param filename: path of a regular file
+        :param cache: if filename.sections should be used (and written)
+        :param max_depth: see build()
+        :return: index
+        """
+        stat = os.stat(filename)
+        if max_depth is None:
+            max_depth = Expansion.MAX_DEPTH
+        key = (SectionIndex._VERSION, stat.st_mtime_ns, stat.st_size, max_depth)
+        if cache:
+            try:
+                with open(filename + ".sections", 'rb') as file:
+                    (stored_key, headers) = marshal.load(file)
+                if tuple(stored_key) == key:
+                    return SectionIndex(filename, stat.st_size, headers)
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        index = SectionIndex.build(filename, max_depth)
+        if cache:
+            index._store(filename + ".sections", key)
+        return index
+
+    @staticmethod
+    def build(filename: str, max_depth: int = None) -> TypeVar('SectionIndex'):
+        """
+        Scan a file for section headers
+
+        :param filename: path of a regular file
+        :param max_depth: see Tokenizer (the scan stops at deeper nesting, the rest is in the last section)
+        :return: index
+        """
+        lines = []  # (name, line number) of the headers
+        reader = Reader.from_file(filename)
+        tokenizer = TemplateTokenizer(reader, EnvironmentVariable({}), TokenWhitespace.NEWLINE, "=",
+                                      TokenEngine.REGEX, max_depth)
+        tokens = tokenizer.tokens()
+        try:
+            while not reader.eof():
+                position = reader.position()
+                line = At.line_of(position)
+                if position == At.pack(line, 1) and SectionIndex._PLAIN.fullmatch(reader.rest_of_line()):
+                    match = SectionIndex._HEADER.fullmatch(reader.rest_of_line())
+                    if match is not None:
+                        lines.append((match.group(1), line))
+                    reader.skip_line()
+                    continue
+                token = next(tokens, None)
+                if token is None:
+                    break
+                if token.is_a(TokenType.SECTION) and position <= At.pack(token.at().line, 1):
+                    lines.append((token.content(), token.at().line))
+        except Exception:
+            pass  # The rest of the file is in the last section, where the error is reported
+        return SectionIndex(filename, os.path.getsize(filename), SectionIndex._offsets(filename, lines))
+
+    @staticmethod
+    def _offsets(filename: str, lines: list) -> list:
+        """
+        Find the byte offsets of header lines
+
+        :param filename: path of file
+        :param lines: (name, line number) in file order
+        :return: list of (name, line number, offset)
+        """
+        headers = []
+        if not lines:
+            return headers
+        with open(filename, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                (line, offset) = (1, 0)
+                for (name, header_line) in lines:
+                    while line < header_line:
+                        offset = content.find(b'\n', offset) + 1
+                        line += 1
+                    headers.append((name, line, offset))
+        return headers
+
+    def __init__(self, filename: str, size: int, headers: list):
+        """
+        Construct an index
+
+        :param filename: path of file
+        :param size: size of file in bytes
+        :param headers: list of (name, line number, byte offset) in file order
+        """
+        self._filename = filename
+        self._size = size
+        self._headers = [tuple(header) for header in headers]
+
+    def _store(self, path: str, key: tuple) -> None:
+        """
+        Write the index atomically, errors are ignored (the index is rebuilt next time)
+
+        :param path: where to store it
+        :param key: version, modification time and size of the file
+        """
+        try:
+            (handle, temp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                marshal.dump((key, self._headers), file)
+            os.replace(temp, path)
+        except OSError:
+            if os.path.exists(temp):
+                os.unlink(temp)
+
+    def sections(self) -> List[str]:
+        """
+        Names of the sections, in file order, without repeats
+
+        :return: list of names ("" if there's content before the first header)
+        """
+        names = [name for (name, line, offset) in self._headers]
+        if self.ranges(""):
+            names.insert(0, "")
+        return list(dict.fromkeys(names))
+
+    def ranges(self, name: str) -> List[tuple]:
+        """
+        Parts of the file, that belong to a section
+
+        :param name: section name ("" is the part before the first header)
+        :return: list of (first line number, start offset, end offset)
+        """
+        return [(line, start, end) for (part, line, start, end) in self.parts() if part == name]
+
+    def parts(self) -> List[tuple]:
+        """
+        The file split at the header lines
+
+        :return: list of (section name, first line number, start offset, end offset)
+                 in file order, empty parts are left out
+        """
+        bounds = [("", 1, 0)] + self._headers + [(None, None, self._size)]
+        return [(bounds[n][0], bounds[n][1], bounds[n][2], bounds[n + 1][2])
+                for n in range(len(bounds) - 1)
+                if bounds[n][2] < bounds[n + 1][2]]
+
+
+class LazyIni(object):
+    """
+Ini file, where sections are parsed when they are first accessed
+
+Only the header lines are found up front (see SectionIndex), a section is
+parsed from its byte range of the file (all of its ranges, if it is repeated),
+so errors in a section are only reported when it is accessed.
+    """
+
+    def __init__(self, filename: str, variable: Variable = None, cache_index: bool = False, encoding: str = None,
+                 max_depth: int = None):
+        """
+        Index an ini file
+
+        :param filename: path of a regular file
+        :param variable: the variable expander (defaults to Environment)
+        :param cache_index: if the index should be stored next to the file (the directory must be writable)
+        :param encoding: text encoding, defaults to the one open() would use
+        :param max_depth: see Tokenizer
+        """
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        self._filename = filename
+        self._variable = variable
+        self._encoding = encoding
+        self._max_depth = max_depth
+        self._index = SectionIndex.load(filename, cache_index, max_depth)
+        self._sections = {}
+
+    def sections(self) -> List[str]:
+        """
+        Names of the sections
+
+        :return: list of names, in file order
+        """
+        return self._index.sections()
+
+    def section(self, name: str) -> dict:
+        """
+        Parse a section (once)
+
+        :param name: section name
+        :return: dict of key to value
+        :raises KeyError: if there's no such section
+        :raises SyntaxError: on invalid input or if a key is repeated in the section
+        """
+        if name in self._sections:
+            return self._sections[name]
+        ranges = self._index.ranges(name)
+        if not ranges:
+            raise KeyError(name)
+        values = {}
+        with open(self._filename, 'rb') as file:
+            for (line, start, end) in ranges:
+                file.seek(start)
+                text = file.read(end - start).decode(self._encoding).replace('\r\n', '\n')
+                reader = Reader(StringIO(text), self._filename, first_line=line)
+                for (section, key, value, at) in IniParser(reader, self._variable, self._max_depth).events():
+                    if key in values:
+                        raise SyntaxError("In section `%s' variable `%s' is already set at: %s" % (section, key, at))
+                    values[key] = value
+        self._sections[name] = values
+        return values
+
+    def __getitem__(self, name: str) -> dict:
+        return self.section(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sections()
+
+
+class LiveIni(object):
+    """
+Ini file, that is re-evaluated when variables change
+
+The file is compiled once (see Template), and each value that comes from an
+expansion knows the variable names it depends on (also those in default
+values and math). When variables change, update() renders only the values
+that depend on them, and reports the entries that changed. Variables used in
+keys change the shape of the file, they make update() evaluate all values.
+
+The values are the same as those of parse_ini() with the same variables.
+    """
+
+    @staticmethod
+    def from_file(filename: str, variable: Variable = EnvironmentVariable(),
+                  track_location: bool = True, max_depth: int = None) -> TypeVar('LiveIni'):
+        """
+        Compile and evaluate a file
+
+        :param filename: path of file
+        :param variable: the variable expander
+        :param track_location: if locations should be reported
+        :param max_depth: see Tokenizer
+        :return: new object
+        """
+        return LiveIni(Reader.from_file(filename, track_location=track_location), variable, max_depth)
+
+    def __init__(self, reader: Reader, variable: Variable = EnvironmentVariable(), max_depth: int = None):
+        """
+        Compile and evaluate input
+
+        :param reader: the input
+        :param variable: the variable expander
+        :param max_depth: see Tokenizer
+        :raises SyntaxError: on invalid input or if a key is repeated in a section
+        """
+        self._source = reader.name()
+        self._steps = Template(reader, variable, TokenWhitespace.NEWLINE, "=", max_depth=max_depth).steps()
+        self._variable = variable
+        (self._data, self._nodes, self._structural) = self._evaluate(variable)
+        self._index()
+
+    def values(self) -> dict:
+        """
+        The current values
+
+        :return: dict of section name to dict of key to value
+        """
+        return self._data
+
+    def dependencies(self, section: str, key: str) -> set:
+        """
+        Variable names a value depends on
+
+        :param section: section name
+        :param key: key in section
+        :return: set of names (empty if the value has no expansions)
+        :raises KeyError: if there's no such entry
+        """
+        if key not in self._data.get(section, {}):
+            raise KeyError((section, key))
+        node = self._nodes.get((section, key))
+        if node is None:
+            return set()
+        return self._names(node)
+
+    def update(self, names: Iterable[str], variable: Variable = None) -> List[tuple]:
+        """
+        Re-evaluate the values, that depend on changed variables
+
+        The resolver is told to forget the names first (see Variable.forget()),
+        so memoizing and caching resolvers look them up again.
+        If an expansion cannot be resolved, the exception is raised and the
+        values are left as they were
+
+        :param names: names of the variables, that changed
+        :param variable: new variable expander (None keeps the current, it should return the new values)
+        :return: list of (section, key) of the entries that changed, were added or were removed, in input order
+        :raises Exception: if an expansion cannot be resolved
+        """
+        if variable is None:
+            variable = self._variable
+        names = set(names)
+        hook(variable, 'forget')(sorted(names))
+        if names & self._structural:
+            (data, nodes, structural) = self._evaluate(variable)
+            changed = self._changes(data, nodes)
+            (self._data, self._nodes, self._structural) = (data, nodes, structural)
+            self._variable = variable
+            self._index()
+            return changed
+        hook(variable, 'begin_parse')()
+        affected = set()
+        for name in names:
+            affected.update(self._dependents.get(name, ()))
+        rendered = []
+        for entry in sorted(affected, key=self._order.get):
+            value = self._nodes[entry].render(variable, self._locate)
+            if value != self._data[entry[0]][entry[1]]:
+                rendered.append((entry, value))
+        for ((section, key), value) in rendered:
+            self._data[section][key] = value
+        self._variable = variable
+        return [entry for (entry, value) in rendered]
+
+    def _changes(self, data: dict, nodes: dict) -> List[tuple]:
+        """
+        Entries that differ between the current and a new evaluation
+
+        Removed entries are placed by their old position, before entries
+        added at the same place
+
+        :param data: the new values
+        :param nodes: the new entries in input order
+        :return: list of (section, key) in input order
+        """
+        changed = []
+        removed = [entry for entry in self._nodes if entry not in nodes]
+        added = []
+        for entry in nodes:
+            if entry not in self._order:
+                added.append(entry)
+                continue
+            while removed and self._order[removed[0]] < self._order[entry]:
+                changed.append(removed.pop(0))
+            changed += added
+            added = []
+            if self._get(self._data, entry) != self._get(data, entry):
+                changed.append(entry)
+        return changed + removed + added
+
+    @staticmethod
+    def _get(data: dict, entry: tuple) -> TypeVar('_str', str, None):
+        return data.get(entry[0], {}).get(entry[1])
+
+    @staticmethod
+    def _names(node: TemplateNode) -> set:
+        found = []
+        node.references(found)
+        return set(reference[1] for reference in found)
+
+    def _index(self) -> None:
+        """
+        Map variable names to the entries that depend on them
+        """
+        self._order = {}
+        self._dependents = {}
+        for entry in self._nodes:
+            self._order[entry] = len(self._order)
+            node = self._nodes[entry]
+            if node is not None:
+                for name in self._names(node):
+                    self._dependents.setdefault(name, set()).add(entry)
+
+    def _evaluate(self, variable: Variable) -> tuple:
+        """
+        Render all of the input, and parse it as an ini file
+
+        :param variable: resolver for variable values
+        :return: tuple of (dict of section name to dict of key to value,
+                           dict of (section, key) to TemplateNode of the value or None in input order,
+                           set of the names used in expansions that aren't values)
+        :raises SyntaxError: on invalid input or if a key is repeated in a section
+        """
+        hook(variable, 'begin_parse')()
+        value_nodes = {}
+        structural = set()
+        tokenizer = Tokenizer.from_tokens(self._render(variable, value_nodes), self._source)
+        data = {}
+        nodes = {}
+        section = ""
+        while not tokenizer.peek_token().is_a(TokenType.EOF):
+            tokens = []
+            found = tokenizer.tokens_match(IniParser._LINE, output=tokens)
+            if found is None:
+                unexpected = tokenizer.peek_token()
+                raise SyntaxError("Unexpected input: `%s' at: %s" % (unexpected.content(), unexpected.at()))
+            if found[0] == 'section':
+                section = tokens[0].content()
+            elif found[0] == 'assign':
+                (key, value) = (tokens[0], tokens[2])
+                values = data.setdefault(section, {})
+                if key.content() in values:
+                    raise SyntaxError("In section `%s' variable `%s' is already set at: %s" %
+                                      (section, key.content(), key.at()))
+                values[key.content()] = value.content()
+                nodes[(section, key.content())] = value_nodes.pop(value, None)
+        for node in value_nodes.values():
+            structural.update(self._names(node))
+        return data, nodes, structural
+
+    def _render(self, variable: Variable, value_nodes: dict) -> Iterator[Token]:
+        """
+        Generator of rendered tokens, see Template
+
+        :param variable: resolver for variable values
+        :param value_nodes: filled with the tokens rendered from a TemplateNode, and that node
+        :return: token iterator, ending with EOF
+        """
+        source = self._source
+        for (at, token_type, content) in self._steps:
+            if token_type is None:
+                if isinstance(content, TemplateSyntaxError):
+                    content = content.rendered(variable, self._locate)
+                raise content.with_traceback(None)
+            if isinstance(content, TemplateNode):
+                token = Token(at, token_type, content.render(variable, self._locate), source)
+                value_nodes[token] = content
+            else:
+                token = Token(at, token_type, content, source)
+            yield token
+
+    def _locate(self, position: TypeVar('_at', int, None)) -> At:
+        return At.from_position(self._source, position)
@@ -1,5 +1,7 @@
+import operator
 import re
-from io import StringIO
+import threading
+from collections import OrderedDict
 from enum import Enum
 from typing import TypeVar
 
@@ -17,6 +19,7 @@ class MathType(Enum):
     MIN = 'MIN'
     MAX = 'MAX'
     NUMBER = 'NUMBER'
+    EXPANSION = 'EXPANSION'  # $-expansion, see MathTokenizer.raw_token()
     OPERATOR = 'OPERATOR'
 
 
@@ -34,24 +37,42 @@ class MathToken(object):
                   MathType.MUL, MathType.DIV, MathType.MOD,
                   MathType.ADD, MathType.SUB}
 
-    def __init__(self, at, token_type, content):
+    def __init__(self, at, token_type, content, text=None):
         """
         Build a token
 
         :param at: location of token start
         :param token_type: type (operator or value)
         :param content: content (only needed for value type)
+        :param text: text of the token for error messages (or an object that str() turns into the text,
+                     so it is only built if reported), defaults to the content
         """
         self._at = at
         self._token_type = token_type
         self._content = content
+        self._text = text
 
-    def at(self) -> str:
+    def at(self) -> TypeVar('_at', int, None):
+        """
+        Location of the token
+
+        :return: position, see Reader.locate()
+        """
         return self._at
 
     def content(self):
         return self._content
 
+    def text(self) -> str:
+        """
+        Text of the token, as reported in error messages
+
+        :return: the source text or expanded value (content is a MathVariable for compiled expansions)
+        """
+        if self._text is None:
+            return str(self._content)
+        return str(self._text)
+
     def is_a(self, wanted_type) -> bool:
         """
         Type matching
@@ -101,12 +122,15 @@ class MathTokenizer(object):
     }
 
     _IS_NUMBER = re.compile('^(?:(?:[-+]?)(0[xX][0-9a-fA-F]+)|([1-9][0-9]*)|(0[0-7]*))$', re.S | re.U)
+    # Whitespace between digits is skipped, also newlines (trailing whitespace continues the run on the next line)
+    _ALNUM_RUN = re.compile('[^\\W_]*(?:\\s+[^\\W_]+)*(?:\\s+\\Z)?', re.U)
+    _SPACE = re.compile('\\s*', re.U)
 
     def __init__(self, at, reader: Reader, expansion: TypeVar('Expansion'), should_resolve: bool):
         """
         Construct a tokenizer for input source consuming
 
-        :param at: where the math expression starts
+        :param at: where the math expression starts (At or position)
         :param reader: source of input
         :param expansion: variable expansion class
         :param should_resolve: are variables required to resolve
@@ -116,42 +140,88 @@ class MathTokenizer(object):
         self._expansion = expansion
         self._should_resolve = should_resolve
 
-    def token(self):
+    def should_resolve(self) -> bool:
+        return self._should_resolve
+
+    def token(self) -> MathToken:
+        """
+        Read a token, $-expansions are expanded into NUMBER tokens
+
+        :return: token
+        """
+        token = self.raw_token()
+        if token.is_a(MathType.EXPANSION):
+            at = token.at()
+            content = self._expansion.expand(at, self._should_resolve)
+            return MathToken(at, MathType.NUMBER, self.expansion_value(at, content), self.expansion_text(at, content))
+        return token
+
+    def raw_token(self) -> MathToken:
+        """
+        Read a token, a $-expansion gives an EXPANSION token
+
+        The reader is then positioned after the $, and the caller expands it
+        (see expansion_value())
+
+        :return: token
+        """
         (c, at) = self._get()
         if c in self._SINGLE_CHAR_TOKENS:
             return MathToken(at, self._SINGLE_CHAR_TOKENS[c], c)
         if str.isalnum(c):
-            content = StringIO()
-            content.write(c)
-            while True:
-                (c, _) = self._get()
-                if str.isalnum(c):
-                    content.write(c)
-                else:
-                    self._reader.unget()
-                    if self._should_resolve:
-                        value = self._as_int(content.getvalue())
-                        if value is None:
-                            raise Exception("%s is not a number at: %s" % (content.getvalue(), at))
-                    else:
-                        value = None
-                    return MathToken(at, MathType.NUMBER, value)
-        if c is '$':
-            content = self._expansion.expand(at, self._should_resolve)
-            if self._should_resolve:
-                neg = False
-                while content and content[0] is '-':
-                    neg = not neg
-                    content = content[1:]
-                value = self._as_int(content)
-                if neg:
-                    value = -value
-                if value is None:
-                    raise Exception("Expansion at: %s does not resolve to a number" % at)
-            else:
-                value = None
-            return MathToken(at, MathType.NUMBER, value)
-        raise Exception("Unexpected character: %s in expression at: %s" % (c, at))
+            content = c + self._reader.read_while(self._ALNUM_RUN)
+            if self._reader.eof():
+                raise Exception("Unexpected EOF in expression at: %s" % self._reader.locate(self._at))
+            if not content.isalnum():
+                content = "".join(content.split())  # whitespace between digits is skipped
+            value = self._literal(at, content)
+            # Errors report the value of a literal (2 for 02), unless it is left to a variable (see template)
+            return MathToken(at, MathType.NUMBER, value, content if isinstance(value, MathTree) else None)
+        if c == '$':
+            return MathToken(at, MathType.EXPANSION, None)
+        raise Exception("Unexpected character: %s in expression at: %s" % (c, self._reader.locate(at)))
+
+    def _literal(self, at, content):
+        """
+        Value of a literal number
+
+        :param at: position of the literal
+        :param content: the literal
+        :return: integer value or None if values are not resolved
+        :raises Exception: if the literal is not a number
+        """
+        if not self._should_resolve:
+            return None
+        value = self.as_int(content)
+        if value is None:
+            raise Exception("%s is not a number at: %s" % (content, self._reader.locate(at)))
+        return value
+
+    def expansion_value(self, at, content):
+        """
+        Value of a $-expansion
+
+        :param at: position of the $
+        :param content: the expanded text
+        :return: integer value or None if values are not resolved
+        :raises Exception: if the expansion does not resolve to a number
+        """
+        if not self._should_resolve:
+            return None
+        value = self.as_signed_int(content)
+        if value is None:
+            raise Exception("Expansion at: %s does not resolve to a number" % self._reader.locate(at))
+        return value
+
+    def expansion_text(self, at, content) -> str:
+        """
+        Text of a $-expansion, for error messages
+
+        :param at: position of the $
+        :param content: the expanded text
+        :return: the expanded text
+        """
+        return content
 
     def _get(self) -> str:
         """
@@ -160,25 +230,24 @@ class MathTokenizer(object):
         :return: character
         :raises: Exception of EOF is encountered
         """
-        while True:
-            at = self._reader.at()
-            c = self._reader.get()
-            if c is None:
-                raise Exception("Unexpected EOF in expression at: %s" % self._at)
-            if str.isspace(c):
-                continue
-            return c, at
-
-    def _as_int(self, content) -> int:
+        self._reader.read_while(self._SPACE)
+        at = self._reader.position()
+        c = self._reader.get()
+        if c is None:
+            raise Exception("Unexpected EOF in expression at: %s" % self._reader.locate(self._at))
+        return c, at
+
+    @staticmethod
+    def as_int(content) -> TypeVar('_int', int, None):
         """
         converts value int integer
 
         knows about negative numbers, octal, decimal or hexadecimal numbers
 
         :param content: text containing number
-        :return: the integer value
+        :return: the integer value or None if it isn't a number
         """
-        match = self._IS_NUMBER.match(content)
+        match = MathTokenizer._IS_NUMBER.match(content)
         if match is None:
             return None
         if match.group(1) is not None:
@@ -188,20 +257,57 @@ class MathTokenizer(object):
         if match.group(3) is not None:
             return int(content, 8)
 
+    @staticmethod
+    def as_signed_int(content) -> TypeVar('_int', int, None):
+        """
+        converts expanded text into integer
+
+        any number of leading - are allowed
+
+        :param content: expanded text
+        :return: the integer value or None if it isn't a number
+        """
+        neg = False
+        while content and content[0] == '-':
+            neg = not neg
+            content = content[1:]
+        value = MathTokenizer.as_int(content)
+        if neg and value is not None:
+            value = -value
+        return value
+
+
+_CONSTANT = 0  # Instructions of a MathProgram
+_VARIABLE = 1
+_OPERATOR = 2
+
+
+def _divide(left: int, right: int) -> int:
+    return int(left / right)
+
 
 class MathTree(object):
     """
     Interface type for mathematical expressions
     """
 
-    def get_value(self) -> int:
+    def get_value(self, values: list = None) -> int:
         """
         The value this tree node represents
 
+        :param values: values of MathVariable leaves
         :return: integer value
         """
         raise NotImplemented()
 
+    def compile(self, code: list) -> None:
+        """
+        Add the postfix instructions computing this node, see MathProgram
+
+        :param code: list of instructions
+        """
+        raise NotImplementedError()
+
 
 class MathValue(MathTree):
     """
@@ -211,13 +317,35 @@ class MathValue(MathTree):
     def __init__(self, value):
         self._value = value
 
-    def get_value(self) -> int:
+    def get_value(self, values: list = None) -> int:
         return self._value
 
+    def compile(self, code: list) -> None:
+        code.append((_CONSTANT, self._value))
+
     def __str__(self):
         return "{%d}" % self._value
 
 
+class MathVariable(MathTree):
+    """
+    MathTree object, that takes its value from a list of values, for trees that
+    are evaluated many times with different input (see template)
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def get_value(self, values: list = None) -> int:
+        return values[self._index]
+
+    def compile(self, code: list) -> None:
+        code.append((_VARIABLE, self._index))
+
+    def __str__(self):
+        return "{$%d}" % self._index
+
+
 class MathExpr(MathTree):
     """
     MathTree object, that computes a value (binary operator)
@@ -232,6 +360,15 @@ class MathExpr(MathTree):
         MathType.MIN: lambda l, r: min(l, r),
         MathType.MAX: lambda l, r: max(l, r)
     }
+    FUNCTIONS = {
+        MathType.ADD: operator.add,
+        MathType.SUB: operator.sub,
+        MathType.MUL: operator.mul,
+        MathType.DIV: _divide,
+        MathType.MOD: operator.mod,
+        MathType.MIN: min,
+        MathType.MAX: max
+    }
 
     def __init__(self, op, left, right):
         """
@@ -244,16 +381,168 @@ class MathExpr(MathTree):
         self._op = op
         self._left = left
         self._right = right
+        self._program = None
 
-    def get_value(self):
+    def get_value(self, values: list = None):
         """
         Compute value
 
+        The tree is compiled (see MathProgram) when it is first computed, so
+        the depth isn't limited by recursion
+
+        :param values: values of MathVariable leaves
         :return: computed value
         """
-        left = self._left.get_value()
-        right = self._right.get_value()
-        return self.OPERATIONS[self._op](left, right)
+        if self._program is None:
+            self._program = MathProgram(self)
+        return self._program.run(values)
+
+    def compile(self, code: list) -> None:
+        """
+        Add the instructions of the operands and the operator
+
+        If both operands are constants, the value is computed now, unless that
+        fails (the error is then raised when the program is run). The tree is
+        walked with an explicit stack, so the depth isn't limited by recursion
+
+        :param code: list of instructions
+        """
+        stack = [(self, False)]
+        while stack:
+            (node, operands_done) = stack.pop()
+            if operands_done:
+                node._add_operator(code)
+            elif isinstance(node, MathExpr):
+                stack.append((node, True))
+                stack.append((node._right, False))
+                stack.append((node._left, False))
+            else:
+                node.compile(code)
+
+    def _add_operator(self, code: list) -> None:
+        """
+        Add the operator, after the instructions of the operands
+
+        :param code: list of instructions
+        """
+        function = self.FUNCTIONS[self._op]
+        if len(code) >= 2 and code[-2][0] == _CONSTANT and code[-1][0] == _CONSTANT:  # The operands are constants
+            try:
+                code[-2:] = [(_CONSTANT, function(code[-2][1], code[-1][1]))]
+                return
+            except Exception:
+                pass
+        code.append((_OPERATOR, function))
 
     def __str__(self):
         return "{%s,%s,%s}" % (self._left, self._op, self._right)
+
+
+class MathProgram(object):
+    """
+    Compiled math expression
+
+    The tree is flattened into postfix instructions, that are run by a loop
+    over a stack of values. Constant subtrees are computed when compiling.
+    The result (and errors) are those of MathTree.get_value()
+    """
+    __slots__ = ('_code', '_constant')
+    CONSTANT = _CONSTANT  # Kinds of instructions
+    VARIABLE = _VARIABLE
+    OPERATOR = _OPERATOR
+
+    def __init__(self, tree: MathTree):
+        """
+        Compile an expression
+
+        :param tree: expression
+        """
+        code = []
+        tree.compile(code)
+        self._code = code
+        self._constant = len(code) == 1 and code[0][0] == _CONSTANT
+
+    def run(self, values: list = None) -> int:
+        """
+        Compute the value
+
+        :param values: values of MathVariable leaves
+        :return: computed value
+        """
+        code = self._code
+        if self._constant:
+            return code[0][1]
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for (kind, argument) in code:
+            if kind == _CONSTANT:
+                push(argument)
+            elif kind == _VARIABLE:
+                push(values[argument])
+            else:
+                right = pop()
+                stack[-1] = argument(stack[-1], right)
+        return stack[0]
+
+    def instructions(self) -> list:
+        """
+        The postfix instructions
+
+        :return: list of (CONSTANT, value), (VARIABLE, index) and (OPERATOR, function of MathExpr.FUNCTIONS)
+        """
+        return self._code
+
+    def __len__(self):
+        return len(self._code)
+
+
+class MathCache(object):
+    """
+    Cache of compiled expressions
+
+    Keeps up to max_size entries (least recently used are dropped), it is
+    thread-safe, so it can be shared by all expansions
+    """
+
+    def __init__(self, max_size: int = 16384):
+        """
+        Construct a cache
+
+        :param max_size: max number of entries
+        """
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key) -> TypeVar('_entry', tuple, None):
+        """
+        Take an entry
+
+        :param key: key of entry
+        :return: entry or None if it isn't cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry: tuple) -> None:
+        """
+        Cache an entry
+
+        :param key: key of entry
+        :param entry: the entry
+        """
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,206 @@
+import locale
+import os
+import pickle
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from io import StringIO
+from typing import List
+
+from expanding.ini import SectionIndex, parse_ini
+from expanding.source import Reader
+from expanding.tokenizer import TokenArrays, TokenWhitespace, TokenEngine, Tokenizer
+from expanding.variable import EnvironmentVariable, Variable
+
+
+def _picklable(error: Exception) -> Exception:
+    """
+    Make sure an exception can be sent back from a worker
+
+    :param error: the exception
+    :return: the exception or an Exception with the same message
+    """
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return Exception(str(error))
+
+
+def _tokenize_file(path: str, whitespace: TokenWhitespace, single_tokens: str, variable: Variable,
+                   track_location: bool, max_depth: int) -> TokenArrays:
+    """
+    Worker: tokenize one file
+
+    :return: the tokens, with the error (if any)
+    """
+    if variable is None:
+        variable = EnvironmentVariable()
+    try:
+        reader = Reader.from_file(path, track_location=track_location)
+    except Exception as e:
+        return TokenArrays(path, b'', [], [], e)
+    return TokenArrays.from_tokenizer(Tokenizer(reader, variable, whitespace, single_tokens, TokenEngine.REGEX,
+                                                max_depth))
+
+
+def _tokenize_range(part: tuple, path: str, encoding: str, whitespace: TokenWhitespace, single_tokens: str,
+                    variable: Variable, track_location: bool, max_depth: int) -> TokenArrays:
+    """
+    Worker: tokenize a part of a file
+
+    :param part: tuple of (first line number, start offset, end offset)
+    :return: the tokens, with the error (if any)
+    """
+    if variable is None:
+        variable = EnvironmentVariable()
+    (line, start, end) = part
+    try:
+        with open(path, 'rb') as file:
+            file.seek(start)
+            text = file.read(end - start).decode(encoding).replace('\r\n', '\n')
+    except Exception as e:
+        return TokenArrays(path, b'', [], [], e)
+    reader = Reader(StringIO(text), path, first_line=line)  # Locations are needed to join the chunks
+    arrays = TokenArrays.from_tokenizer(Tokenizer(reader, variable, whitespace, single_tokens, TokenEngine.REGEX,
+                                                  max_depth))
+    if not track_location and arrays.error() is not None:
+        # The message of an untracked error has no location
+        reader = Reader(StringIO(text), path, track_location=False)
+        error = TokenArrays.from_tokenizer(Tokenizer(reader, variable, whitespace, single_tokens,
+                                                     TokenEngine.REGEX, max_depth)).error()
+        arrays = arrays.with_error(error)
+    return arrays
+
+
+def _parse_ini_file(path: str, variable: Variable, max_depth: int) -> tuple:
+    """
+    Worker: parse one ini file
+
+    :return: tuple of (dict or None, exception or None)
+    """
+    if variable is None:
+        variable = EnvironmentVariable()
+    try:
+        return parse_ini(path, variable, max_depth), None
+    except Exception as e:
+        return None, _picklable(e)
+
+
+def _map(function, items: list, max_workers: int, executor: Executor) -> list:
+    """
+    Run a worker for each item, in a process pool
+
+    Few items (or one worker) are processed in this process
+
+    :param function: worker taking an item
+    :param items: inputs (paths or chunks)
+    :param max_workers: size of pool (None is number of cpus)
+    :param executor: pool to use instead of a new one
+    :return: results in input order
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if executor is None and (len(items) < 2 or max_workers == 1):
+        return [function(item) for item in items]
+    chunksize = max(1, len(items) // (max_workers * 4))  # A few chunks per worker, to even out the load
+    if executor is not None:
+        return list(executor.map(function, items, chunksize=chunksize))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(function, items, chunksize=chunksize))
+
+
+def tokenize_many(paths: List[str], whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                  single_tokens: str = "=", variable: Variable = None, track_location: bool = True,
+                  max_workers: int = None, executor: Executor = None, max_depth: int = None) -> List[TokenArrays]:
+    """
+    Tokenize files in a process pool
+
+    An error in a file is kept in its result (see TokenArrays.error()), and
+    raised when its tokens are replayed
+
+    :param paths: input files
+    :param whitespace: see Tokenizer
+    :param single_tokens: see Tokenizer
+    :param variable: the variable expander, it is sent to the workers so it
+                     should be picklable (None is the environment of the workers)
+    :param track_location: if token locations should be reported
+    :param max_workers: size of pool (None is number of cpus)
+    :param executor: pool to use instead of a new one
+    :param max_depth: see Tokenizer
+    :return: tokens of each file, in input order
+    """
+    worker = partial(_tokenize_file, whitespace=whitespace, single_tokens=single_tokens, variable=variable,
+                     track_location=track_location, max_depth=max_depth)
+    return _map(worker, list(paths), max_workers, executor)
+
+
+def parse_ini_many(paths: List[str], variable: Variable = None,
+                   max_workers: int = None, executor: Executor = None, max_depth: int = None) -> List[tuple]:
+    """
+    Parse ini files in a process pool, see parse_ini()
+
+    :param paths: input files
+    :param variable: the variable expander, it is sent to the workers so it
+                     should be picklable (None is the environment of the workers)
+    :param max_workers: size of pool (None is number of cpus)
+    :param executor: pool to use instead of a new one
+    :param max_depth: see Tokenizer
+    :return: tuples of (dict or None, exception or None), in input order
+    """
+    worker = partial(_parse_ini_file, variable=variable, max_depth=max_depth)
+    return _map(worker, list(paths), max_workers, executor)
+
+
+def tokenize_chunks(path: str, whitespace: TokenWhitespace = TokenWhitespace.NEWLINE, single_tokens: str = "=",
+                    variable: Variable = None, track_location: bool = True, chunk_size: int = None,
+                    max_workers: int = None, executor: Executor = None, cache_index: bool = False,
+                    encoding: str = None, max_depth: int = None) -> TokenArrays:
+    """
+    Tokenize one large file in a process pool
+
+    The file is split at [section] header lines (see SectionIndex), no quote,
+    comment or expansion crosses those. The chunks are tokenized in parallel,
+    with the line numbers of the file, and joined. The result is the same as
+    that of a Tokenizer on the whole file, including the error (if any).
+
+    Single tokens that change how quotes, comments, sections or expansions
+    are read ([ ; " ' $ \\) make the header scan unreliable, the file is then
+    tokenized as one chunk.
+
+    :param path: input file (a regular file)
+    :param whitespace: see Tokenizer
+    :param single_tokens: see Tokenizer
+    :param variable: the variable expander, it is sent to the workers so it
+                     should be picklable (None is the environment of the workers)
+    :param track_location: if token locations should be reported
+    :param chunk_size: minimum number of bytes in a chunk (None is a few chunks per worker)
+    :param max_workers: size of pool (None is number of cpus)
+    :param executor: pool to use instead of a new one
+    :param cache_index: if the section index should be stored next to the file
+    :param encoding: text encoding, defaults to the one open() would use
+    :param max_depth: see Tokenizer
+    :return: tokens of the file
+    """
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    size = os.path.getsize(path)
+    if chunk_size is None:
+        chunk_size = max(65536, size // (max_workers * 4))
+    chunks = []
+    if not any(c in single_tokens for c in '[;"\'$\\'):
+        for (name, line, start, end) in SectionIndex.load(path, cache_index, max_depth).parts():
+            if chunks and chunks[-1][2] - chunks[-1][1] < chunk_size:
+                chunks[-1] = (chunks[-1][0], chunks[-1][1], end)
+            else:
+                chunks.append((line, start, end))
+    if not chunks:
+        chunks = [(1, 0, size)]
+    worker = partial(_tokenize_range, path=path, encoding=encoding, whitespace=whitespace,
+                     single_tokens=single_tokens, variable=variable, track_location=track_location,
+                     max_depth=max_depth)
+    arrays = TokenArrays.join(_map(worker, chunks, max_workers, executor))
+    if not track_location:
+        arrays = arrays.without_locations()
+    return arrays
@@ -0,0 +1,251 @@
+import locale
+from io import StringIO
+from typing import Iterator, TypeVar, List
+
+from expanding.source import At, Reader
+from expanding.tokenizer import Token, TokenType, TokenWhitespace, TokenEngine, Tokenizer
+from expanding.variable import EnvironmentVariable, Variable
+
+
+class _Lines(object):
+    """
+    Line source, reading a list of lines from an index
+    """
+
+    def __init__(self, lines: List[str], index: int):
+        self._lines = lines
+        self._index = index
+
+    def readline(self) -> str:
+        if self._index >= len(self._lines):
+            return ""
+        line = self._lines[self._index]
+        self._index += 1
+        return line
+
+
+class TokenizerSession(object):
+    """
+Incremental tokenizer, for text that is being edited
+
+The text is kept as lines, and the tokens by the line they start on. A line is
+clean, if no token spans (or could grow across) the start of it, then
+tokenizing from the start of the line gives the same tokens as tokenizing the
+whole text: the only state there is the position.
+
+An edit replaces a range of lines. The text is tokenized from the last clean
+line before the edit, until a line after the edit is clean in both the new
+and the old tokens, from there on the old tokens are kept. The cost is that of
+tokenizing the lines around the edit, not the whole text, and the tokens are
+the same as those of a Tokenizer on the whole text.
+
+Variables are resolved when the text is tokenized, call retokenize() when
+their values change.
+    """
+
+    @staticmethod
+    def from_file(filename: str, variable: Variable = EnvironmentVariable(),
+                  whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                  single_tokens: str = "=",
+                  engine: TokenEngine = TokenEngine.CHARACTER,
+                  encoding: str = None,
+                  max_depth: int = None) -> TypeVar('TokenizerSession'):
+        """
+        Create a session from the content of a file
+
+        :param filename: path of file
+        :param variable: the variable expander
+        :param whitespace: see Tokenizer
+        :param single_tokens: see Tokenizer
+        :param engine: see Tokenizer
+        :param encoding: text encoding, defaults to the one open() would use
+        :param max_depth: see Tokenizer
+        :return: new object
+        """
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        with open(filename, 'r', encoding=encoding, newline='') as file:
+            text = file.read().replace('\r\n', '\n')
+        return TokenizerSession(text, variable, whitespace, single_tokens, engine, filename, max_depth)
+
+    def __init__(self, text: str = "", variable: Variable = EnvironmentVariable(),
+                 whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                 single_tokens: str = "=",
+                 engine: TokenEngine = TokenEngine.CHARACTER,
+                 name: str = "<UNKNOWN>",
+                 max_depth: int = None):
+        """
+        Tokenize a text
+
+        :param text: the content
+        :param variable: the variable expander
+        :param whitespace: see Tokenizer
+        :param single_tokens: see Tokenizer
+        :param engine: see Tokenizer
+        :param name: name of source
+        :param max_depth: see Tokenizer
+        """
+        self._variable = variable
+        self._whitespace = whitespace
+        self._single_tokens = single_tokens
+        self._engine = engine
+        self._name = name
+        self._max_depth = max_depth
+        self._lines = StringIO(text).readlines()
+        self._tokens = []  # For each line: list of (column, token type, content) of the tokens starting on it
+        self._clean = []  # For each line: if tokenizing can start there
+        self._error = None
+        self._error_line = None  # Last line, that was reached before the error
+        self.retokenize()
+
+    def text(self) -> str:
+        return "".join(self._lines)
+
+    def line_count(self) -> int:
+        return len(self._lines)
+
+    def error(self) -> TypeVar('_Exception', Exception, None):
+        """
+        The error, that ends the tokens
+
+        :return: exception or None if the text was tokenized to the end
+        """
+        return self._error
+
+    def edit(self, first_line: int, last_line: int, text: str) -> tuple:
+        """
+        Replace lines of the text
+
+        Whole lines are replaced, if text doesn't end with a newline, it is
+        joined with the line after last_line
+
+        :param first_line: first line to replace
+        :param last_line: last line to replace (first_line - 1 to insert before first_line)
+        :param text: the new lines
+        :return: tuple of (first line, last line) that were tokenized, of the new text
+        :raises Exception: if the line range is invalid
+        """
+        lines = self._lines
+        if not 1 <= first_line <= last_line + 1 <= len(lines) + 1:
+            raise Exception("Invalid line range: %d-%d of %d lines" % (first_line, last_line, len(lines)))
+        if first_line > 1 and not lines[first_line - 2].endswith("\n"):
+            first_line -= 1  # Appending to a last line without a newline
+            text = lines[first_line - 1] + text
+        if text != "" and not text.endswith("\n") and last_line < len(lines):
+            last_line += 1
+            text = text + lines[last_line - 1]
+        new_lines = StringIO(text).readlines()
+        start = min(first_line, len(self._clean))
+        while start > 1 and not self._clean[start - 1]:
+            start -= 1
+        lines[first_line - 1:last_line] = new_lines
+        return self._tokenize(max(start, 1), first_line + len(new_lines), len(new_lines) - (last_line - first_line + 1))
+
+    def retokenize(self, variable: Variable = None) -> None:
+        """
+        Tokenize the whole text again
+
+        :param variable: new variable expander (None keeps the current)
+        """
+        if variable is not None:
+            self._variable = variable
+        self._tokens = []
+        self._clean = []
+        self._tokenize(1, None, 0)
+
+    def tokens(self) -> Iterator[Token]:
+        """
+        Generator of the tokens up until (not including) EOF
+
+        :return: token iterator
+        :raises Exception: the error (if any), after the tokens before it
+        """
+        name = self._name
+        for (n, line_tokens) in enumerate(self._tokens):
+            for (column, token_type, content) in line_tokens:
+                yield Token(At.pack(n + 1, column), token_type, content, name)
+        if self._error is not None:
+            raise self._error.with_traceback(None)
+
+    def tokenizer(self) -> Tokenizer:
+        """
+        Replay the tokens
+
+        :return: tokenizer
+        """
+        return Tokenizer.from_tokens(self._replay(), self._name)
+
+    def _replay(self) -> Iterator[Token]:
+        yield from self.tokens()
+        yield Token(At.EOF, TokenType.EOF, '', self._name)
+
+    def _tokenize(self, start: int, sync_from: TypeVar('_int', int, None), delta: int) -> tuple:
+        """
+        Tokenize from a clean line, until the tokens line up with the old ones
+
+        The lines are the new text, the tokens and clean marks are those of the
+        old text, where a line after the edit is delta lines earlier
+
+        :param start: clean line to start from
+        :param sync_from: first line after the edit (None to tokenize to the end)
+        :param delta: number of lines added by the edit
+        :return: tuple of (first line, last line) that were tokenized
+        """
+        lines = self._lines
+        reader = Reader(_Lines(lines, start - 1), self._name, first_line=start)
+        stream = Tokenizer(reader, self._variable, self._whitespace, self._single_tokens, self._engine,
+                           self._max_depth).tokens()
+        tokens = []
+        clean = []
+        line = start  # Next line to be marked
+        end = At.pack(start, 1)  # Where the previous token ended
+        grows = False  # If the previous token could have continued on the next line
+        error = None
+        while True:
+            try:
+                token = next(stream, None)
+            except Exception as e:
+                (token, error) = (None, e)
+            if token is None:
+                last = len(lines) if error is None else line - 1
+            else:
+                at = token.at()
+                last = at.line
+            while line <= last:
+                line_start = At.pack(line, 1)
+                is_clean = end < line_start or (end == line_start and not grows)
+                if is_clean and sync_from is not None and line >= sync_from and self._clean[line - delta - 1]:
+                    self._tokens[start - 1:line - delta - 1] = tokens
+                    self._clean[start - 1:line - delta - 1] = clean
+                    if self._error is not None and delta != 0:
+                        self._refresh_error(delta)  # The message has the old line numbers
+                    return start, line - 1
+                tokens.append([])
+                clean.append(is_clean)
+                line += 1
+            if token is None:
+                break
+            tokens[at.line - start].append((at.pos, token.token_type(), token.content()))
+            end = reader.position()
+            if end == At.EOF:
+                end = At.pack(len(lines) + 1, 1)
+            grows = token.is_a(TokenType.WHITESPACE)
+        for n in range(line, len(lines) + 1):  # After an error
+            tokens.append([])
+            clean.append(False)
+        self._tokens[start - 1:] = tokens
+        self._clean[start - 1:] = clean
+        self._error = error
+        self._error_line = max(start, line - 1)
+        return start, len(lines)
+
+    def _refresh_error(self, delta: int) -> None:
+        """
+        Tokenize again, from the last clean line before the error
+
+        :param delta: number of lines added before the error
+        """
+        start = self._error_line + delta
+        while start > 1 and not self._clean[start - 1]:
+            start -= 1
+        self._tokenize(max(start, 1), None, 0)
@@ -1,8 +1,60 @@
 
+import locale
+import mmap
+import os
+import re
+from io import StringIO
+from typing import TypeVar
+
+
 class At(object):
     """
     Location object
+
+    Readers hand out locations as compact integers (see Reader.position()),
+    those are turned into At objects by from_position() when needed
     """
+    EOF = -1
+    _LINE_SHIFT = 32
+    _POS_MASK = (1 << _LINE_SHIFT) - 1
+
+    @staticmethod
+    def from_position(source: str, position: TypeVar('_int', int, None)) -> TypeVar('At'):
+        """
+        Construct a location object from a compact position
+
+        :param source: the filename
+        :param position: line and character packed into an integer,
+                         At.EOF or None if locations aren't tracked
+        :return: new object
+        """
+        if position is None:
+            return At(source)
+        if position < 0:
+            return At(source + ":EOF")
+        return At(source, position >> At._LINE_SHIFT, position & At._POS_MASK)
+
+    @staticmethod
+    def pack(line: int, pos: int) -> int:
+        """
+        Pack a line and a character on line into a compact position
+
+        :param line: line number
+        :param pos: character on line
+        :return: position
+        """
+        return (line << At._LINE_SHIFT) | pos
+
+    @staticmethod
+    def line_of(position: int) -> int:
+        """
+        Line number of a compact position
+
+        :param position: position (not EOF or None)
+        :return: line number
+        """
+        return position >> At._LINE_SHIFT
+
     def __init__(self, source, line=None, pos=None):
         """
         Construct a location object
@@ -22,6 +74,58 @@ class At(object):
             return "%s:%d:%d" % (self.source, self.line, self.pos)
 
 
+class MappedFile(object):
+    """
+    Line source backed by a memory mapped file
+
+    Lines are decoded as they are read, so the content of the file is never
+    held on the heap as a whole. Windows line endings are translated to \\n.
+    Unlike open() with universal newlines, a lone \\r (old Mac line ending)
+    is not a line ending, it is kept in the line
+    """
+
+    def __init__(self, filename, encoding=None):
+        """
+        Map a file into memory
+
+        :param filename: path of a regular file
+        :param encoding: text encoding, defaults to the one open() would use
+        """
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        self._encoding = encoding
+        self._map = None
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readline(self) -> str:
+        """
+        Read a line from the mapped file
+
+        The mapping is released, when the end of the file is reached
+
+        :return: line including newline or "" at end of file
+        """
+        if self._map is None:
+            return ""
+        line = self._map.readline()
+        if not line:
+            self.close()
+            return ""
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        return line.decode(self._encoding)
+
+    def close(self) -> None:
+        """
+        Release the mapping
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
 class Reader(object):
     """
     (Line) buffered reader with location
@@ -32,21 +136,46 @@ class Reader(object):
         "r": "\r",
         "t": "\t"
     }
+    _UNTIL = {}  # Compiled patterns for read_until()
 
-    def __init__(self, source, name="<UNKNOWN>"):
+    @staticmethod
+    def from_file(filename: str, track_location: bool = True) -> TypeVar('Reader'):
+        """
+        Create a Reader for a file
+
+        Regular files are memory mapped, and decoded line by line (lines end
+        with \\n or \\r\\n, see MappedFile). Anything else (pipes, devices) is
+        read into memory.
+
+        :param filename: path of file
+        :param track_location: if locations should be reported
+        :returns: new object
+        """
+        if os.path.isfile(filename):
+            return Reader(source=MappedFile(filename), name=filename, track_location=track_location)
+        with open(filename, 'r') as f:
+            return Reader(source=StringIO(f.read()), name=filename, track_location=track_location)
+
+    def __init__(self, source, name="<UNKNOWN>", track_location=True, first_line=1):
         """
         Construct a reader
 
         :param source: input file handle
         :param name: name of source
+        :param track_location: if locations should be reported, when disabled
+                               all locations are just the name of the source
+        :param first_line: line number of the first line (when source is a part of a file)
         """
         self._source = source
         self._source_name = name
-        self._buffer = []
+        self._buffer = []  # (line number, text) of the lines available for unget
         self._line = 0
-        self._real_line = 0
-        self._pos = -1
+        self._text = ""
+        self._real_line = first_line - 1
+        self._pos = 0
         self._eof = False
+        if not track_location:
+            self.position = self._no_position
         self._read_line()
 
     def _read_line(self) -> None:
@@ -57,15 +186,29 @@ class Reader(object):
         """
         if not self.eof():
             line = self._source.readline()
-            if line is "":
+            if line == "":
                 self._eof = True
             else:
-                while len(self._buffer) > 2:
-                    self._buffer = self._buffer[1:]
+                if len(self._buffer) > 2:
+                    del self._buffer[0]
                 self._line = len(self._buffer)
                 self._real_line = self._real_line + 1
-                self._buffer.append([self._real_line] + [c for c in line])
-                self._pos = 1
+                self._buffer.append((self._real_line, line))
+                self._text = line
+                self._pos = 0
+
+    def _next_line(self) -> None:
+        """
+        Move to the start of the next line, reading it if it isn't buffered
+
+        Called when the current line has been consumed
+        """
+        if self._line + 1 == len(self._buffer):
+            self._read_line()
+        else:
+            self._line = self._line + 1
+            self._text = self._buffer[self._line][1]
+            self._pos = 0
 
     def get(self) -> str:
         """
@@ -75,16 +218,147 @@ class Reader(object):
         """
         if self.eof():
             return None
-        c = self._buffer[self._line][self._pos]
+        c = self._text[self._pos]
         self._pos = self._pos + 1
-        if self._pos == len(self._buffer[self._line]):
-            if self._line + 1 == len(self._buffer):
-                self._read_line()
-            else:
-                self._pos = 1
-                self._line = self._line + 1
+        if self._pos == len(self._text):
+            self._next_line()
         return c
 
+    def read_while(self, pattern) -> str:
+        """
+        Read a run of characters from the input
+
+        The run continues onto the next line, if pattern matches the rest of the line
+
+        :param pattern: compiled regular expression matching a (possibly empty) run of characters
+                        ie. re.compile('[a-z]*')
+        :return: the characters read ("" if none matched)
+        """
+        parts = None
+        while not self.eof():
+            text = self._text
+            pos = self._pos
+            end = pattern.match(text, pos).end()
+            if end < len(text):
+                self._pos = end
+                if parts is None:
+                    return text[pos:end]
+                parts.append(text[pos:end])
+                break
+            if parts is None:
+                parts = []
+            parts.append(text[pos:])
+            self._pos = end
+            self._next_line()
+        if parts is None:
+            return ""
+        return "".join(parts)
+
+    def read_until(self, chars: str) -> str:
+        """
+        Read characters up until any of the given characters (or end of file)
+
+        The stop character is not consumed
+
+        :param chars: characters that end the run
+        :return: the characters read ("" if none)
+        """
+        pattern = self._UNTIL.get(chars)
+        if pattern is None:
+            pattern = re.compile('[^%s]*' % re.escape(chars))
+            self._UNTIL[chars] = pattern
+        return self.read_while(pattern)
+
+    def match(self, pattern):
+        """
+        Match a pattern at the current location, and consume the matched text
+
+        The match is limited to the current line
+
+        :param pattern: compiled regular expression
+        :return: match object or None if at end of file or pattern doesn't match
+        """
+        if self.eof():
+            return None
+        match = pattern.match(self._text, self._pos)
+        if match is not None:
+            self._pos = match.end()
+            if self._pos == len(self._text):
+                self._next_line()
+        return match
+
+    def skip(self, count: int) -> None:
+        """
+        Skip characters on the current line
+
+        :param count: number of characters, no more than the rest of the line
+        """
+        if count > 0:
+            self._pos = self._pos + count
+            if self._pos == len(self._text):
+                self._next_line()
+
+    def line_number(self) -> int:
+        """
+        Number of the current line, also when locations aren't tracked
+
+        :return: line number (the last line at end of file)
+        """
+        if not self._buffer:
+            return self._real_line
+        return self._buffer[self._line][0]
+
+    def column(self) -> int:
+        """
+        Offset of the current character on the current line, also when locations aren't tracked
+
+        Cheap, unlike rest_of_line(), so offsets into a line can be taken
+        without copying it
+
+        :return: offset (the length of the last line at end of file)
+        """
+        return self._pos
+
+    def line_text(self) -> str:
+        """
+        The current line, see column()
+
+        :return: text including the newline ("" for empty input)
+        """
+        return self._text
+
+    def match_ahead(self, pattern):
+        """
+        Match a pattern at the current location, without consuming anything
+
+        The match is limited to the current line
+
+        :param pattern: compiled regular expression
+        :return: match object (offsets are columns, see column()) or None if
+                 at end of file or pattern doesn't match
+        """
+        if self.eof():
+            return None
+        return pattern.match(self._text, self._pos)
+
+    def rest_of_line(self) -> str:
+        """
+        Look at the rest of the current line, without consuming it
+
+        :return: text up to and including the newline ("" at end of file)
+        """
+        if self.eof():
+            return ""
+        return self._text[self._pos:]
+
+    def skip_line(self) -> None:
+        """
+        Skip the rest of the line including the newline
+        """
+        if not self.eof():
+            self._pos = len(self._text)
+            self._next_line()
+
     def get_quoted(self) -> str:
         """
         Read a backquoted value from  input
@@ -98,14 +372,14 @@ class Reader(object):
             raise Exception("Unexpected EOF - dangling quote")
         if c in self._QUOTED:
             return self._QUOTED[c]
-        if c is 'u' or c is 'U':
+        if c == 'u' or c == 'U':
             hexa = str(self.get()) + str(self.get()) + str(self.get()) + str(self.get())
-            if len(hexa) is not 4:
+            if len(hexa) != 4:
                 raise Exception("Unexpected EOF - dangling quote")
             return chr(int(hexa, 16))
         if str.isnumeric(c) and int(c) <= 3:
             octal = c + str(self.get()) + str(self.get())
-            if len(octal) is not 3:
+            if len(octal) != 3:
                 raise Exception("Unexpected EOF - dangling quote")
             return chr(int(octal, 8))
         return c
@@ -115,11 +389,13 @@ class Reader(object):
         Roll a character back, in the input
         """
         self._pos = self._pos - 1
-        if self._pos <= 0:
+        if self._pos < 0:
             if self._line == 0:
+                self._pos = 0
                 raise BufferError("Unget beyond buffering")
             self._line = self._line - 1
-            self._pos = len(self._buffer[self._line]) - 1
+            self._text = self._buffer[self._line][1]
+            self._pos = len(self._text) - 1
 
     def eof(self) -> bool:
         """
@@ -130,14 +406,53 @@ class Reader(object):
         return self._eof and (
                 self._line >= len(self._buffer) or  # Special for empty input
                 (self._line + 1 == len(self._buffer) and
-                 self._pos == len(self._buffer[self._line])))
+                 self._pos == len(self._text)))
+
+    def name(self) -> str:
+        """
+        The name of the input
 
-    def at(self) -> str:
+        :return: name given at construction
+        """
+        return self._source_name
+
+    def position(self) -> int:
+        """
+        The current location in the input, as a compact integer
+
+        Cheap enough to take for every character, use locate() to turn it
+        into an At object when it is reported
+
+        :return: position
+        """
+        if self.eof():
+            return At.EOF
+        return (self._buffer[self._line][0] << At._LINE_SHIFT) | (self._pos + 1)
+
+    @staticmethod
+    def _no_position() -> None:
+        """
+        Replaces position(), when locations are not tracked
+
+        :return: None
+        """
+        return None
+
+    def locate(self, position) -> At:
+        """
+        Turn a position into a location object
+
+        :param position: value from position() or an At object (returned as is)
+        :return: At (location) object
+        """
+        if isinstance(position, At):
+            return position
+        return At.from_position(self._source_name, position)
+
+    def at(self) -> At:
         """
         The current location in the input
 
         :return: At (location) object
         """
-        if self.eof():
-            return At(self._source_name + ":EOF")
-        return At(self._source_name, self._buffer[self._line][0], self._pos)
+        return At.from_position(self._source_name, self.position())
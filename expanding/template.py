@@ -0,0 +1,760 @@
+import locale
+from collections import OrderedDict
+from io import StringIO
+from types import GeneratorType
+from typing import Iterator, TypeVar, List
+
+from expanding.expand import Expansion
+from expanding.math import MathToken, MathTokenizer, MathType, MathProgram, MathVariable
+from expanding.source import Reader, At
+from expanding.tokenizer import Token, TokenType, TokenWhitespace, TokenEngine, Tokenizer
+from expanding.variable import EnvironmentVariable, Variable, hook
+
+
+class TemplateNode(object):
+    """
+    Interface type for parsed $-expansions
+
+    Nested nodes are rendered (and searched for references) from an explicit
+    stack, so the depth isn't limited by recursion
+    """
+
+    def render(self, variable: Variable, locate) -> str:
+        """
+        Resolve the expansion
+
+        :param variable: resolver for variable values
+        :param locate: function that turns a position into an At object
+        :return: expanded text
+        :raises Exception: if the expansion cannot be resolved
+        """
+        value = self._render(variable, locate)
+        if not isinstance(value, GeneratorType):
+            return value
+        stack = [value]
+        value = None
+        while True:
+            try:
+                node = stack[-1].send(value)
+            except StopIteration as stop:
+                stack.pop()
+                if not stack:
+                    return stop.value
+                value = stop.value
+                continue
+            value = node._render(variable, locate)
+            if isinstance(value, GeneratorType):
+                stack.append(value)
+                value = None
+
+    def _render(self, variable: Variable, locate):
+        """
+        Resolve the expansion, see render()
+
+        :return: expanded text, or a generator that yields the nested nodes,
+                 is sent their text and returns the expanded text
+        """
+        raise NotImplementedError()
+
+    def references(self, references: list) -> None:
+        """
+        Collect the variable references (also those only used if resolving fails)
+
+        :param references: list (position, name, modifiers, has default) tuples are appended to, in input order
+        """
+        stack = [self]
+        while stack:
+            nested = stack.pop()._references(references)
+            stack.extend(reversed(nested))
+
+    def _references(self, references: list) -> list:
+        """
+        Collect the variable reference of this node, see references()
+
+        :param references: list of references
+        :return: the nested nodes
+        """
+        raise NotImplementedError()
+
+
+class TemplateVariable(TemplateNode):
+    """
+    $VARIABLE
+    """
+
+    def __init__(self, at, name):
+        self._at = at
+        self._name = name
+
+    def _render(self, variable: Variable, locate) -> str:
+        if self._name is None:
+            raise Exception("Cannot find variable name at: %s" % locate(self._at))
+        value = variable.lookup_variable(self._name)
+        if value is None:
+            raise Exception("Cannot resolve variable: %s at: %s" % (self._name, locate(self._at)))
+        return value
+
+    def _references(self, references: list) -> list:
+        if self._name is not None:
+            references.append((self._at, self._name, [], False))
+        return []
+
+
+class TemplateBracket(TemplateNode):
+    """
+    ${VARIABLE[:quote[,quote...][|default value]}
+    """
+
+    def __init__(self, at, name, modifiers, quotes, default):
+        """
+        Construct a node
+
+        :param at: position of $
+        :param name: variable name (None if no name could be read)
+        :param modifiers: list of quote names
+        :param quotes: list of quote functions
+        :param default: TemplateText of default value (None if no default)
+        """
+        self._at = at
+        self._name = name
+        self._modifiers = modifiers
+        self._quotes = quotes
+        self._default = default
+
+    def _render(self, variable: Variable, locate):
+        value = None
+        if self._name is not None:
+            value = variable.lookup_variable(self._name)
+        if value is None:
+            if self._default is not None:
+                return self._default._render(variable, locate)
+            if self._name is None:
+                raise Exception("Cannot find variable name at: %s" % locate(self._at))
+            raise Exception("Cannot resolve variable: %s at: %s" % (self._name, locate(self._at)))
+        at = None
+        if self._quotes:
+            at = locate(self._at)
+        for quote in self._quotes:
+            value = quote(value, at)
+        return value
+
+    def _references(self, references: list) -> list:
+        if self._name is not None:
+            references.append((self._at, self._name, self._modifiers, self._default is not None))
+        if self._default is not None:
+            return [self._default]
+        return []
+
+
+class TemplateText(TemplateNode):
+    """
+    Text with embedded expansions (double quoted or default value)
+    """
+
+    def __init__(self, parts):
+        """
+        Construct a node
+
+        :param parts: list of str and TemplateNode
+        """
+        self._parts = parts
+
+    def _render(self, variable: Variable, locate):
+        content = StringIO()
+        for part in self._parts:
+            if isinstance(part, TemplateNode):
+                part = yield part
+            content.write(part)
+        return content.getvalue()
+
+    def _references(self, references: list) -> list:
+        return [part for part in self._parts if isinstance(part, TemplateNode)]
+
+
+class TemplateMath(TemplateNode):
+    """
+    $( integer expression )
+
+    The program has MathVariable leaves for every expansion (and literal, that
+    isn't a number), they are resolved in input order before the expression
+    is computed
+    """
+
+    def __init__(self, program: MathProgram, leaves: list):
+        """
+        Construct a node
+
+        :param program: compiled expression
+        :param leaves: list of (position, literal text or TemplateNode)
+        """
+        self._program = program
+        self._leaves = leaves
+
+    def _render(self, variable: Variable, locate):
+        values = []
+        for (at, leaf) in self._leaves:
+            (value, content) = yield from self._leaf_value(at, leaf, locate)
+            values.append(value)
+        return str(self._program.run(values))
+
+    @staticmethod
+    def _leaf_value(at, leaf, locate):
+        """
+        Resolve a leaf, a generator see _render()
+
+        :param at: position of the leaf
+        :param leaf: literal text or TemplateNode
+        :param locate: function that turns a position into an At object
+        :return: tuple of (integer value, text)
+        :raises Exception: if the leaf isn't a number
+        """
+        if isinstance(leaf, TemplateNode):
+            content = yield leaf
+            value = MathTokenizer.as_signed_int(content)
+            if value is None:
+                raise Exception("Expansion at: %s does not resolve to a number" % locate(at))
+            return value, content
+        value = MathTokenizer.as_int(leaf)
+        if value is None:
+            raise Exception("%s is not a number at: %s" % (leaf, locate(at)))
+        return value, leaf
+
+    def program(self) -> MathProgram:
+        return self._program
+
+    def leaves(self) -> list:
+        """
+        The values of the MathVariable leaves of the program
+
+        :return: list of (position, literal text or TemplateNode)
+        """
+        return self._leaves
+
+    def _references(self, references: list) -> list:
+        return [leaf for (at, leaf) in self._leaves if isinstance(leaf, TemplateNode)]
+
+
+class _TemplateLeaves(TemplateMath):
+    """
+    The leaves of an expression up until a token, that doesn't fit in it (the
+    last leaf). Renders the text of that token, see TemplateSyntaxError
+    """
+
+    def __init__(self, leaves: list):
+        super().__init__(None, leaves)
+
+    def _render(self, variable: Variable, locate):
+        content = None
+        for (at, leaf) in self._leaves:
+            (value, content) = yield from self._leaf_value(at, leaf, locate)
+        return content
+
+
+class TemplateSyntaxError(Exception):
+    """
+    A token, that doesn't fit in an expression, where the token is an expansion
+    (or a literal, that isn't a number)
+
+    A Tokenizer reports such a token by its value, after the expansions before
+    it in the expression are resolved, so the error is only known, when the
+    template is rendered (see rendered()). Until then it names the token by its
+    source text
+    """
+
+    def __init__(self, text, leaves: list, suffix: str):
+        """
+        :param text: source text of the token
+        :param leaves: list of (position, literal text or TemplateNode) of the expression, up to the token
+        :param suffix: the message after the token
+        """
+        super().__init__("Unexpected token: %s%s" % (text, suffix))
+        self._leaves = _TemplateLeaves(leaves)
+        self._suffix = suffix
+
+    def rendered(self, variable: Variable, locate) -> Exception:
+        """
+        The error, as a Tokenizer would report it with a Variable
+
+        :param variable: resolver for variable values
+        :param locate: function that turns a position into an At object
+        :return: exception to raise
+        :raises Exception: if an expansion before the token cannot be resolved
+        """
+        return Exception("Unexpected token: %s%s" % (self._leaves.render(variable, locate), self._suffix))
+
+
+class TemplateExpansion(Expansion):
+    """
+Dollar-expansion, that parses but doesn't resolve
+
+expand() returns a TemplateNode, that can be rendered against any Variable.
+Syntax errors are raised while parsing, resolve errors when rendering.
+    """
+
+    def _begin(self, at, should_resolve: bool):
+        """
+        Start parsing a $-expression, reader should be positioned after $
+
+        :param at: position of $
+        :param should_resolve: ignored, resolving is decided when rendering
+        :return: node, or a generator for ${} and $() (see Expansion._run())
+        """
+        c = self._reader.get()
+        if c == '{':
+            return self._parse_variable(at)
+        if c == '(':
+            return self._parse_math(at)
+        if c is not None:
+            self._reader.unget()
+        return TemplateVariable(at, self._variable.get_name(self._reader))
+
+    def _parse_variable(self, at) -> TemplateNode:
+        """
+        parse ${} construction, see Expansion._expand_variable()
+
+        A generator, see Expansion._run()
+
+        :param at: position of $
+        :return: node
+        """
+        name = self._variable.get_name(self._reader)
+        at_after = self._reader.position()
+        c = self._reader.get()
+        modifiers = []
+        if c == ':':
+            c = ','
+            while c == ',':
+                at_quote = self._reader.position()
+                quote = StringIO()
+                c = self._reader.get()
+                while str.isalnum(c):
+                    quote.write(c)
+                    c = self._reader.get()
+                quote = quote.getvalue()
+                if quote not in self.quotes:
+                    raise Exception("Unknown quote: '%s' at: %s" % (quote, self._reader.locate(at_quote)))
+                modifiers.append(quote)
+
+        default = None
+        if c == '|':
+            default = yield from self._parse_until_closing_bracket()
+        else:
+            if c is None:
+                raise Exception("Unexpected EOF in variable: %s at: %s" % (name, self._reader.locate(at)))
+            if c != '}':
+                raise Exception("Expected '}' in variable: %s at: %s got %s" % (name, self._reader.locate(at_after), c))
+        return TemplateBracket(at, name, modifiers, [self.quotes[quote] for quote in modifiers], default)
+
+    def _parse_until_closing_bracket(self) -> TemplateText:
+        """
+        Parse text (default value) up until closing bracket
+
+        A generator, see Expansion._run()
+
+        :return: node
+        """
+        at = self._reader.position()
+        parts = []
+        content = StringIO()
+        while True:
+            pos = self._reader.position()
+            c = self._reader.get()
+            if c == '}':
+                parts.append(content.getvalue())
+                return TemplateText(parts)
+            if c is None:
+                raise Exception("Unexpected EOF in default value at %s" % self._reader.locate(at))
+            if c == '$':
+                parts.append(content.getvalue())
+                parts.append((yield pos, True))
+                content = StringIO()
+                continue
+            if c == '\\':
+                c = self._reader.get_quoted()
+            if c is not None:
+                content.write(c)
+
+    def _parse_math(self, at) -> TemplateNode:
+        """
+        parse $() construction
+
+        A generator, see Expansion._run()
+
+        :param at: position of $
+        :return: node
+        """
+        tokenizer = _TemplateMathTokenizer(at, self._reader, self)
+        tree = yield from self._process_to_closing_parenthesis(tokenizer)
+        return TemplateMath(MathProgram(tree), tokenizer.leaves)
+
+    def _unexpected_token(self, tokenizer: MathTokenizer, token: MathToken, expected: str) -> Exception:
+        """
+        Error for a token, that doesn't fit in the expression, see Expansion._unexpected_token()
+
+        :return: TemplateSyntaxError if the token is a leaf (the last one)
+        """
+        if not isinstance(token.content(), MathVariable):
+            return super()._unexpected_token(tokenizer, token, expected)
+        return TemplateSyntaxError(token.text(), list(tokenizer.leaves),
+                                   " at: %s%s" % (self._reader.locate(token.at()), expected))
+
+
+class _TemplateMathTokenizer(MathTokenizer):
+    """
+    Math tokenizer, that makes a MathVariable of every expansion
+
+    Literals are values (constants of the program), unless they are not
+    numbers; the error is then raised when the node is rendered. Expansions
+    are reported by their source text in syntax errors, until the template is
+    rendered (see TemplateSyntaxError)
+    """
+
+    def __init__(self, at, reader: Reader, expansion: TemplateExpansion):
+        super().__init__(at, reader, expansion, True)
+        self.leaves = []
+        self._line = None  # (line number, line, column of the $) of the last expansion
+
+    def raw_token(self) -> MathToken:
+        token = super().raw_token()
+        if token.is_a(MathType.EXPANSION):
+            self._line = (self._reader.line_number(), self._reader.line_text(), self._reader.column() - 1)
+        return token
+
+    def _literal(self, at, content) -> TypeVar('_leaf', int, MathVariable):
+        value = self.as_int(content)
+        if value is not None:
+            return value
+        self.leaves.append((at, content))
+        return MathVariable(len(self.leaves) - 1)
+
+    def expansion_value(self, at, content) -> MathVariable:
+        self.leaves.append((at, content))
+        return MathVariable(len(self.leaves) - 1)
+
+    def expansion_text(self, at, content) -> TypeVar('_SourceText'):
+        (line_number, line, start) = self._line
+        if self._reader.line_number() == line_number:
+            return _SourceText(line, start, self._reader.column())
+        return _SourceText(line, start, None)  # The expansion spans lines
+
+
+class _SourceText(object):
+    """
+    Source text of an expansion in an expression, it is only cut from the
+    line, if it is reported (the expansions nested in one are as long)
+    """
+
+    def __init__(self, line: str, start: int, end: TypeVar('_int', int, None)):
+        """
+        :param line: the line of the $
+        :param start: column of the $
+        :param end: column after the expansion, None if it spans lines
+        """
+        self._line = line
+        self._start = start
+        self._end = end
+
+    def __str__(self) -> str:
+        if self._end is None:
+            return self._line[self._start:].rstrip("\n") + "..."
+        return self._line[self._start:self._end]
+
+
+class TemplateTokenizer(Tokenizer):
+    """
+    Tokenizer, that produces TEXT tokens with TemplateNode content for expansions
+    """
+
+    def __init__(self, reader: Reader, variable: Variable, whitespace: TokenWhitespace, single_tokens: str,
+                 engine: TokenEngine, max_depth: int = None):
+        super().__init__(reader, variable, whitespace, single_tokens, engine, max_depth)
+        self.expander = TemplateExpansion(reader, variable, max_depth=max_depth)
+
+    def steps(self) -> List[tuple]:
+        """
+        Tokenize all of the input
+
+        An error ends the input, and is kept as the last step
+
+        :return: list of (position, token type, content) ending with EOF or
+                 (position, None, exception)
+        """
+        steps = []
+        while True:
+            at = self._reader.position()
+            try:
+                token = self._next_token()
+            except Exception as e:
+                steps.append((at, None, e))
+                return steps
+            steps.append((token._at, token._token_type, token._content))
+            if token._token_type is TokenType.EOF:
+                return steps
+
+    def _read_double_quote(self, at) -> Token:
+        """
+        Constructs a token from a double quote text, see Tokenizer._read_double_quote()
+
+        :return: the token, with TemplateText content if it contains expansions
+        :raises Exception: On unexpected eof or invalid quote
+        """
+        parts = []
+        content = StringIO()
+        while True:
+            content.write(self._reader.read_until('"$\\'))
+            a = self._reader.position()
+            c = self._reader.get()
+            if c is None:
+                raise Exception("Unexpected EOF in double quote starting at: %s" % self._reader.locate(at))
+            if c == '"':
+                if not parts:
+                    return Token(at, TokenType.TEXT, content.getvalue(), self._source)
+                parts.append(content.getvalue())
+                return Token(at, TokenType.TEXT, TemplateText(parts), self._source)
+            if c == '$':
+                parts.append(content.getvalue())
+                parts.append(self.expander.expand(a))
+                content = StringIO()
+                continue
+            if c == '\\':
+                c = self._reader.get_quoted()
+            content.write(c)
+
+
+class Reference(object):
+    """
+    A variable reference found by scanning input, see scan()
+    """
+    __slots__ = ('_source', '_at', '_name', '_modifiers', '_has_default')
+
+    def __init__(self, source: str, at: TypeVar('_at', int, None), name: str, modifiers: List[str],
+                 has_default: bool):
+        self._source = source
+        self._at = at
+        self._name = name
+        self._modifiers = modifiers
+        self._has_default = has_default
+
+    def name(self) -> str:
+        return self._name
+
+    def at(self) -> At:
+        """
+        Location of the $
+
+        :return: location object
+        """
+        return At.from_position(self._source, self._at)
+
+    def modifiers(self) -> List[str]:
+        """
+        Names of the quotes applied (${NAME:quote,...})
+
+        :return: list of names
+        """
+        return self._modifiers
+
+    def has_default(self) -> bool:
+        return self._has_default
+
+    def __str__(self):
+        return "{%s,%s,%s,%s}" % (self._name, self.at(), ",".join(self._modifiers), self._has_default)
+
+
+class Template(object):
+    """
+Precompiled input
+
+The input is tokenized once, with expansions kept as nodes, that are resolved
+each time the template is rendered against a Variable. The rendered tokens,
+and the errors (and their locations) are the same as those of a Tokenizer
+reading the input with that Variable. If the input has a syntax error, it is
+reported when rendering reaches the token it is in (where a Tokenizer could
+report an unresolvable variable earlier in the same token).
+    """
+
+    @staticmethod
+    def from_file(filename: str, variable: Variable = EnvironmentVariable(),
+                  whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                  single_tokens: str = "=",
+                  track_location: bool = True,
+                  max_depth: int = None) -> TypeVar('Template'):
+        """
+        Compile a file
+
+        :param filename: path of file
+        :param variable: used for reading variable names, not for resolving
+        :param whitespace: see Tokenizer
+        :param single_tokens: see Tokenizer
+        :param track_location: if token locations should be reported (disable for trusted input)
+        :param max_depth: see Tokenizer
+        :returns: new object
+        """
+        reader = Reader.from_file(filename, track_location=track_location)
+        return Template(reader, variable, whitespace, single_tokens, max_depth=max_depth)
+
+    def __init__(self, reader: Reader, variable: Variable = EnvironmentVariable(),
+                 whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                 single_tokens: str = "=",
+                 engine: TokenEngine = TokenEngine.REGEX,
+                 max_depth: int = None) -> TypeVar('Template'):
+        """
+        Compile input
+
+        :param reader: the file source
+        :param variable: used for reading variable names, not for resolving
+        :param whitespace: see Tokenizer
+        :param single_tokens: see Tokenizer
+        :param engine: see Tokenizer
+        :param max_depth: see Tokenizer
+        :returns: new object
+        """
+        self._source = reader.name()
+        self._steps = TemplateTokenizer(reader, variable, whitespace, single_tokens, engine, max_depth).steps()
+
+    def steps(self) -> List[tuple]:
+        """
+        The compiled input
+
+        :return: list of (position, token type, content) ending with EOF or
+                 (position, None, exception), content is a str or a TemplateNode
+        """
+        return self._steps
+
+    def references(self) -> List[Reference]:
+        """
+        The variable references in the template (also those only used if resolving fails)
+
+        :return: list of references in input order
+        :raises Exception: if the input has a syntax error
+        """
+        found = []
+        for (at, token_type, content) in self._steps:
+            if token_type is None:
+                raise content.with_traceback(None)
+            if isinstance(content, TemplateNode):
+                content.references(found)
+        return [Reference(self._source, at, name, modifiers, has_default)
+                for (at, name, modifiers, has_default) in found]
+
+    def names(self) -> List[str]:
+        """
+        The variable names referenced by the template (also those only used if resolving fails)
+
+        :return: list of unique names in input order
+        """
+        found = []
+        for (at, token_type, content) in self._steps:
+            if isinstance(content, TemplateNode):
+                content.references(found)
+        return list(OrderedDict.fromkeys(reference[1] for reference in found))
+
+    def prefetch(self, variable: Variable) -> Variable:
+        """
+        Resolve all referenced variables in one batch, see Variable.lookup_many()
+
+        :param variable: resolver for variable values
+        :return: resolver of the fetched values
+        """
+        return EnvironmentVariable(hook(variable, 'lookup_many')(self.names()))
+
+    def tokenizer(self, variable: Variable = EnvironmentVariable(), prefetch: bool = False) -> Tokenizer:
+        """
+        Render the template as a Tokenizer
+
+        Expansions are resolved, when the tokens are read
+
+        :param variable: resolver for variable values
+        :param prefetch: resolve all variables in one batch first
+        :return: tokenizer
+        """
+        hook(variable, 'begin_parse')()
+        if prefetch:
+            variable = self.prefetch(variable)
+        return Tokenizer.from_tokens(self._render(variable), self._source)
+
+    def tokens(self, variable: Variable = EnvironmentVariable(), prefetch: bool = False) -> Iterator[Token]:
+        """
+        Render the template as tokens up until (not including) EOF
+
+        :param variable: resolver for variable values
+        :param prefetch: resolve all variables in one batch first
+        :return: token iterator
+        """
+        return self.tokenizer(variable, prefetch).tokens()
+
+    def _render(self, variable: Variable) -> Iterator[Token]:
+        """
+        Generator of rendered tokens
+
+        :param variable: resolver for variable values
+        :return: token iterator, ending with EOF
+        :raises Exception: when an expansion cannot be resolved or a syntax error is reached
+        """
+        source = self._source
+        locate = self._locate
+        for (at, token_type, content) in self._steps:
+            if token_type is None:
+                if isinstance(content, TemplateSyntaxError):
+                    content = content.rendered(variable, locate)
+                raise content.with_traceback(None)
+            if isinstance(content, TemplateNode):
+                content = content.render(variable, locate)
+            yield Token(at, token_type, content, source)
+
+    def _locate(self, position: TypeVar('_at', int, None)) -> At:
+        """
+        Location of a position in the compiled input
+
+        :param position: see Reader.position()
+        :return: location object
+        """
+        return At.from_position(self._source, position)
+
+
+def prefetch_tokenizer(reader: Reader, variable: Variable = EnvironmentVariable(),
+                       whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
+                       single_tokens: str = "=",
+                       engine: TokenEngine = TokenEngine.CHARACTER,
+                       max_depth: int = None) -> Tokenizer:
+    """
+    Two pass Tokenizer, for resolvers with expensive lookups
+
+    The first pass parses the input without resolving anything, then all the
+    referenced variables are resolved in one call to variable.lookup_many(),
+    and the tokens are produced from the fetched values
+
+    :param reader: the file source
+    :param variable: the variable expander
+    :param whitespace: see Tokenizer
+    :param single_tokens: see Tokenizer
+    :param engine: see Tokenizer
+    :param max_depth: see Tokenizer
+    :return: tokenizer
+    """
+    return Template(reader, variable, whitespace, single_tokens, engine, max_depth).tokenizer(variable, prefetch=True)
+
+
+def scan(source: TypeVar('_source', str, Reader), variable: Variable = EnvironmentVariable(),
+         single_tokens: str = "=", max_depth: int = None) -> List[Reference]:
+    """
+    Find the variable references in input, without resolving anything
+
+    Files (given by path) without a $ are not tokenized, they have no
+    references, and their syntax errors are not reported. A Reader is always
+    tokenized
+
+    :param source: path of file or Reader
+    :param variable: used for reading variable names, not for resolving
+    :param single_tokens: see Tokenizer ([ as a single token makes $ in sections expand)
+    :param max_depth: see Tokenizer
+    :return: list of references in input order
+    :raises Exception: if the input has a syntax error (unless it is a file without a $)
+    """
+    if not isinstance(source, Reader):
+        with open(source, encoding=locale.getpreferredencoding(False), newline='') as file:
+            content = file.read().replace('\r\n', '\n')  # as Reader.from_file()
+        if '$' not in content:
+            return []
+        source = Reader(StringIO(content), source)
+    return Template(source, variable, TokenWhitespace.NONE, single_tokens, max_depth=max_depth).references()
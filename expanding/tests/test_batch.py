@@ -0,0 +1,46 @@
+from unittest import TestCase, skipIf
+
+from expanding.batch import MathBatch, evaluate_batch
+from expanding.math import MathExpr, MathType, MathValue, MathVariable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@skipIf(numpy is None, "numpy is not installed")
+class TestMathBatch(TestCase):
+
+    def test_evaluate(self):
+        batch = MathBatch.from_text("$(${MEM}*1024/${WORKERS} < 65536)")
+        self.assertEqual(["MEM", "WORKERS"], batch.names())
+        result = batch.evaluate({"MEM": [32, 4096, 100], "WORKERS": ["1", "0x10", "-3"]})
+        self.assertEqual(numpy.int64, result.dtype)
+        self.assertEqual([32768, 65536, -34133], list(result))
+
+    def test_integer_semantics(self):
+        tree = MathExpr(MathType.MOD, MathVariable(0), MathVariable(1))
+        left = [7, -7, 7, -7]
+        right = [2, 2, -2, -2]
+        self.assertEqual([l % r for (l, r) in zip(left, right)], list(evaluate_batch(tree, [left, right])))
+        tree = MathExpr(MathType.DIV, MathVariable(0), MathVariable(1))
+        self.assertEqual([int(l / r) for (l, r) in zip(left, right)], list(evaluate_batch(tree, [left, right])))
+
+    def test_overflow_falls_back_to_python_ints(self):
+        tree = MathExpr(MathType.MUL, MathVariable(0), MathValue(1 << 40))
+        result = evaluate_batch(tree, [[1, 1 << 30]])
+        self.assertEqual(object, result.dtype)
+        self.assertEqual([1 << 40, 1 << 70], list(result))
+
+    def test_defaults_are_rendered_for_each_row(self):
+        batch = MathBatch.from_text("$(${A|$B} + 1)")
+        self.assertEqual([3, 11], list(batch.evaluate({"A": ["2", None], "B": [5, 10]})))
+
+    def test_errors(self):
+        batch = MathBatch.from_text("$($A / $B)")
+        self.assertRaises(ZeroDivisionError, batch.evaluate, {"A": [1, 2], "B": [1, 0]})
+        with self.assertRaises(Exception) as context:
+            batch.evaluate({"A": [1, "x"], "B": [1, 1]})
+        self.assertEqual("Expansion at: <UNKNOWN>:1:3 does not resolve to a number", str(context.exception))
+        self.assertRaises(Exception, MathBatch.from_text, "${A}")
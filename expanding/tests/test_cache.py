@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from expanding.cache import ParseCache
+from expanding.source import Reader
+from expanding.tokenizer import Tokenizer, TokenWhitespace
+from expanding.variable import EnvironmentVariable
+
+
+class FailingVariable(EnvironmentVariable):
+
+    def __init__(self, env, failures):
+        super().__init__(env)
+        self.failures = failures
+
+    def lookup_variable(self, name):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("service timeout")
+        return super().lookup_variable(name)
+
+
+def tokens(tokenizer):
+    result = []
+    try:
+        for token in tokenizer:
+            result.append((token.content(), str(token.at())))
+    except Exception as e:
+        result.append(str(e))
+    return result
+
+
+class TestParseCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ParseCache(os.path.join(self.directory, "cache"))
+        self.filename = os.path.join(self.directory, "test.ini")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.filename, "w") as file:
+            file.write(content)
+
+    def fresh(self, **kwargs):
+        reader = Reader.from_file(self.filename)
+        return tokens(Tokenizer(reader, EnvironmentVariable(kwargs), TokenWhitespace.NEWLINE, "="))
+
+    def cached(self, **kwargs):
+        return tokens(self.cache.ini_from_file(self.filename, EnvironmentVariable(kwargs)))
+
+    def test_hit(self):
+        self.write("a = $A\nb = ${B|$C}\n")
+        self.assertEqual(self.fresh(A="1", C="3"), self.cached(A="1", C="3"))
+        self.assertEqual(self.fresh(A="1", C="3"), self.cached(A="1", C="3", OTHER="x"))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(self.fresh(A="1", B="2"), self.cached(A="1", B="2"))
+        self.assertEqual(self.fresh(A="2", C="3"), self.cached(A="2", C="3"))
+        self.assertEqual(self.fresh(A="1", B="2"), self.cached(A="1", B="2"))
+        self.assertEqual((2, 3), (self.cache.hits, self.cache.misses))
+
+    def test_error(self):
+        self.write("a = 1\nb = $A\nc = 3\n")
+        expected = self.fresh()
+        self.assertEqual("Cannot resolve variable: A at: %s:2:5" % self.filename, expected[-1])
+        self.assertEqual(expected, self.cached())
+        self.assertEqual(expected, self.cached())
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_max_depth(self):
+        self.write("a = ${A|${A|${A|x}}}\n")
+        self.assertEqual(self.fresh(), self.cached())
+        limited = tokens(self.cache.ini_from_file(self.filename, EnvironmentVariable({}), max_depth=2))
+        self.assertRegex(limited[-1], "Expansions nested deeper than 2 levels at: .*:1:13")
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_resolver_error_is_not_stored(self):
+        self.write("a = $A\n")
+        variable = FailingVariable({"A": "1"}, 1)
+        self.assertEqual("service timeout", tokens(self.cache.ini_from_file(self.filename, variable))[-1])
+        self.assertEqual(self.fresh(A="1"), tokens(self.cache.ini_from_file(self.filename, variable)))
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_resolver_error_on_warm_cache(self):
+        self.write("a = 1\nb = $A\n")
+        self.assertEqual(self.fresh(A="1"), self.cached(A="1"))
+        variable = FailingVariable({"A": "1"}, 2)
+        expected = tokens(Tokenizer(Reader.from_file(self.filename), FailingVariable({"A": "1"}, 1),
+                                    TokenWhitespace.NEWLINE, "="))
+        self.assertEqual("service timeout", expected[-1])
+        self.assertEqual(expected, tokens(self.cache.ini_from_file(self.filename, variable)))
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+        self.assertEqual(self.fresh(A="1"), self.cached(A="1"))
+        self.assertEqual((1, 2), (self.cache.hits, self.cache.misses))
+
+    def test_changed_file(self):
+        self.write("a = 1\n")
+        self.assertEqual(self.fresh(), self.cached())
+        self.write("a = 2\n")
+        self.assertEqual(self.fresh(), self.cached())
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_corrupt_entry(self):
+        self.write("a = 1\n")
+        self.cached()
+        for name in os.listdir(os.path.join(self.directory, "cache")):
+            with open(os.path.join(self.directory, "cache", name), "wb") as file:
+                file.write(b"garbage")
+        self.assertEqual(self.fresh(), self.cached())
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
@@ -1,9 +1,12 @@
+import gc
+import re
+import weakref
 from io import StringIO
 from unittest import TestCase
 
 from expanding.expand import Expansion
 from expanding.source import Reader, At
-from expanding.variable import EnvironmentVariable
+from expanding.variable import EnvironmentVariable, CachingVariable, Variable
 
 
 def make_expanding(text, **kwargs):
@@ -13,6 +16,10 @@ def make_expanding(text, **kwargs):
     return expanding
 
 
+class DottedVariable(EnvironmentVariable):
+    _NAME = re.compile('[\\w.]*', re.U)
+
+
 class TestExpansion(TestCase):
 
     def test_expand_simple(self):
@@ -95,8 +102,135 @@ class TestExpansion(TestCase):
         self.assertEqual("16", expanding.expand(At("", -1, -1)))
         self.assertEqual("!", expanding._reader.get())
 
+    def test_expand_math_nested_in_default(self):
+        expanding = make_expanding("(${A|$((2))} + 1)!", A="5")
+        self.assertEqual("6", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        expanding = make_expanding("(${A|$((2))} + 1)!")
+        self.assertEqual("3", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+
+    def test_expand_math_cached(self):
+        Expansion.MATH_CACHE.clear()
+        expanding = make_expanding("($A * (1 + 1) + ${B|2})!", A="3")
+        self.assertEqual("8", expanding.expand(At("", -1, -1)))
+        self.assertEqual(1, len(Expansion.MATH_CACHE))
+        expanding = make_expanding("($A * (1 + 1) + ${B|2})!", A="5", B="-1")
+        self.assertEqual("9", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        self.assertEqual(1, len(Expansion.MATH_CACHE))
+        expanding = make_expanding("($A * (1 + 1) + ${B|2})!", A="x")
+        with self.assertRaises(Exception) as context:
+            expanding.expand(At("", -1, -1))
+        self.assertEqual("Expansion at: <UNKNOWN>:1:2 does not resolve to a number", str(context.exception))
+
+    def test_expand_math_digits_across_lines(self):
+        expanding = make_expanding("(1 \n 2\n\n3 + 1\n)!")
+        self.assertEqual("124", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+
+    def test_expand_math_cached_max_depth(self):
+        Expansion.MATH_CACHE.clear()
+        self.assertEqual("3", make_expanding("(((1)) + ($A))", A="2").expand(At("", -1, -1)))
+        self.assertEqual(1, len(Expansion.MATH_CACHE))
+        expanding = Expansion(Reader(StringIO("(((1)) + ($A))")), EnvironmentVariable({"A": "2"}), max_depth=1)
+        with self.assertRaisesRegex(Exception, "Parentheses nested deeper than 1 levels at: <UNKNOWN>:1:3"):
+            expanding.expand(At("", -1, -1))
+        expanding = Expansion(Reader(StringIO("(((1)) + ($A))")), EnvironmentVariable({"A": "2"}), max_depth=2)
+        self.assertEqual("3", expanding.expand(At("", -1, -1)))
+
+    def test_expand_math_cached_by_name_syntax(self):
+        Expansion.MATH_CACHE.clear()
+        dotted = Expansion(Reader(StringIO("($A.B+1)")), CachingVariable(DottedVariable({"A.B": "2"})))
+        self.assertEqual("3", dotted.expand(At("", -1, -1)))
+        plain = Expansion(Reader(StringIO("($A.B+1)")), CachingVariable(EnvironmentVariable({"A": "2"})))
+        with self.assertRaisesRegex(Exception, "Unexpected character: . in expression"):
+            plain.expand(At("", -1, -1))
+
+    def test_expand_math_not_cached_across_instances(self):
+        class PatternVariable(Variable):  # get_name() depends on the instance, name_syntax() isn't overridden
+            def __init__(self, pattern, env):
+                self._pattern = re.compile(pattern)
+                self._env = env
+
+            def get_name(self, reader):
+                return reader.read_while(self._pattern) or None
+
+            def lookup_variable(self, name):
+                return self._env.get(name)
+
+        Expansion.MATH_CACHE.clear()
+        dotted = Expansion(Reader(StringIO("($A.B+1)")), PatternVariable('[\\w.]*', {"A.B": "2"}))
+        self.assertEqual("3", dotted.expand(At("", -1, -1)))
+        plain = Expansion(Reader(StringIO("($A.B+1)")), PatternVariable('\\w*', {"A": "2"}))
+        with self.assertRaisesRegex(Exception, "Unexpected character: . in expression"):
+            plain.expand(At("", -1, -1))
+        self.assertEqual(1, len(Expansion.MATH_CACHE))
+        variable = PatternVariable('[\\w.]*', {"A.B": "2"})
+        for _ in range(2):
+            self.assertEqual("3", Expansion(Reader(StringIO("($A.B+1)")), variable).expand(At("", -1, -1)))
+        self.assertEqual(2, len(Expansion.MATH_CACHE))
+        alive = weakref.ref(variable)
+        del variable
+        gc.collect()
+        self.assertIsNone(alive())  # The cache doesn't keep the resolver alive
+
+    def test_expand_math_multi_line_is_not_cached(self):
+        Expansion.MATH_CACHE.clear()
+        expanding = make_expanding("($A +\n 1)!", A="3")
+        self.assertEqual("4", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        self.assertEqual(0, len(Expansion.MATH_CACHE))
+
+    def test_expand_math_error_shows_value(self):
+        expanding = make_expanding("(($A $A))", A="6")
+        with self.assertRaisesRegex(Exception, "^Unexpected token: 6 at: <UNKNOWN>:1:6 expected"):
+            expanding.expand(At("", -1, -1))
+        expanding = make_expanding("(1 $A)", A="-6")
+        with self.assertRaisesRegex(Exception, "^Unexpected token: -6 at: <UNKNOWN>:1:4 expected"):
+            expanding.expand(At("", -1, -1))
+        expanding = make_expanding("(1 $A)", A="-0x10")  # The expanded text, not the value (-16)
+        with self.assertRaisesRegex(Exception, "^Unexpected token: -0x10 at: <UNKNOWN>:1:4 expected"):
+            expanding.expand(At("", -1, -1))
+        expanding = make_expanding("((1) 02)")  # Literals show the value
+        with self.assertRaisesRegex(Exception, "^Unexpected token: 2 at: <UNKNOWN>:1:6 expected"):
+            expanding.expand(At("", -1, -1))
+        expanding = make_expanding("((1) 0x1012)")
+        with self.assertRaisesRegex(Exception, "^Unexpected token: 4114 at: <UNKNOWN>:1:6 expected"):
+            expanding.expand(At("", -1, -1))
+
     def test_expand_with_quotes(self):
         expanding = make_expanding("{A:sql,attr}!", A="ab'\"cd")
         self.assertEqual("ab''&quot;cd", expanding.expand(At("", -1, -1)))
         self.assertEqual("!", expanding._reader.get())
 
+    def test_expand_unused_default_is_not_looked_up(self):
+        expanding = make_expanding("{A|$B ${C} $($D)}!", A="a")
+        looked_up = []
+        lookup_variable = expanding._variable.lookup_variable
+        expanding._variable.lookup_variable = lambda name: looked_up.append(name) or lookup_variable(name)
+        self.assertEqual("a", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        self.assertEqual(["A"], looked_up)
+
+    def test_expand_deeply_nested(self):
+        expanding = make_expanding("{A|" + "${A|" * 4999 + "x" + "}" * 5000 + "!")
+        self.assertEqual("x", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        expanding = make_expanding("(" + "(" * 4999 + "1" + "+1)" * 5000 + "!")
+        self.assertEqual("5001", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        expanding = make_expanding("(" + "$(" * 4999 + "1" + ")" * 5000 + "!")
+        self.assertEqual("1", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+        expanding = make_expanding("{A|" + "$((${A|" * 2499 + "1" + "}))" * 2499 + "}!")
+        self.assertEqual("1", expanding.expand(At("", -1, -1)))
+        self.assertEqual("!", expanding._reader.get())
+
+    def test_expand_max_depth(self):
+        expanding = Expansion(Reader(StringIO("{A|${A|${A|x}}}")), EnvironmentVariable({}), max_depth=2)
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: <UNKNOWN>:1:8"):
+            expanding.expand(At("", -1, -1))
+        expanding = Expansion(Reader(StringIO("((((1))))")), EnvironmentVariable({}), max_depth=2)
+        with self.assertRaisesRegex(Exception, "Parentheses nested deeper than 2 levels at: <UNKNOWN>:1:4"):
+            expanding.expand(At("", -1, -1))
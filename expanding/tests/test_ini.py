@@ -0,0 +1,231 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+from io import StringIO
+from expanding.ini import ini_events, parse_ini, LazyIni, LiveIni, SectionIndex
+from expanding.source import Reader
+from expanding.variable import EnvironmentVariable, CachingVariable, ChainVariable
+
+
+class TestIni(TestCase):
+
+    def setUp(self):
+        environ = mock.patch.dict(os.environ, {"X": "x"})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def events(self, text, **kwargs):
+        return [(section, key, value, str(at))
+                for (section, key, value, at) in ini_events(Reader(StringIO(text), **kwargs))]
+
+    def test_plain_lines(self):
+        self.assertEqual([("", "a", "1", "<UNKNOWN>:2:2"),
+                          ("s", "b", "2", "<UNKNOWN>:5:1")],
+                         self.events("# comment\n a = 1 \n\n[s]\nb=2"))
+
+    def test_expanded_lines(self):
+        self.assertEqual([("", "a", "x", "<UNKNOWN>:1:1"),
+                          ("", "b", "-x-", "<UNKNOWN>:2:3"),
+                          ("s", "c", "1", "<UNKNOWN>:4:1")],
+                         self.events("a=$X\n  b = \"-${X}-\"\n[s]\nc='1'\n"))
+
+    def test_untracked(self):
+        self.assertEqual([("", "a", "1", "<UNKNOWN>"),
+                          ("", "b", "x", "<UNKNOWN>")],
+                         self.events("a=1\nb=$X\n", track_location=False))
+
+    def test_errors(self):
+        with self.assertRaisesRegex(SyntaxError, "Unexpected input: `a' at: <UNKNOWN>:2:1"):
+            self.events("a=1\na b\n")
+        with self.assertRaisesRegex(SyntaxError, "Unexpected input: `a' at: <UNKNOWN>:1:1"):
+            self.events("a=1 # no newline token\nc=2\n")
+        with self.assertRaisesRegex(SyntaxError, "variable `a' is already set at: <UNKNOWN>:2:1"):
+            parse_ini(Reader(StringIO("a=1\na=2\n")))
+
+    def test_max_depth(self):
+        text = "a = ${A|${A|${A|x}}}\n"
+        self.assertEqual({"": {"a": "x"}}, parse_ini(Reader(StringIO(text)), EnvironmentVariable({})))
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: <UNKNOWN>:1:13"):
+            parse_ini(Reader(StringIO(text)), EnvironmentVariable({}), max_depth=2)
+
+    def test_parse_file(self):
+        (handle, filename) = tempfile.mkstemp(suffix=".ini")
+        try:
+            with os.fdopen(handle, "w") as file:
+                file.write("a=1\n[s]\nb=$X\n[t]\n")
+            self.assertEqual({"": {"a": "1"}, "s": {"b": "x"}}, parse_ini(filename, EnvironmentVariable()))
+        finally:
+            os.unlink(filename)
+
+
+class CountingVariable(EnvironmentVariable):
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.names = []
+
+    def lookup_variable(self, name):
+        self.names.append(name)
+        return super().lookup_variable(name)
+
+
+class TestLazyIni(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "test.ini")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.filename, "w") as file:
+            file.write(content)
+
+    def test_sections(self):
+        self.write("a=1\n[s]\nb=\"\n[not a header]\n\"\n  [t] \nc=2\n[s]\nd=3\n")
+        index = SectionIndex.build(self.filename)
+        self.assertEqual(["", "s", "t"], index.sections())
+        self.assertEqual([(2, 4, 29), (8, 40, 48)], index.ranges("s"))
+        self.write("[s]\n")
+        self.assertEqual(["s"], SectionIndex.build(self.filename).sections())
+        self.write("[s]\n[a]b = 1\n [t] # comment\n")
+        self.assertEqual(["s", "t"], SectionIndex.build(self.filename).sections())
+
+    def test_lazy_loading(self):
+        self.write("[a]\nx=${A}\n[b]\ny=${B}\n[a]\nz=1\n[c]\nbad input\n")
+        variable = CountingVariable({"A": "1", "B": "2"})
+        ini = LazyIni(self.filename, variable, cache_index=False)
+        self.assertEqual(["a", "b", "c"], ini.sections())
+        self.assertEqual({"x": "1", "z": "1"}, ini["a"])
+        self.assertEqual(["A"], variable.names)
+        self.assertTrue("b" in ini)
+        self.assertFalse("d" in ini)
+        with self.assertRaises(KeyError):
+            ini.section("d")
+        with self.assertRaisesRegex(SyntaxError, "Unexpected input: `bad' at: .*test.ini:8:1"):
+            ini.section("c")
+        self.assertEqual({"x": "1", "z": "1"}, ini["a"])
+        self.assertEqual(["A"], variable.names)
+
+    def test_empty_section_parsed_once(self):
+        self.write("[a]\n# comment\n[b]\n")
+        ini = LazyIni(self.filename, EnvironmentVariable({}))
+        self.assertEqual({}, ini["a"])
+        os.unlink(self.filename)
+        self.assertEqual({}, ini["a"])
+
+    def test_same_as_parse(self):
+        self.write("a = 1\r\n[s]\r\nb = \"${X}\n[x]\"\r\n[t]\r\nc = '\u00e6'\r\n")
+        variable = EnvironmentVariable({"X": "x"})
+        ini = LazyIni(self.filename, variable, cache_index=False)
+        self.assertEqual(parse_ini(self.filename, variable), dict((name, ini[name]) for name in ini.sections()))
+
+    def test_error_location(self):
+        self.write("[a]\nx=1\n\n[b]\ny=${NOPE}\n")
+        ini = LazyIni(self.filename, EnvironmentVariable({}), cache_index=False)
+        with self.assertRaisesRegex(Exception, "Cannot resolve variable: NOPE at: .*test.ini:5:3"):
+            ini.section("b")
+
+    def test_max_depth(self):
+        self.write("[s]\na = ${A|${A|${A|x}}}\n")
+        self.assertEqual({"a": "x"}, LazyIni(self.filename, EnvironmentVariable({}))["s"])
+        ini = LazyIni(self.filename, EnvironmentVariable({}), max_depth=2)
+        self.assertEqual(["s"], ini.sections())
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: .*:2:13"):
+            ini.section("s")
+
+    def test_cached_index(self):
+        self.write("[a]\nx=1\n")
+        self.assertEqual(["a"], LazyIni(self.filename).sections())
+        self.assertFalse(os.path.exists(self.filename + ".sections"))
+        self.assertEqual(["a"], LazyIni(self.filename, cache_index=True).sections())
+        self.assertTrue(os.path.exists(self.filename + ".sections"))
+        self.assertEqual(["a"], LazyIni(self.filename, cache_index=True).sections())
+        self.write("[a]\nx=1\n[b]\n")
+        self.assertEqual(["a", "b"], LazyIni(self.filename, cache_index=True).sections())
+        with open(self.filename + ".sections", "wb") as file:
+            file.write(b"garbage")
+        self.assertEqual(["a", "b"], LazyIni(self.filename, cache_index=True).sections())
+        with open(self.filename + ".sections", "rb") as file:
+            self.assertNotEqual(b"garbage", file.read())
+
+
+class TestLiveIni(TestCase):
+
+    TEXT = ("a = $A\n"
+            "[s]\n"
+            "b = \"${B|${A}}-x\"\n"
+            "c = $(($C * 2))\n"
+            "d = plain\n")
+
+    def live(self, env, text=TEXT):
+        return LiveIni(Reader(StringIO(text), "file"), CountingVariable(env))
+
+    def test_values(self):
+        env = {"A": "1", "C": "3"}
+        live = self.live(env)
+        self.assertEqual(parse_ini(Reader(StringIO(self.TEXT)), EnvironmentVariable(env)), live.values())
+        self.assertEqual({"A"}, live.dependencies("", "a"))
+        self.assertEqual({"A", "B"}, live.dependencies("s", "b"))
+        self.assertEqual({"C"}, live.dependencies("s", "c"))
+        self.assertEqual(set(), live.dependencies("s", "d"))
+        with self.assertRaises(KeyError):
+            live.dependencies("s", "e")
+
+    def test_update(self):
+        live = self.live({"A": "1", "C": "3"})
+        variable = CountingVariable({"A": "2", "C": "3"})
+        self.assertEqual([("", "a"), ("s", "b")], live.update(["A"], variable))
+        self.assertEqual(["A", "B", "A"], variable.names)
+        self.assertEqual({"": {"a": "2"}, "s": {"b": "2-x", "c": "6", "d": "plain"}}, live.values())
+        self.assertEqual([], live.update(["C", "X"]))
+        variable = CountingVariable({"A": "2", "B": "b", "C": "3"})
+        self.assertEqual([("s", "b")], live.update(["B"], variable))
+        self.assertEqual("b-x", live.values()["s"]["b"])
+
+    def test_update_caching_variable(self):
+        env = {"A": "1", "B": "b", "C": "3"}
+        for variable in [CachingVariable(EnvironmentVariable(env)), ChainVariable(EnvironmentVariable(env))]:
+            env.update(A="1", C="3")
+            live = LiveIni(Reader(StringIO(self.TEXT), "file"), variable)
+            env["A"] = "2"
+            self.assertEqual([("", "a")], live.update(["A"]))
+            self.assertEqual("2", live.values()[""]["a"])
+            env["C"] = "4"
+            self.assertEqual([("s", "c")], live.update(["C"]))
+            self.assertEqual("8", live.values()["s"]["c"])
+
+    def test_max_depth(self):
+        text = "a = ${A|${A|${A|x}}}\n"
+        self.assertEqual({"": {"a": "x"}}, LiveIni(Reader(StringIO(text)), EnvironmentVariable({})).values())
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: <UNKNOWN>:1:13"):
+            LiveIni(Reader(StringIO(text)), EnvironmentVariable({}), max_depth=2)
+
+    def test_math_syntax_error(self):
+        with self.assertRaisesRegex(Exception, "^Unexpected token: 3 at: file:1:10 expected"):
+            self.live({}, "a = $((1 $(1+2)))\n")
+
+    def test_failed_update(self):
+        live = self.live({"A": "1", "C": "3"})
+        with self.assertRaisesRegex(Exception, "Cannot resolve variable: A at: file:1:5"):
+            live.update(["A"], EnvironmentVariable({"C": "3"}))
+        self.assertEqual("1", live.values()[""]["a"])
+        self.assertEqual([], live.update(["A"]))
+
+    def test_variable_keys(self):
+        text = "[s]\n$K = 1\nb = 2\n"
+        live = self.live({"K": "a"}, text)
+        self.assertEqual({"s": {"a": "1", "b": "2"}}, live.values())
+        self.assertEqual([("s", "a"), ("s", "c")], live.update(["K"], EnvironmentVariable({"K": "c"})))
+        self.assertEqual({"s": {"c": "1", "b": "2"}}, live.values())
+        with self.assertRaisesRegex(SyntaxError, "variable `b' is already set"):
+            live.update(["K"], EnvironmentVariable({"K": "b"}))
+        self.assertEqual({"s": {"c": "1", "b": "2"}}, live.values())
+
+    def test_structural_update_order(self):
+        text = "[s]\na = $V\n$K = 1\nc = $V\nd = 2\n[t]\ne = $V\n"
+        live = self.live({"K": "x", "V": "1"}, text)
+        self.assertEqual([("s", "a"), ("s", "x"), ("s", "y"), ("s", "c"), ("t", "e")],
+                         live.update(["K", "V"], EnvironmentVariable({"K": "y", "V": "2"})))
@@ -2,7 +2,7 @@ from io import StringIO
 from unittest import TestCase
 
 from expanding.expand import Expansion
-from expanding.math import MathTokenizer, MathType
+from expanding.math import MathTokenizer, MathType, MathValue, MathVariable, MathExpr, MathProgram, MathCache
 from expanding.source import Reader, At
 from expanding.variable import EnvironmentVariable
 
@@ -39,3 +39,42 @@ class TestMathTokenizer(TestCase):
         self.assertEqual(None, token.content())
 
 
+class TestMathProgram(TestCase):
+
+    def test_run(self):
+        tree = MathExpr(MathType.SUB, MathExpr(MathType.MUL, MathVariable(0), MathValue(3)),
+                        MathExpr(MathType.DIV, MathVariable(1), MathValue(2)))
+        program = MathProgram(tree)
+        for values in ([1, 2], [-7, 5], [0, -3]):
+            self.assertEqual(tree.get_value(values), program.run(values))
+
+    def test_constant_folding(self):
+        tree = MathExpr(MathType.ADD, MathVariable(0),
+                        MathExpr(MathType.MAX, MathValue(4), MathExpr(MathType.MUL, MathValue(2), MathValue(3))))
+        program = MathProgram(tree)
+        self.assertEqual(3, len(program))
+        self.assertEqual(7, program.run([1]))
+        self.assertEqual(1, len(MathProgram(MathExpr(MathType.SUB, MathValue(0), MathValue(5)))))
+
+    def test_failing_fold_raises_when_run(self):
+        program = MathProgram(MathExpr(MathType.ADD, MathVariable(0), MathExpr(MathType.DIV, MathValue(1), MathValue(0))))
+        self.assertRaises(ZeroDivisionError, program.run, [1])
+
+    def test_deep_tree(self):
+        tree = MathValue(0)
+        for level in range(5000):
+            tree = MathExpr(MathType.ADD, tree, MathVariable(0))
+        self.assertEqual(10000, tree.get_value([2]))
+
+
+class TestMathCache(TestCase):
+
+    def test_least_recently_used_are_dropped(self):
+        cache = MathCache(max_size=2)
+        cache.put("a", (1,))
+        cache.put("b", (2,))
+        self.assertEqual((1,), cache.get("a"))
+        cache.put("c", (3,))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual((1,), cache.get("a"))
+        self.assertEqual(2, len(cache))
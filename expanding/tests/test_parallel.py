@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from expanding.ini import parse_ini
+from expanding.parallel import tokenize_many, parse_ini_many, tokenize_chunks
+from expanding.source import Reader
+from expanding.tokenizer import Tokenizer, TokenWhitespace
+from expanding.variable import EnvironmentVariable
+
+
+def tokens(tokenizer):
+    result = []
+    try:
+        for token in tokenizer:
+            result.append((token.content(), str(token.at())))
+    except Exception as e:
+        result.append(str(e))
+    return result
+
+
+class TestParallel(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for n in range(12):
+            path = os.path.join(self.directory, "%d.ini" % n)
+            with open(path, "w") as file:
+                if n == 5:
+                    file.write("a = 1\nb = $MISSING\n")
+                else:
+                    file.write("[s%d]\nkey = \"${A}-%d\"\n" % (n, n))
+            self.paths.append(path)
+        self.paths.append(os.path.join(self.directory, "missing.ini"))
+        self.variable = EnvironmentVariable({"A": "a"})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tokenize_many(self):
+        results = tokenize_many(self.paths, TokenWhitespace.NEWLINE, "=", self.variable, max_workers=2)
+        self.assertEqual(len(self.paths), len(results))
+        for (path, arrays) in zip(self.paths[:-1], results):
+            tokenizer = Tokenizer(Reader.from_file(path), self.variable, TokenWhitespace.NEWLINE, "=")
+            self.assertEqual(tokens(tokenizer), tokens(arrays.tokenizer()))
+        self.assertIn("Cannot resolve variable: MISSING", str(results[5].error()))
+        self.assertIsInstance(results[-1].error(), FileNotFoundError)
+
+    def test_parse_ini_many(self):
+        results = parse_ini_many(self.paths, self.variable, max_workers=2)
+        self.assertEqual((parse_ini(self.paths[3], self.variable), None), results[3])
+        self.assertEqual({"s0": {"key": "a-0"}}, results[0][0])
+        self.assertIsNone(results[5][0])
+        self.assertIn("Cannot resolve variable: MISSING", str(results[5][1]))
+        self.assertIsInstance(results[-1][1], FileNotFoundError)
+
+    def test_max_depth(self):
+        with open(self.paths[0], "w") as file:
+            file.write("a = ${B|${B|${B|x}}}\n")
+        arrays = tokenize_many(self.paths[:1], variable=self.variable, max_workers=1, max_depth=2)[0]
+        self.assertIn("Expansions nested deeper than 2 levels", str(arrays.error()))
+        (values, error) = parse_ini_many(self.paths[:1], self.variable, max_workers=1, max_depth=2)[0]
+        self.assertIn("Expansions nested deeper than 2 levels", str(error))
+        self.assertEqual(({"": {"a": "x"}}, None), parse_ini_many(self.paths[:1], self.variable, max_workers=1)[0])
+
+    def test_in_process(self):
+        results = tokenize_many(self.paths[:2], variable=self.variable, max_workers=1)
+        self.assertEqual(["[s0]", "[s1]"], [str(next(arrays.tokens()).content()).join("[]") for arrays in results])
+
+
+class TestChunks(TestCase):
+
+    def setUp(self):
+        (handle, self.filename) = tempfile.mkstemp(suffix=".ini")
+        with os.fdopen(handle, "w") as file:
+            file.write("a = 1\n# comment\n")
+            for n in range(20):
+                file.write("  [s%d]\nkey = \"${A}-%d\n[not a header]\"\n# [comment]\n" % (n, n))
+        self.variable = EnvironmentVariable({"A": "a"})
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def serial(self, whitespace=TokenWhitespace.NEWLINE, track_location=True):
+        reader = Reader.from_file(self.filename, track_location=track_location)
+        return tokens(Tokenizer(reader, self.variable, whitespace, "="))
+
+    def test_same_tokens(self):
+        for whitespace in TokenWhitespace:
+            arrays = tokenize_chunks(self.filename, whitespace, "=", self.variable, chunk_size=1, max_workers=1)
+            self.assertEqual(self.serial(whitespace), tokens(arrays.tokenizer()))
+
+    def test_pool(self):
+        arrays = tokenize_chunks(self.filename, variable=self.variable, chunk_size=100, max_workers=2)
+        self.assertEqual(self.serial(), tokens(arrays.tokenizer()))
+
+    def test_error(self):
+        with open(self.filename, "a") as file:
+            file.write("[t]\nb = $MISSING\n[u]\nc = 1\n")
+        for track_location in (True, False):
+            arrays = tokenize_chunks(self.filename, variable=self.variable, track_location=track_location,
+                                     chunk_size=1, max_workers=1)
+            self.assertEqual(self.serial(track_location=track_location), tokens(arrays.tokenizer()))
+        self.assertRegex(str(arrays.error()), "Cannot resolve variable: MISSING at: .*\\.ini$")
+
+    def test_max_depth(self):
+        with open(self.filename, "a") as file:
+            file.write("[t]\nb = ${B|${B|${B|x}}}\n")
+        arrays = tokenize_chunks(self.filename, variable=self.variable, chunk_size=1, max_workers=1, max_depth=2)
+        self.assertRegex(str(arrays.error()), "Expansions nested deeper than 2 levels at: .*\\.ini:84:13$")
@@ -0,0 +1,79 @@
+from unittest import TestCase
+from io import StringIO
+
+from expanding.session import TokenizerSession
+from expanding.source import Reader
+from expanding.tokenizer import Tokenizer, TokenWhitespace, TokenEngine
+from expanding.variable import EnvironmentVariable
+
+
+def tokens(tokenizer):
+    result = []
+    try:
+        for token in tokenizer:
+            result.append((token.content(), str(token.at())))
+    except Exception as e:
+        result.append(str(e))
+    return result
+
+
+class TestTokenizerSession(TestCase):
+
+    def setUp(self):
+        self.variable = EnvironmentVariable({"A": "a"})
+
+    def full(self, session, whitespace=TokenWhitespace.NEWLINE):
+        reader = Reader(StringIO(session.text()))
+        return tokens(Tokenizer(reader, self.variable, whitespace, "=", TokenEngine.CHARACTER))
+
+    def test_edit_line(self):
+        session = TokenizerSession("[s]\na = 1\nb = $A\nc = 3\n", self.variable)
+        self.assertEqual((3, 3), session.edit(3, 3, "b = \"${A}${A}\"\n"))
+        self.assertEqual("[s]\na = 1\nb = \"${A}${A}\"\nc = 3\n", session.text())
+        self.assertEqual(self.full(session), tokens(session.tokens()))
+        self.assertIn(("aa", "<UNKNOWN>:3:5"), tokens(session.tokens()))
+
+    def test_insert_and_delete(self):
+        session = TokenizerSession("a = 1\nb = 2\n", self.variable)
+        self.assertEqual((1, 2), session.edit(1, 0, "x = 0\ny = 0\n"))
+        self.assertEqual(self.full(session), tokens(session.tokens()))
+        self.assertEqual(("b", "<UNKNOWN>:4:1"), tokens(session.tokens())[-4])
+        session.edit(2, 3, "")
+        self.assertEqual("x = 0\nb = 2\n", session.text())
+        self.assertEqual(self.full(session), tokens(session.tokens()))
+        session.edit(3, 2, "c = 3")
+        self.assertEqual(self.full(session), tokens(session.tokens()))
+        session.edit(4, 3, "4\n")
+        self.assertEqual("x = 0\nb = 2\nc = 34\n", session.text())
+
+    def test_multi_line_tokens(self):
+        session = TokenizerSession("a = \"1\n2\n3\"\nb = 2\n", self.variable, TokenWhitespace.WHITESPACE)
+        (first, last) = session.edit(2, 2, "[x]\n")
+        self.assertEqual(1, first)
+        self.assertEqual(self.full(session, TokenWhitespace.WHITESPACE), tokens(session.tokens()))
+        session.edit(5, 4, "  \n")  # Whitespace before b, joins the newline before it
+        self.assertEqual(self.full(session, TokenWhitespace.WHITESPACE), tokens(session.tokens()))
+
+    def test_errors(self):
+        session = TokenizerSession("a = 1\nb = 2\nc = 3\n", self.variable)
+        session.edit(2, 2, "b = \"2\n")
+        self.assertEqual(["Unexpected EOF in double quote starting at: <UNKNOWN>:2:5"], tokens(session.tokens())[-1:])
+        self.assertIsNotNone(session.error())
+        session.edit(1, 0, "\n")
+        self.assertEqual(["Unexpected EOF in double quote starting at: <UNKNOWN>:3:5"], tokens(session.tokens())[-1:])
+        session.edit(3, 3, "b = \"2\"\n")
+        self.assertIsNone(session.error())
+        self.assertEqual(self.full(session), tokens(session.tokens()))
+        with self.assertRaises(Exception):
+            session.edit(3, 7, "")
+
+    def test_max_depth(self):
+        session = TokenizerSession("a = 1\nb = ${A|${A|${A|x}}}\n", self.variable, max_depth=2)
+        self.assertEqual("Expansions nested deeper than 2 levels at: <UNKNOWN>:2:13", str(session.error()))
+        self.assertEqual((2, 2), session.edit(2, 2, "b = ${A|${A|x}}\n"))
+        self.assertIsNone(session.error())
+
+    def test_retokenize(self):
+        session = TokenizerSession("a = $A\n", self.variable)
+        session.retokenize(EnvironmentVariable({"A": "b"}))
+        self.assertEqual(["a", "=", "b", "\n"], [token.content() for token in session.tokenizer().tokens()])
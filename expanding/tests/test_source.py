@@ -1,3 +1,6 @@
+import os
+import re
+import tempfile
 from unittest import TestCase
 from io import StringIO
 import expanding.source as source
@@ -37,6 +40,79 @@ class TestReader(TestCase):
         reader.unget()  # \n
         self.assertRaises(BufferError, reader.unget)  # fail
 
+    def test_position(self):
+        reader = source.Reader(StringIO("One\nTwo"), name="file")
+        reader.get()
+        reader.get()
+        reader.get()
+        reader.get()
+        position = reader.position()
+        self.assertEqual("file:2:1", str(reader.locate(position)))
+        self.assertEqual("file:2:1", str(source.At.from_position("file", source.At.pack(2, 1))))
+        reader.get()
+        self.assertEqual("file:2:1", str(reader.locate(position)))
+        self.assertEqual("file:2:2", str(reader.at()))
+        while reader.get() is not None:
+            pass
+        self.assertEqual("file:EOF", str(reader.locate(reader.position())))
+
+    def test_first_line(self):
+        reader = source.Reader(StringIO("One\nTwo"), name="file", first_line=10)
+        self.assertEqual("file:10:1", str(reader.at()))
+        reader.skip_line()
+        self.assertEqual(11, source.At.line_of(reader.position()))
+
+    def test_position_untracked(self):
+        reader = source.Reader(StringIO("One\nTwo"), name="file", track_location=False)
+        reader.get()
+        self.assertEqual(None, reader.position())
+        self.assertEqual("file", str(reader.at()))
+
+    def test_read_while(self):
+        reader = source.Reader(StringIO("abc  \n  \n def"))
+        self.assertEqual("abc", reader.read_while(re.compile('[a-z]*')))
+        self.assertEqual("", reader.read_while(re.compile('[a-z]*')))
+        self.assertEqual("  \n  \n ", reader.read_while(re.compile('\\s*')))
+        self.assertEqual("<UNKNOWN>:3:2", str(reader.at()))
+        self.assertEqual("def", reader.read_while(re.compile('[a-z]*')))
+        self.assertTrue(reader.eof())
+        reader.unget()
+        self.assertEqual("f", reader.get())
+
+    def test_read_until(self):
+        reader = source.Reader(StringIO("ab'c\nd'"))
+        self.assertEqual("ab", reader.read_until("'"))
+        self.assertEqual("'", reader.get())
+        self.assertEqual("c\nd", reader.read_until("'"))
+        self.assertEqual("'", reader.get())
+        self.assertEqual("", reader.read_until("'"))
+        self.assertEqual(None, reader.get())
+
+    def test_skip_line(self):
+        reader = source.Reader(StringIO("# comment\nnext"))
+        reader.get()
+        reader.skip_line()
+        self.assertEqual("<UNKNOWN>:2:1", str(reader.at()))
+        reader.unget()
+        self.assertEqual("\n", reader.get())
+        reader.skip_line()
+        self.assertTrue(reader.eof())
+
+    def test_column(self):
+        reader = source.Reader(StringIO("ab(c)\nd"), track_location=False)
+        reader.get()
+        self.assertEqual(1, reader.column())
+        self.assertEqual("ab(c)\n", reader.line_text())
+        match = reader.match_ahead(re.compile('b\\(c\\)'))
+        self.assertEqual((1, 5), match.span())
+        self.assertEqual(1, reader.column())  # Nothing is consumed
+        reader.skip(5)
+        self.assertEqual(0, reader.column())
+        self.assertEqual("d", reader.line_text())
+        reader.get()
+        self.assertEqual(1, reader.column())  # End of file
+        self.assertEqual(None, reader.match_ahead(re.compile('')))
+
     def test_get_quoted(self):
         reader = source.Reader(StringIO("\\n\\r\\t\\u0040\\040\\$"))
         self.assertEqual("\\", reader.get())
@@ -51,3 +127,38 @@ class TestReader(TestCase):
         self.assertEqual(" ", reader.get_quoted())
         self.assertEqual("\\", reader.get())
         self.assertEqual("$", reader.get_quoted())
+
+
+class TestMappedFile(TestCase):
+
+    def _write(self, content):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_readline(self):
+        mapped = source.MappedFile(self._write(b"One\r\nTw\xc3\xb8\nThree"), encoding='utf-8')
+        self.assertEqual("One\n", mapped.readline())
+        self.assertEqual("Twø\n", mapped.readline())
+        self.assertEqual("Three", mapped.readline())
+        self.assertEqual("", mapped.readline())
+        self.assertEqual("", mapped.readline())
+
+    def test_lone_carriage_return(self):
+        mapped = source.MappedFile(self._write(b"One\rTwo\r\nThree\r"))
+        self.assertEqual("One\rTwo\n", mapped.readline())
+        self.assertEqual("Three\r", mapped.readline())
+        self.assertEqual("", mapped.readline())
+
+    def test_empty_file(self):
+        mapped = source.MappedFile(self._write(b""))
+        self.assertEqual("", mapped.readline())
+
+    def test_reader_from_file(self):
+        path = self._write(b"One\nTwo\n")
+        reader = source.Reader.from_file(path)
+        self.assertIsInstance(reader._source, source.MappedFile)
+        self.assertEqual('O', reader.get())
+        self.assertEqual("%s:1:2" % path, str(reader.at()))
@@ -0,0 +1,160 @@
+import os
+import tempfile
+from io import StringIO
+from unittest import TestCase
+
+from expanding.source import Reader
+from expanding.template import Template, prefetch_tokenizer, scan
+from expanding.tokenizer import Tokenizer, TokenType, TokenWhitespace
+from expanding.variable import EnvironmentVariable
+
+
+def make_template(text, whitespace=TokenWhitespace.NEWLINE):
+    return Template(Reader(StringIO(text)), EnvironmentVariable({}), whitespace=whitespace)
+
+
+def render(template, **kwargs):
+    return [(token.content(), str(token.at())) for token in template.tokens(EnvironmentVariable(kwargs))]
+
+
+def direct(text, whitespace=TokenWhitespace.NEWLINE, **kwargs):
+    tokenizer = Tokenizer(Reader(StringIO(text)), EnvironmentVariable(kwargs), whitespace=whitespace)
+    return [(token.content(), str(token.at())) for token in tokenizer.tokens()]
+
+
+class TestTemplate(TestCase):
+
+    def test_render_many(self):
+        text = 'a = $A\nb = "-${B:xml|none}-" \'$C\'\nc = $( $A * (2 + ${C|3}) )\n'
+        template = make_template(text)
+        for env in [dict(A="1", B="<"), dict(A="2"), dict(A="-3", B="4", C="-5")]:
+            self.assertEqual(direct(text, **env), render(template, **env))
+        self.assertEqual([('a', '<UNKNOWN>:1:1'), ('=', '<UNKNOWN>:1:3'), ('2', '<UNKNOWN>:1:5'),
+                          ("\n", '<UNKNOWN>:1:7')],
+                         render(template, A="2")[:4])
+
+    def test_render_errors(self):
+        template = make_template('a = $A\nb = $(1 + $B)\n')
+        with self.assertRaisesRegex(Exception, "Cannot resolve variable: A at: <UNKNOWN>:1:5"):
+            render(template)
+        with self.assertRaisesRegex(Exception, "Expansion at: <UNKNOWN>:2:11 does not resolve to a number"):
+            render(template, A="1", B="x")
+        self.assertEqual('3', render(template, A="1", B="2")[-2][0])
+
+    def test_render_deeply_nested(self):
+        text = 'a = ' + '${A|' * 5000 + '$B' + '}' * 5000 + '\nb = $(' + '(' * 5000 + '$B' + '+1)' * 5000 + ')\n' + \
+               'c = ' + '$(' * 5000 + '$B' + ')' * 5000 + '\n'
+        template = make_template(text)
+        self.assertEqual(['2', '5002', '2'], [content for (content, at) in render(template, B="2")[2::4]])
+
+    def test_syntax_error(self):
+        template = make_template('a = 1\nb = ${A\n')
+        tokenizer = template.tokenizer(EnvironmentVariable({}))
+        self.assertIsNotNone(tokenizer.tokens_are(TokenType.WORD, TokenType.EQ, TokenType.TEXT, TokenType.NEWLINE,
+                                                  TokenType.WORD, TokenType.EQ))
+        with self.assertRaisesRegex(Exception, "Expected '}' in variable: A at: <UNKNOWN>:2:8 got"):
+            tokenizer.peek_token()
+
+    def test_math_syntax_error(self):
+        for (text, message) in [('a = $(($A ${B|1}))\n', "^Unexpected token: 1 at: <UNKNOWN>:1:11 expected"),
+                                ('a = $((1 $(1+2)))\n', "^Unexpected token: 3 at: <UNKNOWN>:1:10 expected"),
+                                ('a = $((1 ${B|-0x10}))\n', "^Unexpected token: -0x10 at: <UNKNOWN>:1:10 expected"),
+                                ('a = $(($A x))\n', "^x is not a number at: <UNKNOWN>:1:11$"),
+                                ('a = $((1) x)\n', "^x is not a number at: <UNKNOWN>:1:11$"),
+                                ('a = $((1 $C))\n', "^Expansion at: <UNKNOWN>:1:10 does not resolve to a number$")]:
+            with self.assertRaisesRegex(Exception, message):
+                direct(text, A="1", C="x")
+            with self.assertRaisesRegex(Exception, message):
+                render(make_template(text), A="1", C="x")
+        with self.assertRaisesRegex(Exception, "^Unexpected token: \\$\\(1\\+2\\) at: <UNKNOWN>:1:10"):
+            make_template('a = $((1 $(1+2)))\n').references()  # Not rendered, the source text
+
+    def test_max_depth(self):
+        template = Template(Reader(StringIO('a = $((((1))))\n')), EnvironmentVariable({}), max_depth=2)
+        with self.assertRaisesRegex(Exception, "Parentheses nested deeper than 2 levels at: <UNKNOWN>:1:9"):
+            render(template)
+
+    def test_replay_eof(self):
+        tokenizer = make_template('a').tokenizer()
+        self.assertTrue(tokenizer.tokens_are(TokenType.TEXT))
+        self.assertTrue(tokenizer.is_eof())
+        self.assertTrue(tokenizer.peek_token(3).is_a(TokenType.EOF))
+
+
+class BatchVariable(EnvironmentVariable):
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.calls = []
+
+    def lookup_variable(self, name):
+        self.calls.append(name)
+        return super().lookup_variable(name)
+
+    def lookup_many(self, names):
+        self.calls.append(list(names))
+        return dict((name, super(BatchVariable, self).lookup_variable(name)) for name in names)
+
+
+class TestPrefetch(TestCase):
+
+    def test_names(self):
+        template = make_template('a = $A "${B|$C}" $( $D * ${A:s} )\n')
+        self.assertEqual(["A", "B", "C", "D"], template.names())
+
+    def test_prefetch_tokenizer(self):
+        text = 'a = $A\nb = ${B|$C}\nc = $( $A * 2 )\nd = $A\n'
+        variable = BatchVariable(dict(A="3", C="c"))
+        tokenizer = prefetch_tokenizer(Reader(StringIO(text)), variable)
+        self.assertEqual(direct(text, A="3", C="c"), [(token.content(), str(token.at())) for token in tokenizer])
+        self.assertEqual([["A", "B", "C"]], variable.calls)
+
+    def test_prefetch_tokenizer_max_depth(self):
+        text = "a = ${A|${A|${A|x}}}\n"
+        tokenizer = prefetch_tokenizer(Reader(StringIO(text)), BatchVariable({}), max_depth=2)
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: <UNKNOWN>:1:13"):
+            list(tokenizer)
+
+
+class TestScan(TestCase):
+
+    def test_scan(self):
+        text = "# $COMMENT\na = ${A:xml,sql|$B}\nb = '$QUOTED' \"$C\"\n[$SECTION]\nc = $( 2 * $D )\n"
+        self.assertEqual(["{A,<UNKNOWN>:2:5,xml,sql,True}", "{B,<UNKNOWN>:2:17,,False}",
+                          "{C,<UNKNOWN>:3:16,,False}", "{D,<UNKNOWN>:5:12,,False}"],
+                         [str(reference) for reference in scan(Reader(StringIO(text)))])
+
+    def test_scan_file(self):
+        (handle, filename) = tempfile.mkstemp(suffix=".ini")
+        try:
+            with os.fdopen(handle, "w") as file:
+                file.write("a = 1\n")
+            self.assertEqual([], scan(filename))
+            with open(filename, "w") as file:
+                file.write("a = 1\r\nb = ${B:ms}\n")
+            references = scan(filename)
+            self.assertEqual(["B"], [reference.name() for reference in references])
+            self.assertEqual(["ms"], references[0].modifiers())
+            self.assertFalse(references[0].has_default())
+            self.assertEqual("%s:2:5" % filename, str(references[0].at()))
+            with open(filename, "w") as file:
+                file.write("[broken\n")
+            self.assertEqual([], scan(filename))  # Not tokenized
+            with self.assertRaisesRegex(Exception, "Whitespace is not allowed in section"):
+                scan(Reader.from_file(filename))
+            with open(filename, "w", newline="") as file:
+                file.write("a = ${A\r\n}\r\n")
+            with self.assertRaisesRegex(Exception, "Expected '}' in variable: A at: .*:1:8 got \n"):
+                scan(filename)
+        finally:
+            os.unlink(filename)
+
+    def test_scan_max_depth(self):
+        text = "a = ${A|${A|${A|x}}}\n"
+        self.assertEqual(3, len(scan(Reader(StringIO(text)))))
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: <UNKNOWN>:1:13"):
+            scan(Reader(StringIO(text)), max_depth=2)
+
+    def test_scan_syntax_error(self):
+        with self.assertRaisesRegex(Exception, "Unknown quote: 'bad' at: <UNKNOWN>:1:5"):
+            scan(Reader(StringIO("${A:bad}")))
@@ -1,3 +1,4 @@
+import pickle
 from io import StringIO
 from unittest import TestCase
 
@@ -8,8 +9,8 @@ from expanding.variable import EnvironmentVariable
 at = At("Unknown", 1, 2)
 
 
-def make_tokenizer(text, whitespace=TokenWhitespace.NEWLINE, **kwargs):
-    return Tokenizer(Reader(StringIO(text)), EnvironmentVariable(kwargs), whitespace=whitespace)
+def make_tokenizer(text, whitespace=TokenWhitespace.NEWLINE, engine=TokenEngine.CHARACTER, **kwargs):
+    return Tokenizer(Reader(StringIO(text)), EnvironmentVariable(kwargs), whitespace=whitespace, engine=engine)
 
 
 class TestToken(TestCase):
@@ -25,50 +26,93 @@ class TestToken(TestCase):
         self.assertEqual(False, token.is_a(TokenType.NUMBER))
         self.assertEqual(False, token.is_a(TokenType.WORD))
 
+    def test_is_a_synthetic(self):
+        self.assertTrue(Token(at, TokenType.NEWLINE, "\n").is_a(TokenType.EOL))
+        self.assertTrue(Token(at, TokenType.NEWLINE, "\n").is_a(TokenType.ANY_WHITESPACE))
+        self.assertTrue(Token(at, TokenType.EOF, "").is_a(TokenType.EOL))
+        self.assertFalse(Token(at, TokenType.EOF, "").is_a(TokenType.ANY_WHITESPACE))
+        self.assertTrue(Token(at, TokenType.EQ, "=").is_a(TokenType.ANY))
+        self.assertFalse(Token(at, TokenType.EQ, "=").is_a(TokenType.WORD))
+        self.assertFalse(Token(at, TokenType.EQ, "=").is_a(TokenType.OPTIONAL))
+
+    def test_value(self):
+        self.assertEqual(123, Token(at, TokenType.TEXT, "123").value())
+        self.assertEqual(-31, Token(at, TokenType.TEXT, "-0x1f").value())
+        self.assertEqual(15, Token(at, TokenType.TEXT, "017").value())
+        self.assertEqual(0, Token(at, TokenType.TEXT, "0").value())
+        self.assertEqual(None, Token(at, TokenType.TEXT, "1A3").value())
+        self.assertEqual(None, Token(at, TokenType.SECTION, "123").value())
+        self.assertFalse(hasattr(Token(at, TokenType.TEXT, "123"), '__dict__'))
+
+    def test_at_from_position(self):
+        token = Token(At.pack(3, 4), TokenType.TEXT, "123", "file")
+        self.assertEqual("file:3:4", str(token.at()))
+        self.assertIs(at, Token(at, TokenType.TEXT, "123").at())
+
 
 class TestTokenizer(TestCase):
+    engine = TokenEngine.CHARACTER
+
+    def make_tokenizer(self, text, whitespace=TokenWhitespace.NEWLINE, **kwargs):
+        return make_tokenizer(text, whitespace=whitespace, engine=self.engine, **kwargs)
+
 
     def test_tokens_are_word(self):
-        self.assertTrue(make_tokenizer("abc \n").tokens_are(TokenType.TEXT))
-        self.assertTrue(make_tokenizer("abc \n").tokens_are(TokenType.WORD))
+        self.assertTrue(self.make_tokenizer("abc \n").tokens_are(TokenType.TEXT))
+        self.assertTrue(self.make_tokenizer("abc \n").tokens_are(TokenType.WORD))
 
     def test_tokens_are_single_quote(self):
-        self.assertTrue(make_tokenizer("'abc' \n").tokens_are(TokenType.TEXT))
-        self.assertTrue(make_tokenizer("'abc' \n").tokens_are(TokenType.WORD))
+        self.assertTrue(self.make_tokenizer("'abc' \n").tokens_are(TokenType.TEXT))
+        self.assertTrue(self.make_tokenizer("'abc' \n").tokens_are(TokenType.WORD))
 
     def test_tokens_are_expanded(self):
         output = []
-        self.assertTrue(make_tokenizer(" $FOO ", FOO="a b").tokens_are(TokenType.TEXT, output=output))
+        self.assertTrue(self.make_tokenizer(" $FOO ", FOO="a b").tokens_are(TokenType.TEXT, output=output))
         self.assertEqual(1, len(output))
         self.assertEqual("a b", output[0].content())
 
     def test_tokens_are_double_quote(self):
-        self.assertTrue(make_tokenizer('"abc"').tokens_are(TokenType.TEXT))
-        self.assertTrue(make_tokenizer('"abc"').tokens_are(TokenType.WORD))
+        self.assertTrue(self.make_tokenizer('"abc"').tokens_are(TokenType.TEXT))
+        self.assertTrue(self.make_tokenizer('"abc"').tokens_are(TokenType.WORD))
 
     def test_tokens_are_double_quote_expanded(self):
         output = []
-        self.assertTrue(make_tokenizer('foo = "abc $($ID) def"\n', ID="123")
+        self.assertTrue(self.make_tokenizer('foo = "abc $($ID) def"\n', ID="123")
                         .tokens_are(TokenType.WORD, TokenType.EQ, TokenType.TEXT, TokenType.NEWLINE, output=output))
         self.assertEqual("abc 123 def", output[2].content())
-        tokenizer = make_tokenizer('')
+        tokenizer = self.make_tokenizer('')
         self.assertTrue(tokenizer.tokens_are(TokenType.EOF))
         self.assertTrue(tokenizer.tokens_are(TokenType.EOF))
         self.assertTrue(tokenizer.is_eof())
 
     def test_tokens_are_section_and_comment(self):
         output = []
-        self.assertTrue(make_tokenizer('; bah \n[fool] #abc\n  \n', ID="123")
+        self.assertTrue(self.make_tokenizer('; bah \n[fool] #abc\n  \n', ID="123")
                         .tokens_are(TokenType.SECTION, TokenType.NEWLINE, TokenType.EOF, output=output))
         self.assertEqual("fool", output[0].content())
 
     def test_token_eof(self):
-        self.assertRaises(Exception, make_tokenizer('[fool').tokens_are, TokenType.SECTION)
-        self.assertRaises(Exception, make_tokenizer('\'fool').tokens_are, TokenType.TEXT)
-        self.assertRaises(Exception, make_tokenizer('"fool').tokens_are, TokenType.TEXT)
+        self.assertRaises(Exception, self.make_tokenizer('[fool').tokens_are, TokenType.SECTION)
+        self.assertRaises(Exception, self.make_tokenizer('\'fool').tokens_are, TokenType.TEXT)
+        self.assertRaises(Exception, self.make_tokenizer('"fool').tokens_are, TokenType.TEXT)
+
+    def test_token_locations(self):
+        output = []
+        self.assertTrue(self.make_tokenizer("a\n  b $X", X="x").tokens_are(TokenType.TEXT, TokenType.NEWLINE, TokenType.TEXT,
+                                                                     TokenType.TEXT, TokenType.EOF, output=output))
+        self.assertEqual(["<UNKNOWN>:1:1", "<UNKNOWN>:1:2", "<UNKNOWN>:2:3", "<UNKNOWN>:2:5", "<UNKNOWN>:EOF"],
+                         [str(token.at()) for token in output])
+        with self.assertRaisesRegex(Exception, "at: <UNKNOWN>:2:3"):
+            self.make_tokenizer("\n  [a b]").tokens_are(TokenType.NEWLINE, TokenType.SECTION)
+
+    def test_token_locations_untracked(self):
+        tzr = Tokenizer(Reader(StringIO("a\n  b"), name="file", track_location=False), engine=self.engine)
+        output = []
+        self.assertTrue(tzr.tokens_are(TokenType.TEXT, TokenType.NEWLINE, TokenType.TEXT, output=output))
+        self.assertEqual(["file", "file", "file"], [str(token.at()) for token in output])
 
     def test_whitespace_none(self):
-        tzr = make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.NONE)
+        tzr = self.make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.NONE)
         output = []
 
         self.assertTrue(tzr.tokens_are(TokenType.TEXT, output=output))
@@ -77,7 +121,7 @@ class TestTokenizer(TestCase):
         self.assertTrue(tzr.tokens_are(TokenType.TEXT, TokenType.EOF))
 
     def test_whitespace_newline(self):
-        tzr = make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.NEWLINE)
+        tzr = self.make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.NEWLINE)
         output = []
         self.assertTrue(tzr.tokens_are(TokenType.NEWLINE, TokenType.TEXT, output=output))
         self.assertEqual(2, len(output))
@@ -85,7 +129,7 @@ class TestTokenizer(TestCase):
         self.assertTrue(tzr.tokens_are(TokenType.TEXT, TokenType.EOF))
 
     def test_whitespace_newline_match_optional_whitespace(self):
-        tzr = make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.NEWLINE)
+        tzr = self.make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.NEWLINE)
         output = []
         self.assertTrue(tzr.tokens_are(TokenType.OPTIONAL, TokenType.ANY_WHITESPACE, TokenType.TEXT, output=output))
         self.assertEqual(1, len(output))
@@ -93,7 +137,7 @@ class TestTokenizer(TestCase):
         self.assertTrue(tzr.tokens_are(TokenType.TEXT, TokenType.EOF))
 
     def test_whitespace_whitespace(self):
-        tzr = make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.WHITESPACE)
+        tzr = self.make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.WHITESPACE)
         output = []
         self.assertFalse(tzr.tokens_are(TokenType.NEWLINE, TokenType.TEXT, output=output))
         self.assertTrue(tzr.tokens_are(TokenType.WHITESPACE, TokenType.TEXT, output=output))
@@ -102,7 +146,7 @@ class TestTokenizer(TestCase):
         self.assertTrue(tzr.tokens_are(TokenType.OPTIONAL, TokenType.WHITESPACE, TokenType.TEXT, TokenType.EOF))
 
     def test_whitespace_both(self):
-        tzr = make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.BOTH)
+        tzr = self.make_tokenizer("  \n   foo bar", whitespace=TokenWhitespace.BOTH)
         output = []
         self.assertFalse(tzr.tokens_are(TokenType.NEWLINE, TokenType.TEXT, output=output))
         self.assertTrue(tzr.tokens_are(TokenType.WHITESPACE, TokenType.NEWLINE, TokenType.WHITESPACE, TokenType.TEXT, output=output))
@@ -111,16 +155,181 @@ class TestTokenizer(TestCase):
         self.assertTrue(tzr.tokens_are(TokenType.OPTIONAL,TokenType.ANY_WHITESPACE, TokenType.TEXT, TokenType.EOF))
 
     def test_whitespace_both_optional(self):
-        tzr = make_tokenizer("  \n   foo'bar'", whitespace=TokenWhitespace.BOTH)
+        tzr = self.make_tokenizer("  \n   foo'bar'", whitespace=TokenWhitespace.BOTH)
         output = []
         self.assertTrue(tzr.tokens_are(TokenType.OPTIONAL, TokenType.ANY_WHITESPACE, TokenType.TEXT, output=output))
         self.assertEqual(1, len(output))
         self.assertEqual("foo", output[0].content())
         self.assertTrue(tzr.tokens_are(TokenType.OPTIONAL, TokenType.ANY_WHITESPACE, TokenType.TEXT, TokenType.EOF))
 
+    def test_peek_token_deep(self):
+        tzr = self.make_tokenizer(" ".join(str(n) for n in range(200)))
+        self.assertEqual("150", tzr.peek_token(150).content())
+        for n in range(199):
+            self.assertEqual(str(n), tzr.peek_token().content())
+            self.assertEqual(str(n + 1), tzr.peek_token(1).content())
+            self.assertTrue(tzr.tokens_are(TokenType.NUMBER))
+        self.assertTrue(tzr.tokens_are(TokenType.NUMBER, TokenType.EOF))
+        self.assertTrue(tzr.peek_token(3).is_a(TokenType.EOF))
+
+    def test_iterate(self):
+        tzr = self.make_tokenizer("a = b\n[c]\n", whitespace=TokenWhitespace.NEWLINE)
+        self.assertEqual(["a", "=", "b", "\n", "c", "\n"], [token.content() for token in tzr])
+        self.assertTrue(tzr.is_eof())
+        self.assertEqual([], list(tzr))
+
+    def test_iterate_after_matching(self):
+        tzr = self.make_tokenizer("a b c d e f g")
+        self.assertTrue(tzr.tokens_are(TokenType.TEXT))
+        self.assertEqual("d", tzr.peek_token(2).content())
+        self.assertEqual(["b", "c"], [token.content() for token in tzr.next_tokens(2)])
+        self.assertTrue(tzr.tokens_are(TokenType.TEXT, TokenType.TEXT))
+        self.assertEqual(["f", "g"], [token.content() for token in tzr.next_tokens(5)])
+        self.assertEqual([], tzr.next_tokens(5))
+        self.assertTrue(tzr.tokens_are(TokenType.EOF))
+
     def test_one_of_matching(self):
-        tzr = Tokenizer(Reader(StringIO(" foo ( bar  ")), single_tokens="{}[]()")
+        tzr = Tokenizer(Reader(StringIO(" foo ( bar  ")), single_tokens="{}[]()", engine=self.engine)
         output = []
         self.assertTrue(tzr.tokens_are(TokenType.WORD, [TokenType.LBRACE, TokenType.LBRACKET, TokenType.LPARENT], TokenType.WORD, output=output))
         self.assertTrue(output[1].is_a(TokenType.LPARENT))
 
+    def test_max_depth(self):
+        tzr = Tokenizer(Reader(StringIO("a ${A|${A|${A|x}}}")), EnvironmentVariable({}), max_depth=2,
+                        engine=self.engine)
+        self.assertTrue(tzr.tokens_are(TokenType.WORD))
+        with self.assertRaisesRegex(Exception, "Expansions nested deeper than 2 levels at: <UNKNOWN>:1:11"):
+            tzr.peek_token()
+
+
+class TestTokenGrammar(TestCase):
+
+    GRAMMAR = TokenGrammar(blank=(TokenType.NEWLINE,),
+                           section=(TokenType.SECTION, TokenType.EOL),
+                           number=(TokenType.WORD, TokenType.EQ, TokenType.NUMBER, TokenType.EOL),
+                           assign=(TokenType.WORD, TokenType.EQ, TokenType.TEXT, TokenType.EOL),
+                           key=(TokenType.WORD, TokenType.EQ, TokenType.OPTIONAL, TokenType.TEXT, TokenType.EOL))
+
+    def test_alternatives(self):
+        tzr = make_tokenizer("[main]\n\na = 12\nb = x\nc = \n")
+        output = []
+        self.assertEqual(("section", output), tzr.tokens_match(self.GRAMMAR, output=output))
+        self.assertEqual("main", output[0].content())
+        self.assertEqual("blank", tzr.tokens_match(self.GRAMMAR)[0])
+        (name, output) = tzr.tokens_match(self.GRAMMAR)
+        self.assertEqual("number", name)
+        self.assertEqual(["a", "=", "12", "\n"], [token.content() for token in output])
+        (name, output) = tzr.tokens_match(self.GRAMMAR)
+        self.assertEqual("assign", name)
+        self.assertEqual("x", output[2].content())
+        (name, output) = tzr.tokens_match(self.GRAMMAR)
+        self.assertEqual("key", name)
+        self.assertEqual(["c", "=", "\n"], [token.content() for token in output])
+        self.assertTrue(tzr.is_eof())
+
+    def test_no_match(self):
+        tzr = make_tokenizer("a = = b\n")
+        self.assertEqual(None, tzr.tokens_match(self.GRAMMAR))
+        self.assertTrue(tzr.tokens_are(TokenType.WORD, TokenType.EQ, TokenType.EQ))
+
+    def test_one_of_and_first_wins(self):
+        grammar = TokenGrammar(('long', (TokenType.TEXT, [TokenType.LPARENT, TokenType.LBRACE], TokenType.TEXT)),
+                               ('short', (TokenType.TEXT,)),
+                               ('never', (TokenType.WORD, TokenType.LPARENT)))
+        tzr = Tokenizer(Reader(StringIO("foo { bar foo (")), single_tokens="{}()")
+        self.assertEqual(['long', 'short', 'never'], grammar.names())
+        self.assertEqual("long", tzr.tokens_match(grammar)[0])
+        self.assertEqual("short", tzr.tokens_match(grammar)[0])
+        self.assertEqual(None, tzr.tokens_match(grammar))
+
+    def test_dangling_optional(self):
+        self.assertRaises(Exception, TokenGrammar, bad=(TokenType.TEXT, TokenType.OPTIONAL))
+
+
+class TestTokenizerRegex(TestTokenizer):
+    """
+    Same cases as TestTokenizer, using the regex engine
+    """
+    engine = TokenEngine.REGEX
+
+
+class TestTokenizerEngines(TestCase):
+
+    INPUTS = [
+        "[section]\nkey = value # comment\n\nother=\"quoted $A\" ; comment\n",
+        "  a\t b\r\n\n  \n'it''s' \"es\\\"caped\" $(1 + $A) ${B|x y}",
+        "[a]b]c [] 'multi\nline' \"multi\nline\" # end",
+        "a=(b){c}[d],e:f;g\n+1-2*3/4%5^6&7<8>9?0!",
+        "   \n\n\t",
+        "",
+    ]
+
+    def tokens(self, text, whitespace, single_tokens, engine):
+        tzr = Tokenizer(Reader(StringIO(text)), EnvironmentVariable({'A': '1'}), whitespace=whitespace,
+                        single_tokens=single_tokens, engine=engine)
+        tokens = []
+        while True:
+            token = tzr.peek_token()
+            tokens.append(str(token))
+            if tzr.is_eof():
+                return tokens
+            tzr.tokens_are(TokenType.ANY)
+
+    def test_same_tokens(self):
+        for text in self.INPUTS:
+            for whitespace in TokenWhitespace:
+                for single_tokens in ("=", "=[]", "".join(Tokenizer._SINGLE_CHARACTER_TOKENS.keys())):
+                    self.assertEqual(self.tokens(text, whitespace, single_tokens, TokenEngine.CHARACTER),
+                                     self.tokens(text, whitespace, single_tokens, TokenEngine.REGEX),
+                                     "%r %s %r" % (text, whitespace, single_tokens))
+
+
+class TestTokenArrays(TestCase):
+
+    def test_replay(self):
+        text = "[s]\na = $A\nb = 'x'\n"
+        arrays = TokenArrays.from_tokenizer(make_tokenizer(text, A="1"))
+        self.assertIsNone(arrays.error())
+        self.assertEqual([(str(token), str(token.at())) for token in make_tokenizer(text, A="1")],
+                         [(str(token), str(token.at())) for token in arrays.tokens()])
+        self.assertTrue(arrays.tokenizer().tokens_are(TokenType.SECTION, TokenType.NEWLINE))
+
+    def test_error(self):
+        arrays = TokenArrays.from_tokenizer(make_tokenizer("a = 1\nb = $A\n"))
+        tokenizer = arrays.tokenizer()
+        self.assertTrue(tokenizer.tokens_are(TokenType.WORD, TokenType.EQ, TokenType.NUMBER, TokenType.EOL,
+                                             TokenType.WORD, TokenType.EQ))
+        with self.assertRaisesRegex(Exception, "Cannot resolve variable: A at: <UNKNOWN>:2:5"):
+            tokenizer.peek_token()
+
+    def test_pickle(self):
+        arrays = TokenArrays.from_tokenizer(make_tokenizer("a = 1\nb = $A\n"))
+        copy = pickle.loads(pickle.dumps(arrays))
+        self.assertEqual(["a", "=", "1", "\n", "b", "="], [token.content() for token in copy.tokenizer().next_tokens(6)])
+        self.assertEqual(str(arrays.error()), str(copy.error()))
+        token = make_tokenizer("abc", A="1").peek_token()
+        self.assertEqual(str(token), str(pickle.loads(pickle.dumps(token))))
+        self.assertEqual(str(token.at()), str(pickle.loads(pickle.dumps(token.at()))))
+
+    def test_dump(self):
+        arrays = TokenArrays.from_tokenizer(make_tokenizer("a = $A\n"))
+        copy = TokenArrays.load("<UNKNOWN>", arrays.dump())
+        self.assertEqual(str(arrays.error()), str(copy.error()))
+        self.assertEqual(len(arrays), len(copy))
+
+    def test_join(self):
+        first = TokenArrays.from_tokenizer(make_tokenizer("a b\n", whitespace=TokenWhitespace.WHITESPACE))
+        reader = Reader(StringIO(" c $A"), first_line=2)
+        second = TokenArrays.from_tokenizer(Tokenizer(reader, EnvironmentVariable({}), TokenWhitespace.WHITESPACE))
+        joined = TokenArrays.join([first, second])
+        self.assertEqual([("a", "<UNKNOWN>:1:1"), (" ", "<UNKNOWN>:1:2"), ("b", "<UNKNOWN>:1:3"),
+                          ("\n ", "<UNKNOWN>:1:4"), ("c", "<UNKNOWN>:2:2"), (" ", "<UNKNOWN>:2:3")],
+                         [(token.content(), str(token.at())) for token in joined.tokenizer().next_tokens(6)])
+        self.assertIn("Cannot resolve variable: A", str(joined.error()))
+        untracked = joined.without_locations().tokenizer()
+        self.assertEqual(["<UNKNOWN>"] * 6, [str(token.at()) for token in untracked.next_tokens(6)])
+        first = TokenArrays.from_tokenizer(make_tokenizer("a\n# comment\n", whitespace=TokenWhitespace.WHITESPACE))
+        reader = Reader(StringIO(" c"), first_line=3)
+        second = TokenArrays.from_tokenizer(Tokenizer(reader, EnvironmentVariable({}), TokenWhitespace.WHITESPACE))
+        joined = TokenArrays.join([first, second])
+        self.assertEqual(["a", "\n", " ", "c"], [token.content() for token in joined.tokens()])
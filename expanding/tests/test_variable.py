@@ -1,8 +1,12 @@
+import threading
 from unittest import TestCase
 from expanding.source import Reader
 from io import StringIO
 
-from expanding.variable import EnvironmentVariable
+from expanding.ini import LiveIni
+from expanding.template import Template
+from expanding.tokenizer import Tokenizer
+from expanding.variable import EnvironmentVariable, ChainVariable, CachingVariable
 
 
 class TestEnvVarReader(TestCase):
@@ -23,3 +27,205 @@ class TestEnvVarReader(TestCase):
         var_reader = EnvironmentVariable(env = {"_ABC123": "abc", "DEF": "fed"})
         self.assertEqual(None, var_reader.lookup_variable("FOO"))
         self.assertEqual("abc", var_reader.lookup_variable("_ABC123"))
+
+    def test_snapshot(self):
+        env = {"A": "a"}
+        var_reader = EnvironmentVariable(env=env, snapshot=True)
+        env["A"] = "b"
+        self.assertEqual("a", var_reader.lookup_variable("A"))
+
+
+class CountingVariable(EnvironmentVariable):
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.lookups = 0
+
+    def lookup_variable(self, name):
+        self.lookups += 1
+        return super().lookup_variable(name)
+
+
+class TestChainVariable(TestCase):
+
+    def test_lookup_variable(self):
+        overrides = CountingVariable({"A": "override"})
+        defaults = CountingVariable({"A": "default", "B": "default"})
+        var_reader = ChainVariable(overrides, defaults)
+        self.assertEqual("override", var_reader.lookup_variable("A"))
+        self.assertEqual("default", var_reader.lookup_variable("B"))
+        self.assertEqual(None, var_reader.lookup_variable("C"))
+        for name in ["A", "B", "C"] * 10:
+            var_reader.lookup_variable(name)
+        self.assertEqual(3, overrides.lookups)
+        self.assertEqual(2, defaults.lookups)
+        var_reader.clear()
+        self.assertEqual("override", var_reader.lookup_variable("A"))
+        self.assertEqual(4, overrides.lookups)
+
+    def test_get_name(self):
+        var_reader = ChainVariable(EnvironmentVariable({}))
+        self.assertEqual("ABC", var_reader.get_name(Reader(StringIO("ABC-"))))
+
+    def test_memo_is_for_one_parse(self):
+        env = {"A": "1"}
+        overrides = CountingVariable(env)
+        var_reader = ChainVariable(overrides)
+
+        def parse():
+            return [token.content() for token in Tokenizer(Reader(StringIO("$A $A $A")), var_reader).tokens()]
+
+        self.assertEqual(["1", "1", "1"], parse())
+        self.assertEqual(1, overrides.lookups)
+        env["A"] = "2"
+        self.assertEqual(["2", "2", "2"], parse())
+        self.assertEqual(2, overrides.lookups)
+
+
+class TestCachingVariable(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.wrapped = CountingVariable({"A": "a", "B": "b", "C": "c"})
+
+    def clock(self):
+        return self.now
+
+    def test_lru(self):
+        var_reader = CachingVariable(self.wrapped, max_size=2, clock=self.clock)
+        for name in ["A", "B", "A", "C", "A", "B"]:
+            var_reader.lookup_variable(name)
+        self.assertEqual(4, self.wrapped.lookups)  # B was dropped by C
+        self.assertEqual({'hits': 2, 'misses': 4, 'size': 2}, var_reader.stats())
+
+    def test_ttl(self):
+        var_reader = CachingVariable(self.wrapped, ttl=10, clock=self.clock)
+        self.assertEqual("a", var_reader.lookup_variable("A"))
+        self.now = 9.0
+        self.assertEqual("a", var_reader.lookup_variable("A"))
+        self.assertEqual(1, self.wrapped.lookups)
+        self.now = 10.0
+        self.assertEqual("a", var_reader.lookup_variable("A"))
+        self.assertEqual(2, self.wrapped.lookups)
+
+    def test_negative(self):
+        var_reader = CachingVariable(self.wrapped, clock=self.clock)
+        self.assertEqual(None, var_reader.lookup_variable("X"))
+        self.assertEqual(None, var_reader.lookup_variable("X"))
+        self.assertEqual(1, self.wrapped.lookups)
+        var_reader = CachingVariable(self.wrapped, negative=False, clock=self.clock)
+        self.assertEqual(None, var_reader.lookup_variable("X"))
+        self.assertEqual(None, var_reader.lookup_variable("X"))
+        self.assertEqual(3, self.wrapped.lookups)
+
+    def test_invalidate(self):
+        var_reader = CachingVariable(self.wrapped, clock=self.clock)
+        var_reader.lookup_variable("A")
+        var_reader.lookup_variable("B")
+        var_reader.invalidate("A")
+        var_reader.lookup_variable("A")
+        var_reader.lookup_variable("B")
+        self.assertEqual(3, self.wrapped.lookups)
+        var_reader.invalidate()
+        self.assertEqual(0, var_reader.stats()['size'])
+
+    def test_forget(self):
+        var_reader = ChainVariable(CachingVariable(self.wrapped, clock=self.clock))
+        var_reader.lookup_variable("A")
+        var_reader.lookup_variable("B")
+        var_reader.forget(["A"])
+        var_reader.lookup_variable("A")
+        var_reader.lookup_variable("B")
+        self.assertEqual(3, self.wrapped.lookups)
+        var_reader.forget()
+        var_reader.lookup_variable("B")
+        self.assertEqual(4, self.wrapped.lookups)
+
+    def test_invalidate_during_lookup(self):
+        var_reader = CachingVariable(self.wrapped, clock=self.clock)
+        lookup_variable = self.wrapped.lookup_variable
+
+        def invalidating_lookup(name):
+            value = lookup_variable(name)
+            var_reader.invalidate(name)
+            return value
+
+        self.wrapped.lookup_variable = invalidating_lookup
+        self.assertEqual("a", var_reader.lookup_variable("A"))
+        self.assertEqual(0, var_reader.stats()['size'])
+
+    def test_threads(self):
+        var_reader = CachingVariable(self.wrapped, max_size=2)
+
+        def lookups():
+            for name in ["A", "B", "C", "X"] * 250:
+                var_reader.lookup_variable(name)
+
+        threads = [threading.Thread(target=lookups) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = var_reader.stats()
+        self.assertEqual(4000, stats['hits'] + stats['misses'])
+        self.assertEqual(2, stats['size'])
+
+
+class TestLookupMany(TestCase):
+
+    def test_chain(self):
+        overrides = CountingVariable({"A": "override"})
+        defaults = CountingVariable({"A": "default", "B": "default"})
+        var_reader = ChainVariable(overrides, defaults)
+        self.assertEqual({"A": "override", "B": "default", "C": None}, var_reader.lookup_many(["A", "B", "C", "A"]))
+        self.assertEqual(3, overrides.lookups)
+        self.assertEqual(2, defaults.lookups)
+        self.assertEqual("default", var_reader.lookup_variable("B"))
+        self.assertEqual(2, defaults.lookups)
+
+    def test_caching(self):
+        wrapped = CountingVariable({"A": "a", "B": "b"})
+        var_reader = CachingVariable(wrapped)
+        self.assertEqual("a", var_reader.lookup_variable("A"))
+        self.assertEqual({"A": "a", "B": "b", "C": None}, var_reader.lookup_many(["A", "B", "C"]))
+        self.assertEqual(3, wrapped.lookups)
+        self.assertEqual({"B": "b", "C": None}, var_reader.lookup_many(["B", "C"]))
+        self.assertEqual(3, wrapped.lookups)
+
+    def test_caching_repeated_names(self):
+        var_reader = CachingVariable(CountingVariable({"A": "a"}))
+        self.assertEqual({"A": "a"}, var_reader.lookup_many(["A", "A"]))
+        self.assertEqual({'hits': 0, 'misses': 1, 'size': 1}, var_reader.stats())
+
+
+class DuckVariable(object):
+    """
+    A resolver that doesn't extend Variable
+    """
+
+    def __init__(self, env):
+        self._env = env
+
+    def get_name(self, reader):
+        return EnvironmentVariable().get_name(reader)
+
+    def lookup_variable(self, name):
+        return self._env.get(name)
+
+
+class TestDuckTyped(TestCase):
+
+    def test_tokenizer(self):
+        for var_reader in (DuckVariable({"A": "2"}), ChainVariable(DuckVariable({"A": "2"})),
+                           CachingVariable(DuckVariable({"A": "2"}))):
+            tokens = Tokenizer(Reader(StringIO("$A $(($A+1)*2)")), var_reader).tokens()
+            self.assertEqual(["2", "6"], [token.content() for token in tokens])
+
+    def test_template(self):
+        template = Template(Reader(StringIO("a = $A\n")))
+        tokens = template.tokenizer(DuckVariable({"A": "1"}), prefetch=True).tokens()
+        self.assertEqual(["a", "=", "1", "\n"], [token.content() for token in tokens])
+
+    def test_live_ini(self):
+        ini = LiveIni(Reader(StringIO("[s]\na = $A\n")), DuckVariable({"A": "1"}))
+        self.assertEqual([("s", "a")], ini.update(["A"], DuckVariable({"A": "2"})))
@@ -1,11 +1,14 @@
+import builtins
+import pickle
 import re
 from enum import Enum
 from io import StringIO
-from typing import TypeVar, List
+from itertools import islice, repeat
+from typing import Iterator, TypeVar, List
 
 from expanding.expand import Expansion
 from expanding.source import Reader, At
-from expanding.variable import EnvironmentVariable, Variable
+from expanding.variable import EnvironmentVariable, Variable, hook
 
 
 class TokenType(Enum):
@@ -61,28 +64,67 @@ class TokenWhitespace(Enum):
     BOTH = 'BOTH' """Produces both newline and whitespace tokens (whitespace will not contain newlines)"""
 
 
+class TokenEngine(Enum):
+    """How does Tokenizer scan the input"""
+    # Could be produced synthetically, but then completion is missing
+    CHARACTER = 'CHARACTER'  # Character by character
+    REGEX = 'REGEX'  # Master regular expression, falling back to character by character for complex constructs
+
+
+# Bit of each token type, in the kinds bit set of a Token
+_TYPE_BIT = dict((token_type, 1 << n) for (n, token_type) in enumerate(TokenType))
+# TEXT token that hasn't been tested for WORD / NUMBER yet
+_UNCLASSIFIED = 1 << len(_TYPE_BIT)
+_CONTENT_BITS = _TYPE_BIT[TokenType.WORD] | _TYPE_BIT[TokenType.NUMBER]
+
+
+def _base_kinds() -> dict:
+    """
+    Kinds bit set of each token type, before looking at content
+
+    :return: dict of type to bit set
+    """
+    kinds = dict((token_type, bit | _TYPE_BIT[TokenType.ANY]) for (token_type, bit) in _TYPE_BIT.items())
+    kinds[TokenType.NEWLINE] |= _TYPE_BIT[TokenType.EOL] | _TYPE_BIT[TokenType.ANY_WHITESPACE]
+    kinds[TokenType.WHITESPACE] |= _TYPE_BIT[TokenType.ANY_WHITESPACE]
+    kinds[TokenType.EOF] |= _TYPE_BIT[TokenType.EOL]
+    kinds[TokenType.TEXT] |= _UNCLASSIFIED
+    return kinds
+
+
 class Token(object):
     """
 Container for a token
 
 Implements location, type and content
 Also has matchers for token types
+
+The (synthetic) types a token matches are kept as a bit set, TEXT content
+is classified as WORD / NUMBER on first query
     """
-    _IS_NUMBER = re.compile('^(?:(?:[-+]?)(?:0[xX][0-9a-fA-F]+)|(?:[1-9][0-9]*)|(?:0[0-7]*))$', re.S | re.U)
+    __slots__ = ('_at', '_token_type', '_content', '_source', '_kinds', '_value')
+
+    _IS_NUMBER = re.compile('^(?:([-+]?0[xX][0-9a-fA-F]+)|([1-9][0-9]*)|(0[0-7]*))$', re.S | re.U)
     _IS_WORD = re.compile('^\\S+$', re.S | re.U)
+    _KINDS = _base_kinds()
 
-    def __init__(self, at: At, token_type: TokenType, content: str) -> TypeVar('Token'):
+    def __init__(self, at: TypeVar('_at', At, int, None), token_type: TokenType, content: str,
+                 source: str = None) -> TypeVar('Token'):
         """
         Token class contructor
 
-        :param at: Location of token
+        :param at: Location of token, an At object or a position from Reader.position()
         :param token_type: type
         :param content: content string
+        :param source: name of input, needed when at is a position
         :returns: new object
         """
         self._at = at
         self._token_type = token_type
         self._content = content
+        self._source = source
+        self._kinds = self._KINDS[token_type]
+        self._value = None
 
     def at(self) -> At:
         """
@@ -90,7 +132,17 @@ Also has matchers for token types
 
         :returns: At object where this token starts
         """
-        return self._at
+        if isinstance(self._at, At):
+            return self._at
+        return At.from_position(self._source, self._at)
+
+    def token_type(self) -> TokenType:
+        """
+        Get the type of the token (not the synthetic types, see is_a())
+
+        :returns: type
+        """
+        return self._token_type
 
     def content(self) -> str:
         """
@@ -100,6 +152,26 @@ Also has matchers for token types
         """
         return self._content
 
+    def value(self) -> TypeVar('_int', int, None):
+        """
+        Get the integer value of a NUMBER token
+
+        :returns: hexadecimal, decimal or octal value of content, None if not a NUMBER
+        """
+        if self._kinds & _UNCLASSIFIED:
+            self._classify()
+        return self._value
+
+    def kinds(self) -> int:
+        """
+        Get the bit set of (synthetic) types this token matches
+
+        :returns: bit set, see TokenGrammar
+        """
+        if self._kinds & _UNCLASSIFIED:
+            self._classify()
+        return self._kinds
+
     def is_a(self, wanted_type: TokenType) -> bool:
         """
         Is the token of a given type
@@ -109,20 +181,165 @@ Also has matchers for token types
         :param wanted_type: type
         :returns: true if type is matched
         """
-        if wanted_type is TokenType.ANY:
-            return True
-        if wanted_type is TokenType.ANY_WHITESPACE:
-            return self._token_type is TokenType.NEWLINE or self._token_type is TokenType.WHITESPACE
-        if wanted_type is TokenType.EOL:
-            return self._token_type is TokenType.NEWLINE or self._token_type is TokenType.EOF
-        if wanted_type is TokenType.NUMBER:
-            return self._token_type is TokenType.TEXT and self._IS_NUMBER.match(self._content) is not None
-        if wanted_type is TokenType.WORD:
-            return self._token_type is TokenType.TEXT and self._IS_WORD.match(self._content) is not None
-        return wanted_type is self._token_type
+        bit = _TYPE_BIT[wanted_type]
+        if bit & _CONTENT_BITS and self._kinds & _UNCLASSIFIED:
+            self._classify()
+        return self._kinds & bit != 0
+
+    def _classify(self) -> None:
+        """
+        Test TEXT content for WORD and NUMBER, and compute the value of a NUMBER
+        """
+        kinds = self._kinds & ~_UNCLASSIFIED
+        if self._IS_WORD.match(self._content) is not None:
+            kinds |= _TYPE_BIT[TokenType.WORD]
+        match = self._IS_NUMBER.match(self._content)
+        if match is not None:
+            kinds |= _TYPE_BIT[TokenType.NUMBER]
+            if match.group(1) is not None:
+                self._value = int(match.group(1), 16)
+            elif match.group(2) is not None:
+                self._value = int(match.group(2), 10)
+            else:
+                self._value = int(match.group(3), 8)
+        self._kinds = kinds
 
     def __str__(self):
-        return "{%s,%s,%s}" % (self._token_type, self._at, self._content)
+        return "{%s,%s,%s}" % (self._token_type, self.at(), self._content)
+
+
+class _GrammarNode(object):
+    """
+    Node in the decision tree of a TokenGrammar
+    """
+    __slots__ = ('steps', 'accept', 'first')
+
+    def __init__(self, first: int):
+        """
+        Construct an empty node
+
+        :param first: index of the first alternative passing through this node
+        """
+        self.steps = []  # (optional, mask, child node) in order of first alternative
+        self.accept = None  # index of alternative ending here
+        self.first = first
+
+
+class TokenGrammar(object):
+    """
+Compiled set of named token type sequences
+
+Each sequence takes the same elements as Tokenizer.tokens_are(), token types,
+lists of token types and OPTIONAL. The sequences are merged on common prefixes
+into a decision tree on type bit sets, so Tokenizer.tokens_match() tests each
+token once, no matter how many alternatives share it.
+The first alternative (in order of declaration) that matches, is selected.
+    """
+
+    def __init__(self, *alternatives, **named):
+        """
+        Compile alternatives
+
+        :param alternatives: (name, sequence) tuples
+        :param named: name=sequence, taken after alternatives
+        :raises Exception: on a dangling OPTIONAL
+        """
+        self._names = []
+        self._root = _GrammarNode(0)
+        for (name, sequence) in list(alternatives) + list(named.items()):
+            index = len(self._names)
+            self._names.append(name)
+            node = self._root
+            for (optional, mask) in self._compile(name, sequence):
+                for (step_optional, step_mask, child) in node.steps:
+                    if step_optional == optional and step_mask == mask:
+                        node = child
+                        break
+                else:
+                    child = _GrammarNode(index)
+                    node.steps.append((optional, mask, child))
+                    node = child
+            if node.accept is None:
+                node.accept = index
+
+    @staticmethod
+    def _compile(name: str, sequence) -> List[tuple]:
+        """
+        Turn a token type sequence into steps
+
+        :param name: name of alternative, for error reporting
+        :param sequence: token types, lists of token types or OPTIONAL
+        :return: list of (optional, mask)
+        :raises Exception: on a dangling OPTIONAL
+        """
+        steps = []
+        optional = False
+        for arg in sequence:
+            if arg is TokenType.OPTIONAL:
+                optional = True
+                continue
+            if hasattr(arg, '__iter__'):
+                mask = 0
+                for token_type in arg:
+                    mask |= _TYPE_BIT[token_type]
+            else:
+                mask = _TYPE_BIT[arg]
+            steps.append((optional, mask))
+            optional = False
+        if optional:
+            raise Exception("Dangling OPTIONAL in TokenGrammar alternative: %s" % name)
+        return steps
+
+    def names(self) -> List[str]:
+        """
+        Names of the alternatives
+
+        :return: names in order of declaration
+        """
+        return list(self._names)
+
+    def match(self, peek) -> TypeVar('_match', tuple, None):
+        """
+        Find the first matching alternative
+
+        :param peek: function taking n, returning the token n ahead in the input
+        :return: (name, number of tokens matched, matched tokens) or None
+        """
+        best = self._search(self._root, peek, 0, [], None)
+        if best is None:
+            return None
+        return self._names[best[0]], best[1], best[2]
+
+    def _search(self, node: _GrammarNode, peek, i: int, taken: List[Token], best):
+        """
+        Walk the decision tree
+
+        Subtrees that cannot hold an alternative before the best match so far are skipped
+
+        :param node: current node
+        :param peek: token lookup
+        :param i: tokens consumed so far
+        :param taken: tokens output so far
+        :param best: (alternative, tokens consumed, tokens taken) or None
+        :return: best match
+        """
+        if node.accept is not None and (best is None or node.accept < best[0]):
+            best = (node.accept, i, list(taken))
+        for (optional, mask, child) in node.steps:
+            if best is not None and child.first >= best[0]:
+                break
+            if optional:
+                j = i
+                while peek(j).kinds() & mask:
+                    j = j + 1
+                best = self._search(child, peek, j, taken, best)
+            else:
+                token = peek(i)
+                if token.kinds() & mask:
+                    taken.append(token)
+                    best = self._search(child, peek, i + 1, taken, best)
+                    taken.pop()
+        return best
 
 
 class Tokenizer(object):
@@ -157,41 +374,69 @@ Primary purpose of this package is
         '?': TokenType.QUESTION,
         '!': TokenType.EXCLAMATION,
     }
+    _SPACE = re.compile('\\s*', re.U)
+    _SPACE_IN_LINE = re.compile('[^\\S\\n]*', re.U)
+    _SECTION_NAME = re.compile('[^\\]\\s]*', re.U)
+    _MASTER_WHITESPACE = {
+        TokenWhitespace.NONE: '(?P<skip>\\s+)',
+        TokenWhitespace.NEWLINE: '(?P<newline>[^\\S\\n]*\\n)|(?P<skip>[^\\S\\n]+)',
+        TokenWhitespace.WHITESPACE: '(?P<space>\\s+)',
+        TokenWhitespace.BOTH: '(?P<newline>\\n)|(?P<space>[^\\S\\n]+)',
+    }
+    _MASTER_PATTERNS = {}  # Compiled master patterns by whitespace mode and single tokens
+    _COMPACT_AFTER = 64  # Consumed tokens kept in the lookahead list, before it is compacted
 
     @staticmethod
-    def ini_from_file(filename: str) -> TypeVar('Tokenizer'):
+    def ini_from_file(filename: str, track_location: bool = True) -> TypeVar('Tokenizer'):
         """
         Create a Tokenizer from a file, for parsing ini files
 
-        The file is read into memory - inefficient when dealing with large files.
+        Regular files are memory mapped, see Reader.from_file()
 
         :param filename: path of file
+        :param track_location: if token locations should be reported (disable for trusted input)
         :returns: new object
         """
-        with open(filename, 'r') as f:
-            content = f.read()
-            reader = Reader(source=StringIO(content), name=filename)
-            return Tokenizer(reader=reader, variable=EnvironmentVariable(), whitespace=TokenWhitespace.NEWLINE, single_tokens="=")
+        reader = Reader.from_file(filename, track_location=track_location)
+        return Tokenizer(reader=reader, variable=EnvironmentVariable(), whitespace=TokenWhitespace.NEWLINE, single_tokens="=")
 
     @staticmethod
-    def full_from_file(filename: str) -> TypeVar('Tokenizer'):
+    def full_from_file(filename: str, track_location: bool = True) -> TypeVar('Tokenizer'):
         """
         Create a Tokenizer from a file, for parsing any files
 
-        The file is read into memory - inefficient when dealing with large files.
+        Regular files are memory mapped, see Reader.from_file()
 
         :param filename: path of file
+        :param track_location: if token locations should be reported (disable for trusted input)
         :returns: new object
         """
-        with open(filename, 'r') as f:
-            content = f.read()
-            reader = Reader(source=StringIO(content), name=filename)
-            return Tokenizer(reader=reader, variable=EnvironmentVariable(), whitespace=TokenWhitespace.BOTH,
-                             single_tokens="".join(Tokenizer._SINGLE_CHARACTER_TOKENS.keys()))
+        reader = Reader.from_file(filename, track_location=track_location)
+        return Tokenizer(reader=reader, variable=EnvironmentVariable(), whitespace=TokenWhitespace.BOTH,
+                         single_tokens="".join(Tokenizer._SINGLE_CHARACTER_TOKENS.keys()))
+
+    @staticmethod
+    def from_tokens(tokens: Iterator[Token], name: str = "<UNKNOWN>") -> TypeVar('Tokenizer'):
+        """
+        Create a Tokenizer, that replays tokens instead of reading input
+
+        The tokens are pulled from the iterator when they are needed, so a
+        lazy iterator fails at the same point, as the input would have
+
+        :param tokens: iterator of tokens, ending with an EOF token
+        :param name: name of the source
+        :returns: new object
+        """
+        tokenizer = Tokenizer(Reader(StringIO(""), name))
+        tokenizer._replay = iter(tokens)
+        tokenizer._next_token = tokenizer._next_token_replay
+        return tokenizer
 
     def __init__(self, reader: Reader, variable: Variable = EnvironmentVariable(),
                  whitespace: TokenWhitespace = TokenWhitespace.NEWLINE,
-                 single_tokens: str = "=") -> TypeVar('Tokenizer'):
+                 single_tokens: str = "=",
+                 engine: TokenEngine = TokenEngine.CHARACTER,
+                 max_depth: int = None) -> TypeVar('Tokenizer'):
         """
         Tokenizer constructor
 
@@ -200,10 +445,14 @@ Primary purpose of this package is
         :param whitespace: should newlines be tokens
         :param single_tokens: String of chars thet should be their own tokens
                               see _SINGLE_CHARACTER_TOKENS for known tokens
+        :param engine: how the input is scanned, both produce the same tokens
+        :param max_depth: max nesting of expansions (and of parentheses), defaults to Expansion.MAX_DEPTH
         :returns: new object
         """
         self._variable = variable
+        hook(variable, 'begin_parse')()
         self._reader = reader
+        self._source = reader.name()
         if whitespace is TokenWhitespace.BOTH:
             self._handle_whitespace = self._handle_whitespace_both
         elif whitespace is TokenWhitespace.NEWLINE:
@@ -212,21 +461,54 @@ Primary purpose of this package is
             self._handle_whitespace = self._handle_whitespace_whitespace
         else:
             self._handle_whitespace = self._handle_whitespace_none
-        self.expander = Expansion(reader, variable)
+        self.expander = Expansion(reader, variable, max_depth=max_depth)
         self._tokens = []
+        self._head = 0  # Index of the next token in _tokens
         self._single_tokens = dict(
             [(x, self._SINGLE_CHARACTER_TOKENS[x]) for x in self._SINGLE_CHARACTER_TOKENS.keys() if x in single_tokens])
         self._break_chars = ''.join(self._single_tokens.keys()) + "[]$;#'" + '"'
+        self._text_run = re.compile('[^\\s%s]*' % re.escape(self._break_chars), re.U)
+        if engine is TokenEngine.REGEX:
+            self._master = self._master_pattern(whitespace)
+            self._next_token = self._next_token_regex
 
-    def peek_token(self) -> Token:
+    def _master_pattern(self, whitespace: TokenWhitespace):
         """
-        Look at the next token, mostly for error reporting, when unable to match a token sequence
+        Build (or reuse) the master pattern, for the regex engine
 
+        Alternatives are in the same order as the tests in _next_token()
+
+        :param whitespace: whitespace mode
+        :return: compiled pattern
+        """
+        single = ''.join(self._single_tokens.keys())
+        pattern = self._MASTER_PATTERNS.get((whitespace, single))
+        if pattern is None:
+            alternatives = [self._MASTER_WHITESPACE[whitespace],
+                            '(?P<comment>[#;][^\\n]*\\n?)',
+                            '(?P<dollar>\\$)']
+            if single:
+                alternatives.append('(?P<single>[%s])' % re.escape(single))
+            alternatives += ['(?P<section>\\[(?P<section_name>[^\\]\\s]*)\\])',
+                             '(?P<open_section>\\[)',
+                             '(?P<dquote>"(?P<dquote_text>[^"$\\\\\\n]*)")',
+                             '(?P<open_dquote>")',
+                             "(?P<squote>'(?P<squote_text>[^'\\n]*)'(?!'))",
+                             "(?P<open_squote>')",
+                             '(?P<text>.[^\\s%s]*)' % re.escape(self._break_chars)]
+            pattern = re.compile('|'.join(alternatives), re.U)
+            self._MASTER_PATTERNS[(whitespace, single)] = pattern
+        return pattern
+
+    def peek_token(self, n: int = 0) -> Token:
+        """
+        Look at an upcoming token, mostly for error reporting, when unable to match a token sequence
+
+        :param n: how many tokens to look past (0 is the next token)
         :returns: next token
         """
-        if not self._tokens:
-            self._next_token()
-        return self._tokens[0]
+        self._ensure_n_tokens(n)
+        return self._tokens[self._head + n]
 
     def tokens_are(self, *args: TypeVar('_TokenType', TokenType, List[TokenType]), output: List[Token] = None) -> List[Token]:
         """
@@ -241,25 +523,26 @@ Primary purpose of this package is
         if output is None:
             output = []
         taken = []
-        i = 0
+        tokens = self._tokens
+        i = self._head
         last_was = None
         for arg in args:
-            self._ensure_n_tokens(i)
+            self._ensure_n_tokens(i - self._head)
 
             if last_was is TokenType.OPTIONAL:
-                while self._tokens[i].is_a(arg):
+                while tokens[i].is_a(arg):
                     i = i + 1
-                    self._ensure_n_tokens(i)
+                    self._ensure_n_tokens(i - self._head)
             elif arg is TokenType.OPTIONAL:
                 pass
             elif hasattr(arg, '__iter__'):
-                if True in [self._tokens[i].is_a(t) for t in arg]:
-                    taken.append(self._tokens[i])
+                if True in [tokens[i].is_a(t) for t in arg]:
+                    taken.append(tokens[i])
                     i = i + 1
                 else:
                     return None
-            elif self._tokens[i].is_a(arg):
-                taken.append(self._tokens[i])
+            elif tokens[i].is_a(arg):
+                taken.append(tokens[i])
                 i = i + 1
             else:
                 return None
@@ -268,17 +551,71 @@ Primary purpose of this package is
             raise Exception("Dangling OPTIONAL in tokens_are()")
         for token in taken:
             output.append(token)
-        self._tokens = self._tokens[i:]
+        self._consume(i - self._head)
         return output
 
+    def tokens_match(self, grammar: TokenGrammar, output: List[Token] = None) -> TypeVar('_match', tuple, None):
+        """
+        Match the input against the alternatives of a grammar
+
+        :param grammar: compiled alternatives
+        :param output: where to put the matched tokens
+                       (only put if an alternative matches)
+        :returns: tuple of name of the matching alternative and output or None if no match is made
+        """
+        if output is None:
+            output = []
+        found = grammar.match(self.peek_token)
+        if found is None:
+            return None
+        (name, consumed, taken) = found
+        output.extend(taken)
+        self._consume(consumed)
+        return name, output
+
+    def tokens(self) -> Iterator[Token]:
+        """
+        Generator of the remaining tokens up until (not including) EOF
+
+        Tokens already read ahead by the pattern matching methods come first,
+        then tokens are taken straight from the input, without being kept
+        in the lookahead. Pattern matching can be mixed with iteration.
+
+        :returns: token iterator
+        """
+        while True:
+            if self._head < len(self._tokens):
+                token = self._tokens[self._head]
+                if token.is_a(TokenType.EOF):
+                    return
+                self._consume(1)
+            else:
+                token = self._next_token()
+                if token.is_a(TokenType.EOF):
+                    self._tokens.append(token)
+                    return
+            yield token
+
+    def __iter__(self) -> Iterator[Token]:
+        return self.tokens()
+
+    def next_tokens(self, n: int) -> List[Token]:
+        """
+        Take a batch of tokens from the input
+
+        :param n: max number of tokens
+        :returns: list of tokens, shorter than n (possibly empty) if EOF is reached
+        """
+        return list(islice(self.tokens(), n))
+
     def is_eof(self):
         """
         Test for end of file in input
 
         :return: if eof has been reached
         """
-        self._ensure_n_tokens(1)
-        return self._tokens[0].is_a(TokenType.EOF)
+        self._ensure_n_tokens(0)
+        return self._tokens[self._head].is_a(TokenType.EOF)
 
     def has_more(self):
         """
@@ -289,202 +626,445 @@ Primary purpose of this package is
         return not self.is_eof()
 
     def _ensure_n_tokens(self, n: int) -> None:
-        while len(self._tokens) <= n:
-            self._next_token()
+        """
+        Make sure the lookahead holds more than n tokens
+
+        :param n: number of tokens past the next one
+        """
+        while len(self._tokens) - self._head <= n:
+            self._tokens.append(self._next_token())
 
-    def _next_token(self) -> None:
+    def _consume(self, n: int) -> None:
         """
-        Construct a new token, and puts it in the token list
+        Drop tokens from the front of the lookahead
 
+        The list is only compacted, when most of it has been consumed,
+        so each token is moved at most once (amortized)
+
+        :param n: number of tokens to drop
+        """
+        self._head = self._head + n
+        if self._head == len(self._tokens):
+            self._tokens.clear()
+            self._head = 0
+        elif self._head > self._COMPACT_AFTER and self._head * 2 > len(self._tokens):
+            del self._tokens[:self._head]
+            self._head = 0
+
+    def _next_token(self) -> Token:
+        """
+        Construct a new token from the input
+
+        :return: the token
         :raises Exception: if input is invalid
         """
         while True:
-            at = self._reader.at()
+            at = self._reader.position()
             c = self._reader.get()
             if c is None:
-                self._tokens.append(Token(at, TokenType.EOF, ''))
-                return
+                return Token(at, TokenType.EOF, '', self._source)
             if str.isspace(c):
-                if self._handle_whitespace(at, c):
-                    return
+                token = self._handle_whitespace(at, c)
+                if token is not None:
+                    return token
                 continue
-            if c is '#' or c is ';':
-                while True:
-                    c = self._reader.get()
-                    if c is None or c is "\n":
-                        break
+            if c == '#' or c == ';':
+                self._reader.skip_line()
                 continue
-            if c is "$":
+            if c == "$":
                 content = self.expander.expand(at)
-                self._tokens.append(Token(at, TokenType.TEXT, content))
-                return
+                return Token(at, TokenType.TEXT, content, self._source)
             if c in self._single_tokens:
-                self._tokens.append(Token(at, self._single_tokens[c], c))
-                return
-            if c is '[':
-                self._read_section(at)
-                return
-            if c is '"':
-                self._read_double_quote(at)
-                return
-            if c is "'":
-                self._read_single_quote(at)
-                return
-
-            content = StringIO()
-            content.write(c)
-            while True:
-                c = self._reader.get()
-                if c is None:
-                    break
-                if str.isspace(c) or c in self._break_chars:
-                    self._reader.unget()
-                    break
-                content.write(c)
-            self._tokens.append(Token(at, TokenType.TEXT, content.getvalue()))
+                return Token(at, self._single_tokens[c], c, self._source)
+            if c == '[':
+                return self._read_section(at)
+            if c == '"':
+                return self._read_double_quote(at)
+            if c == "'":
+                return self._read_single_quote(at)
+
+            content = c + self._reader.read_while(self._text_run)
+            return Token(at, TokenType.TEXT, content, self._source)
+
+    def _next_token_regex(self) -> Token:
+        """
+        Construct a new token from the input using the master pattern
+
+        Constructs the pattern cannot take in one match (expansions, quotes with
+        escapes or newlines, bad sections) are handed to the character based methods
+
+        :return: the token
+        :raises Exception: if input is invalid
+        """
+        while True:
+            at = self._reader.position()
+            match = self._reader.match(self._master)
+            if match is None:
+                return Token(at, TokenType.EOF, '', self._source)
+            kind = match.lastgroup
+            if kind == 'text':
+                return Token(at, TokenType.TEXT, match.group(), self._source)
+            if kind == 'skip' or kind == 'comment':
+                continue
+            if kind == 'newline':
+                return Token(at, TokenType.NEWLINE, "\n", self._source)
+            if kind == 'space':
+                content = match.group()
+                if match.end() == len(match.string):
+                    content = content + self._reader.read_while(self._SPACE)
+                return Token(at, TokenType.WHITESPACE, content, self._source)
+            if kind == 'single':
+                c = match.group()
+                return Token(at, self._single_tokens[c], c, self._source)
+            if kind == 'dollar':
+                return Token(at, TokenType.TEXT, self.expander.expand(at), self._source)
+            if kind == 'section':
+                return Token(at, TokenType.SECTION, match.group('section_name'), self._source)
+            if kind == 'dquote':
+                return Token(at, TokenType.TEXT, match.group('dquote_text'), self._source)
+            if kind == 'squote':
+                return Token(at, TokenType.TEXT, match.group('squote_text'), self._source)
+            if kind == 'open_section':
+                return self._read_section(at)
+            if kind == 'open_dquote':
+                return self._read_double_quote(at)
+            return self._read_single_quote(at)
+
+    def _next_token_replay(self) -> Token:
+        """
+        Take the next token from the replayed tokens, see from_tokens()
 
-    def _handle_whitespace_none(self, at, c) -> False:
+        :return: the token (EOF is repeated)
+        """
+        token = next(self._replay)
+        if token.is_a(TokenType.EOF):
+            self._replay = repeat(token)
+        return token
+
+    def _handle_whitespace_none(self, at, c) -> None:
         """
         Eat all whitespace in source
 
         :param at: required by interface
         :param c: required by interface
-        :return False: Doesn't produce a token
+        :return None: Doesn't produce a token
         """
-        while True:
-            if c is None:
-                return False
-            if not str.isspace(c):
-                self._reader.unget()
-                return False
-            c = self._reader.get()
+        self._reader.read_while(self._SPACE)
+        return None
 
-    def _handle_whitespace_newline(self, at, c) -> bool:
+    def _handle_whitespace_newline(self, at, c) -> TypeVar('_Token', Token, None):
         """
         Constructs a newline token if a newline is encountered in whitespace block
 
         :param at: Needed for new token
         :param c: first whitespace character
-        :return bool: if a newline is encountered
+        :return: the newline token or None if no newline is encountered
         """
-        while True:
+        if c != "\n":
+            self._reader.read_while(self._SPACE_IN_LINE)
+            c = self._reader.get()
             if c is None:
-                return False
-            if c is "\n":
-                self._tokens.append(Token(at, TokenType.NEWLINE, c))
-                return True
-            if not str.isspace(c):
+                return None
+            if c != "\n":
                 self._reader.unget()
-                return False
-            c = self._reader.get()
+                return None
+        return Token(at, TokenType.NEWLINE, c, self._source)
 
-    def _handle_whitespace_whitespace(self, at, c) -> True:
+    def _handle_whitespace_whitespace(self, at, c) -> Token:
         """
         Constructs a whitespace token with optional newlines in it
 
         :param at: Needed for new token
         :param c: first whitespace character
-        :return True: will always produce a token
+        :return: the token
         """
-        content = StringIO()
-        while True:
-            if c is None:
-                self._tokens.append(Token(at, TokenType.WHITESPACE, content.getvalue()))
-                return True
-            if not str.isspace(c):
-                self._reader.unget()
-                self._tokens.append(Token(at, TokenType.WHITESPACE, content.getvalue()))
-                return True
-            content.write(c)
-            c = self._reader.get()
+        content = c + self._reader.read_while(self._SPACE)
+        return Token(at, TokenType.WHITESPACE, content, self._source)
 
-    def _handle_whitespace_both(self, at, c) -> True:
+    def _handle_whitespace_both(self, at, c) -> Token:
         """
         Constructs a newline token or a whitespace token
 
         :param at: Needed for new token
         :param c: first whitespace character
-        :return True: will always produce a token
+        :return: the token
         """
-        if c is "\n":
-            self._tokens.append(Token(at, TokenType.NEWLINE, c))
-            return True
-        content = StringIO()
-        while True:
-            if c is None:
-                self._tokens.append(Token(at, TokenType.WHITESPACE, content.getvalue()))
-                return True
-            if not str.isspace(c) or c is "\n":
-                self._reader.unget()
-                self._tokens.append(Token(at, TokenType.WHITESPACE, content.getvalue()))
-                return True
-            content.write(c)
-            c = self._reader.get()
+        if c == "\n":
+            return Token(at, TokenType.NEWLINE, c, self._source)
+        content = c + self._reader.read_while(self._SPACE_IN_LINE)
+        return Token(at, TokenType.WHITESPACE, content, self._source)
 
-    def _read_single_quote(self, at) -> None:
+    def _read_single_quote(self, at) -> Token:
         """
-        Constructs a token from a single quote text, and puts it into the token list.
+        Constructs a token from a single quote text
 
         Input should be positioned after 1st quote
 
+        :return: the token
         :raises Exception: On unexpected eof
         """
         content = StringIO()
         while True:
+            content.write(self._reader.read_until("'"))
+            if self._reader.get() is None:
+                raise Exception("Unexpected EOF in single quote starting at: %s" % self._reader.locate(at))
             c = self._reader.get()
-            if c is None:
-                raise Exception("Unexpected EOF in single quote starting at: %s" % at)
-            if c is "'":
-                c = self._reader.get()
-                if c is not "'":
-                    if c is not None:
-                        self._reader.unget()
-                    self._tokens.append(Token(at, TokenType.TEXT, content.getvalue()))
-                    return
+            if c != "'":
+                if c is not None:
+                    self._reader.unget()
+                return Token(at, TokenType.TEXT, content.getvalue(), self._source)
             content.write(c)
 
-    def _read_double_quote(self, at) -> None:
+    def _read_double_quote(self, at) -> Token:
         """
-        Constructs a token from a double quote text, and puts it into the token list.
+        Constructs a token from a double quote text
 
         Input should be positioned after 1st quote.
         \\ escapes are expanded and variables are expanded
 
+        :return: the token
         :raises Exception: On unexpected eof, invalid quote or variable
         """
         content = StringIO()
         while True:
-            a = self._reader.at()
+            content.write(self._reader.read_until('"$\\'))
+            a = self._reader.position()
             c = self._reader.get()
             if c is None:
-                raise Exception("Unexpected EOF in double quote starting at: %s" % at)
-            if c is '"':
-                self._tokens.append(Token(at, TokenType.TEXT, content.getvalue()))
-                return
-            if c is '$':
+                raise Exception("Unexpected EOF in double quote starting at: %s" % self._reader.locate(at))
+            if c == '"':
+                return Token(at, TokenType.TEXT, content.getvalue(), self._source)
+            if c == '$':
                 content.write(self.expander.expand(a))
                 continue
-            if c is '\\':
+            if c == '\\':
                 c = self._reader.get_quoted()
             content.write(c)
 
-    def _read_section(self, at) -> None:
+    def _read_section(self, at) -> Token:
         """
-        Constructs a token from a section, and puts it into the token list.
+        Constructs a token from a section
 
         Input should be positioned after [.
 
+        :return: the token
         :raises Exception: On unexpected eof or whitespace
         """
-        content = StringIO()
-        while True:
-            c = self._reader.get()
-            if c is None:
-                raise Exception("Unexpected EOF in section starting at: %s" % at)
-            if c is ']':
-                self._tokens.append(Token(at, TokenType.SECTION, content.getvalue()))
-                return
-            if str.isspace(c):
-                raise Exception("Whitespace is not allowed in section at: %s" % at)
-            content.write(c)
+        content = self._reader.read_while(self._SECTION_NAME)
+        c = self._reader.get()
+        if c is None:
+            raise Exception("Unexpected EOF in section starting at: %s" % self._reader.locate(at))
+        if c == ']':
+            return Token(at, TokenType.SECTION, content, self._source)
+        raise Exception("Whitespace is not allowed in section at: %s" % self._reader.locate(at))
+
+
+class TokenArrays(object):
+    """
+Compact token stream
+
+All tokens of an input, as arrays of types, contents and positions. It can
+be pickled (sent between processes, an error that cannot be pickled is sent
+as an Exception with the same message) and is replayed as a Tokenizer. If the
+input had an error, it is raised after the last token read before it, as it
+would have been by a Tokenizer on the input.
+    """
+    __slots__ = ('_source', '_types', '_contents', '_positions', '_error')
+
+    _TYPES = list(TokenType)
+    _TYPE_INDEX = dict((token_type, n) for (n, token_type) in enumerate(_TYPES))
+
+    def __init__(self, source: str, types: bytes, contents: List[str], positions: list, error: Exception = None):
+        """
+        Construct from arrays, see from_tokenizer()
+
+        :param source: name of the source
+        :param types: token type indexes (into list(TokenType))
+        :param contents: token contents
+        :param positions: token positions (see Reader.position())
+        :param error: exception raised after the tokens
+        """
+        self._source = source
+        self._types = types
+        self._contents = contents
+        self._positions = positions
+        self._error = error
+
+    @staticmethod
+    def from_tokenizer(tokenizer: Tokenizer) -> TypeVar('TokenArrays'):
+        """
+        Read all tokens, up until EOF or an error
+
+        :param tokenizer: the source
+        :return: new object
+        """
+        types = []
+        contents = []
+        positions = []
+        error = None
+        index = TokenArrays._TYPE_INDEX
+        try:
+            for token in tokenizer.tokens():
+                types.append(index[token._token_type])
+                contents.append(token._content)
+                positions.append(token._at)
+            token = tokenizer.peek_token()
+            types.append(index[token._token_type])
+            contents.append(token._content)
+            positions.append(token._at)
+        except Exception as e:
+            error = e
+        return TokenArrays(tokenizer._source, bytes(types), contents, positions, error)
+
+    @staticmethod
+    def join(parts: List[TypeVar('TokenArrays')]) -> TypeVar('TokenArrays'):
+        """
+        Concatenate the tokens of consecutive parts of an input
+
+        The parts should be split at line starts, and have locations. The EOF of
+        all but the last part is dropped, WHITESPACE tokens that meet at a split
+        are merged (not if a comment is between them), and the first error ends
+        the input.
+
+        :param parts: token streams in input order (at least one)
+        :return: new object
+        """
+        eof = TokenArrays._TYPE_INDEX[TokenType.EOF]
+        whitespace = TokenArrays._TYPE_INDEX[TokenType.WHITESPACE]
+        types = bytearray()
+        contents = []
+        positions = []
+        error = None
+        for part in parts:
+            if types and types[-1] == eof:
+                del types[-1], contents[-1], positions[-1]
+            start = 0
+            if types and types[-1] == whitespace and part._types[:1] == bytes((whitespace,)) \
+                    and TokenArrays._meets(positions[-1], contents[-1], part._positions[0]):
+                contents[-1] += part._contents[0]
+                start = 1
+            types += part._types[start:]
+            contents += part._contents[start:]
+            positions += part._positions[start:]
+            error = part._error
+            if error is not None:
+                break
+        return TokenArrays(parts[0]._source, bytes(types), contents, positions, error)
+
+    @staticmethod
+    def _meets(position: TypeVar('_int', int, None), content: str, following: TypeVar('_int', int, None)) -> bool:
+        """
+        Does a token end where the following token starts
+
+        :param position: position of token
+        :param content: content of token (ending with a newline)
+        :param following: position of the following token (at the start of a line)
+        :return: true if there is nothing between them
+        """
+        if position is None or following is None or position < 0 or following < 0:
+            return False
+        return content.endswith("\n") and At.line_of(position) + content.count("\n") == At.line_of(following) \
+            and following == At.pack(At.line_of(following), 1)
+
+    @staticmethod
+    def load(source: str, data: tuple) -> TypeVar('TokenArrays'):
+        """
+        Construct from dump()
+
+        :param source: name of the source
+        :param data: from dump()
+        :return: new object
+        """
+        (types, contents, positions, error) = data
+        if error is not None:
+            (name, args) = error
+            error = getattr(builtins, name)(*args)
+        return TokenArrays(source, types, contents, positions, error)
+
+    def dump(self) -> TypeVar('_data', tuple, None):
+        """
+        The arrays as builtin types, for marshal
+
+        :return: tuple or None if the error is not a builtin exception with simple arguments
+        """
+        error = self._error
+        if error is not None:
+            name = type(error).__qualname__
+            if type(error).__module__ != 'builtins' or getattr(builtins, name, None) is not type(error):
+                return None
+            if not all(isinstance(arg, (str, int)) for arg in error.args):
+                return None
+            error = (name, error.args)
+        return self._types, self._contents, self._positions, error
 
+    def source(self) -> str:
+        return self._source
+
+    def with_error(self, error: Exception) -> TypeVar('TokenArrays'):
+        """
+        The same tokens, ending with another error
+
+        :param error: exception raised after the tokens
+        :return: new object
+        """
+        return TokenArrays(self._source, self._types, self._contents, self._positions, error)
+
+    def without_locations(self) -> TypeVar('TokenArrays'):
+        """
+        The same tokens, as if locations weren't tracked
+
+        :return: new object
+        """
+        return TokenArrays(self._source, self._types, self._contents, [None] * len(self._positions), self._error)
+
+    def error(self) -> TypeVar('_Exception', Exception, None):
+        """
+        The error, that ended the input
+
+        :return: exception or None if the input was read to the end
+        """
+        return self._error
+
+    def tokenizer(self) -> Tokenizer:
+        """
+        Replay the tokens
+
+        :return: tokenizer
+        """
+        return Tokenizer.from_tokens(self._replay(), self._source)
+
+    def tokens(self) -> Iterator[Token]:
+        """
+        Replay the tokens up until (not including) EOF
+
+        :return: token iterator
+        """
+        return self.tokenizer().tokens()
+
+    def __len__(self):
+        return len(self._types)
+
+    def __getstate__(self):
+        error = self._error
+        if error is not None:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = Exception(str(error))
+        return self._source, self._types, self._contents, self._positions, error
+
+    def __setstate__(self, state):
+        (self._source, self._types, self._contents, self._positions, self._error) = state
+
+    def _replay(self) -> Iterator[Token]:
+        """
+        Generator of the tokens
+
+        :return: token iterator (ending with EOF or raising the error)
+        """
+        types = self._TYPES
+        source = self._source
+        for (token_type, content, position) in zip(self._types, self._contents, self._positions):
+            yield Token(position, types[token_type], content, source)
+        if self._error is not None:
+            raise self._error.with_traceback(None)
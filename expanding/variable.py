@@ -1,5 +1,10 @@
 import os
-from typing import TypeVar
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import TypeVar, List
 
 from expanding.source import Reader
 
@@ -27,15 +32,79 @@ class Variable(object):
         """
         raise NotImplemented
 
+    def lookup_many(self, names: List[str]) -> dict:
+        """
+        Resolve a batch of variables
+
+        Resolvers that can resolve many names in one call (remote services)
+        should override this, the default looks them up one by one
+        :param names: variable names
+        :return: dict of name to value (None if the variable is unknown)
+        """
+        return dict((name, self.lookup_variable(name)) for name in names)
+
+    def begin_parse(self) -> None:
+        """
+        Called when a parse (or a rendering of a template) starts
+
+        Resolvers that remember lookups for one parse (ChainVariable) start
+        over, wrappers pass it on. The default does nothing
+        """
+        pass
+
+    def forget(self, names: List[str] = None) -> None:
+        """
+        Drop what is remembered of variables, that have changed
+
+        Resolvers that memoize or cache values drop them, wrappers pass it on.
+        The default does nothing
+        :param names: variable names, None for all
+        """
+        pass
+
+    def name_syntax(self):
+        """
+        Identity of the way get_name() reads names
+
+        Resolvers with equal name syntax read the same names from the same input,
+        compiled expressions are shared between them (see Expansion.MATH_CACHE).
+        Override this to share with other instances
+        :return: hashable value, defaults to a weak reference to the instance
+                 (nothing is shared, and the cache doesn't keep the resolver alive)
+        """
+        return weakref.ref(self)
+
+
+def hook(variable, name: str):
+    """
+    A method of a resolver, that isn't part of the basic interface
+
+    Resolvers only have to implement get_name() and lookup_variable(), the
+    default of Variable is used for lookup_many(), begin_parse(), forget() and
+    name_syntax() if they don't have them
+    :param variable: resolver
+    :param name: name of the method
+    :return: bound method
+    """
+    method = getattr(variable, name, None)
+    if method is None:
+        method = getattr(Variable, name).__get__(variable)
+    return method
+
 
 class EnvironmentVariable(Variable):
+    _NAME = re.compile('\\w*', re.U)
 
-    def __init__(self, env: dict = os.environ) -> object:
+    def __init__(self, env: dict = os.environ, snapshot: bool = False) -> object:
         """
         dictionary resolver
 
         :param env: dictionary, defaults to ENV
+        :param snapshot: copy env into a plain dict once, later changes to env are not seen
+                         (os.environ encodes and decodes the name on every lookup)
         """
+        if snapshot:
+            env = dict(env)
         self._env = env
 
     def get_name(self, reader: Reader) -> _str:
@@ -44,18 +113,9 @@ class EnvironmentVariable(Variable):
         :param reader: the input source
         :return: variable name read from input
         """
-        name = None
-        while True:
-            c = reader.get()
-            if c is None:
-                break
-            if name is None and (str.isalnum(c) or c is '_'):
-                name = c
-            elif str.isalnum(c) or c is '_':
-                name = name + c
-            else:
-                reader.unget()
-                break
+        name = reader.read_while(self._NAME)
+        if name == "":
+            return None
         return name
 
     def lookup_variable(self, name: str) -> _str:
@@ -64,6 +124,295 @@ class EnvironmentVariable(Variable):
         :param name: name to look up
         :return: value or None if the variable is unknown
         """
-        if name in self._env:
-            return self._env[name]
-        return None
+        return self._env.get(name)
+
+    def name_syntax(self):
+        """
+        The name pattern, unless a subclass reads names in another way
+
+        :return: see Variable.name_syntax()
+        """
+        if type(self).get_name is EnvironmentVariable.get_name:
+            return self._NAME
+        return super().name_syntax()
+
+
+class ChainVariable(Variable):
+    """
+    Layered resolvers
+
+    A variable is resolved by the first resolver that knows it (put overrides
+    first and defaults last). Names are read by the first resolver.
+
+    Lookups are memoized for one parse (a Tokenizer, or a rendering of a
+    Template), see begin_parse(). Call clear() if the values of the resolvers
+    change during a parse.
+    """
+
+    def __init__(self, *variables: Variable) -> object:
+        """
+        Stack resolvers
+
+        :param variables: resolvers in order of precedence
+        """
+        if not variables:
+            raise Exception("ChainVariable needs at least one resolver")
+        self._variables = variables
+        self._memo = {}
+
+    def get_name(self, reader: Reader) -> _str:
+        """
+        Read a name, using the first resolver
+
+        :param reader: the input source
+        :return: variable name read from input
+        """
+        return self._variables[0].get_name(reader)
+
+    def begin_parse(self) -> None:
+        """
+        Forget memoized lookups, and pass it on to the resolvers
+        """
+        self._memo.clear()
+        for variable in self._variables:
+            hook(variable, 'begin_parse')()
+
+    def forget(self, names: List[str] = None) -> None:
+        """
+        Forget memoized lookups of the names, and pass it on to the resolvers
+
+        :param names: variable names, None for all
+        """
+        if names is None:
+            self._memo.clear()
+        else:
+            for name in names:
+                self._memo.pop(name, None)
+        for variable in self._variables:
+            hook(variable, 'forget')(names)
+
+    def name_syntax(self):
+        """
+        Name syntax of the first resolver
+
+        :return: see Variable.name_syntax()
+        """
+        return hook(self._variables[0], 'name_syntax')()
+
+    def lookup_variable(self, name: str) -> _str:
+        """
+        Resolve variable name from the first resolver that knows it
+        :param name: name to look up
+        :return: value or None if no resolver knows the variable
+        """
+        memo = self._memo
+        if name in memo:
+            return memo[name]
+        value = None
+        for variable in self._variables:
+            value = variable.lookup_variable(name)
+            if value is not None:
+                break
+        memo[name] = value
+        return value
+
+    def lookup_many(self, names: List[str]) -> dict:
+        """
+        Resolve a batch of variables, with one batch per resolver
+        :param names: variable names
+        :return: dict of name to value (None if no resolver knows the variable)
+        """
+        memo = self._memo
+        values = {}
+        missing = []
+        for name in names:
+            if name in memo:
+                values[name] = memo[name]
+            elif name not in values:
+                values[name] = None
+                missing.append(name)
+        for variable in self._variables:
+            if not missing:
+                break
+            found = hook(variable, 'lookup_many')(missing)
+            missing = [name for name in missing if found.get(name) is None]
+            for name in found:
+                if values.get(name) is None:
+                    values[name] = found[name]
+        for name in values:
+            memo[name] = values[name]
+        return values
+
+    def clear(self) -> None:
+        """
+        Forget memoized lookups
+        """
+        self._memo.clear()
+
+
+class CachingVariable(Variable):
+    """
+    Caching resolver wrapper, for slow resolvers (files, services)
+
+    Keeps up to max_size values (least recently used are dropped), each for ttl
+    seconds. Unknown variables (None) are cached too, unless negative is False.
+    The cache is thread-safe, so it can be shared by all tokenizers; the wrapped
+    resolver is called without holding the lock.
+    """
+
+    def __init__(self, variable: Variable, max_size: int = 1024, ttl: float = None, negative: bool = True,
+                 clock=time.monotonic) -> object:
+        """
+        Wrap a resolver
+
+        :param variable: the slow resolver
+        :param max_size: max number of cached names
+        :param ttl: seconds a value is cached (None is forever)
+        :param negative: if unknown variables should be cached
+        :param clock: function returning the time in seconds
+        """
+        if max_size < 1:
+            raise Exception("max_size should be positive")
+        self._variable = variable
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative = negative
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # name -> (value, expires)
+        self._generation = 0  # bumped by invalidate(), lookups started before are not stored
+        self.hits = 0
+        self.misses = 0
+
+    def get_name(self, reader: Reader) -> _str:
+        """
+        Read a name, using the wrapped resolver
+
+        :param reader: the input source
+        :return: variable name read from input
+        """
+        return self._variable.get_name(reader)
+
+    def begin_parse(self) -> None:
+        """
+        Pass it on to the wrapped resolver, the cache outlives a parse
+        """
+        hook(self._variable, 'begin_parse')()
+
+    def forget(self, names: List[str] = None) -> None:
+        """
+        Drop the cached values of the names (see invalidate()), and pass it on to the wrapped resolver
+
+        :param names: variable names, None for all
+        """
+        if names is None:
+            self.invalidate()
+        else:
+            for name in names:
+                self.invalidate(name)
+        hook(self._variable, 'forget')(names)
+
+    def name_syntax(self):
+        """
+        Name syntax of the wrapped resolver
+
+        :return: see Variable.name_syntax()
+        """
+        return hook(self._variable, 'name_syntax')()
+
+    def lookup_variable(self, name: str) -> _str:
+        """
+        Resolve variable name from cache or the wrapped resolver
+        :param name: name to look up
+        :return: value or None if the variable is unknown
+        """
+        with self._lock:
+            (found, value) = self._cached(name)
+            generation = self._generation
+        if found:
+            return value
+        value = self._variable.lookup_variable(name)
+        self._store({name: value}, generation)
+        return value
+
+    def lookup_many(self, names: List[str]) -> dict:
+        """
+        Resolve a batch of variables, names that are not cached are resolved in one batch
+        :param names: variable names
+        :return: dict of name to value (None if the variable is unknown)
+        """
+        values = {}
+        missing = []
+        with self._lock:
+            for name in dict.fromkeys(names):
+                (found, value) = self._cached(name)
+                values[name] = value
+                if not found:
+                    missing.append(name)
+            generation = self._generation
+        if missing:
+            found = hook(self._variable, 'lookup_many')(missing)
+            values.update(found)
+            self._store(found, generation)
+        return values
+
+    def _cached(self, name: str) -> tuple:
+        """
+        Take a value from the cache, lock must be held
+
+        :param name: name to look up
+        :return: tuple of (found, value)
+        """
+        entry = self._cache.get(name)
+        if entry is not None:
+            (value, expires) = entry
+            if expires is None or expires > self._clock():
+                self._cache.move_to_end(name)
+                self.hits += 1
+                return True, value
+            del self._cache[name]
+        self.misses += 1
+        return False, None
+
+    def _store(self, values: dict, generation: int) -> None:
+        """
+        Cache values, unless the cache was invalidated since they were looked up
+
+        :param values: dict of name to value
+        :param generation: the generation when the lookup started
+        """
+        expires = None
+        if self._ttl is not None:
+            expires = self._clock() + self._ttl
+        with self._lock:
+            if generation != self._generation:
+                return
+            for (name, value) in values.items():
+                if value is None and not self._negative:
+                    continue
+                self._cache[name] = (value, expires)
+                self._cache.move_to_end(name)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, name: str = None) -> None:
+        """
+        Drop cached values
+
+        :param name: variable to drop, None drops all
+        """
+        with self._lock:
+            self._generation += 1
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
+
+    def stats(self) -> dict:
+        """
+        Cache statistics
+
+        :return: dict with hits, misses and size
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache)}
@@ -5,6 +5,9 @@ setup(
     version='0.9',
     packages=['expanding'],
     package_dir={'expanding': 'expanding'},
+    extras_require={
+        'batch': ['numpy']
+    },
     options={
         'build_exe': {
             'packages': find_packages(exclude=['tests', 'example', 'README.md'])